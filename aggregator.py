@@ -1,103 +1,112 @@
-import asyncpraw
-from datetime import datetime
-from ai_engine import extract_post_info 
-from dotenv import load_dotenv
-from db import connect_to_db, save_post_to_db, Post
-from tele_bot import send_to_telegram
-import os
-
-load_dotenv()
-
-# Reddit API setup
-REDDIT_CLIENT_ID = os.getenv("REDDIT_CLIENT_ID")
-REDDIT_CLIENT_SECRET = os.getenv("REDDIT_CLIENT_SECRET")
-REDDIT_USER_AGENT = os.getenv("REDDIT_USER_AGENT")
-
-async def create_reddit_client():
-    return asyncpraw.Reddit(
-        client_id=REDDIT_CLIENT_ID,
-        client_secret=REDDIT_CLIENT_SECRET,
-        user_agent=REDDIT_USER_AGENT
-    )
-
-# Sample category and subreddit list
-subreddit_categories = [
-    {
-        "category": "Teaching Python",
-        "subreddits": ["learnpython"],
-        "tele_addy": "5871291837"
-    },
-    {
-        "category": "SaaS Development",
-        "subreddits": ["startups", "Entrepreneur"],
-        "tele_addy": "5871291837"
-    }
-]
-
-async def fetch_and_aggregate_data(reddit, interval=3600, limit=1):
-    """
-    Function that runs on a loop and grabs the most recent post from each subreddit.
-    The interval can be set in seconds, default is 1 hour (3600 seconds).
-    """
-    while True:
-        for category_obj in subreddit_categories:
-            category = category_obj["category"]
-            subreddits = category_obj["subreddits"]
-
-            for subreddit_name in subreddits:
-                subreddit = await reddit.subreddit(subreddit_name)
-                
-                # Use async for to iterate over the async generator
-                async for post in subreddit.new(limit=limit):
-                    reddit_post_id = post.id
-
-                    # Check if the post already exists in the database
-                    if Post.objects(reddit_post_id=reddit_post_id).first():
-                        print(f"Post {reddit_post_id} already exists in the database. Skipping...")
-                        continue  # Skip to the next post if it's already in the database
-                    
-                    title = post.title
-                    content = post.selftext
-                    posted_time = datetime.fromtimestamp(post.created_utc)
-                    # Load the author object before accessing its attributes
-                    if post.author:
-                        await post.author.load()  # Load the author object
-                        reddit_user_id = post.author.id if post.author else "Unknown"
-                        username = post.author.name if post.author else "Unknown"
-                    else:
-                        reddit_user_id = "Unknown"
-                        username = "Unknown"
-
-                    # username = post.author.name if post.author else "Unknown"
-                    # reddit_user_id = post.author.id if post.author else "Unknown"
-
-                    # Call the AI function to extract relevant info
-                    extracted_info = extract_post_info(title, content, subreddit_name, category)
-
-                    # Add the posted time before uploading to the database
-                    extracted_info["time_created"] = posted_time.isoformat()
-                    extracted_info["reddit_post_id"] = reddit_post_id
-                    extracted_info["category"] = category
-                    extracted_info["filter_type"] = "new"
-                    extracted_info["username"] = username
-                    extracted_info["reddit_user_id"] = reddit_user_id
-
-                    # send message to telegram
-                    await send_to_telegram(category_obj["tele_addy"], extracted_info, category)
-
-                    # Save data to db
-                    save_post_to_db(extracted_info, username)
-                    print("Post saved.")
-
-        # Wait for the next iteration
-        print(f"Waiting {interval} seconds for the next run...")
-        await asyncio.sleep(interval)
-
-async def main():
-    connect_to_db()
-    reddit = await create_reddit_client()
-    await fetch_and_aggregate_data(reddit, limit=3)
-
-if __name__ == "__main__":
-    import asyncio
-    asyncio.run(main())
+import asyncio
+from dotenv import load_dotenv
+from bot_routes import get_registry
+from db import connect_to_db, ensure_indexes
+from embedding_index import EMBEDDING_INDEX_ENABLED, EMBEDDING_INDEX_PATH, EmbeddingIndex
+from fetch_planner import FetchPlanner
+import metrics
+from pipeline import Pipeline
+from reddit_scraper import reddit_client, close_reddit_client
+from scheduler import PollScheduler
+from sharding import SHARDING_ENABLED, WORKER_ID, ShardCoordinator
+from work_queue import WORK_QUEUE_PATH, WorkQueue
+import os
+
+load_dotenv()
+
+async def create_reddit_client():
+    # Shares the client, and its HTTP session, with reddit_scraper
+    return reddit_client()
+
+# Sample category and subreddit list
+subreddit_categories = [
+    {
+        "category": "Teaching Python",
+        "subreddits": ["learnpython"],
+        "tele_addy": "5871291837"
+    },
+    {
+        "category": "SaaS Development",
+        "subreddits": ["startups", "Entrepreneur"],
+        "tele_addy": "5871291837"
+    }
+]
+
+async def fetch_and_aggregate_data(reddit, interval=3600, limit=1):
+    """
+    Function that runs forever and polls every subreddit for new posts.
+
+    Each subreddit is polled on its own schedule, based on how fast posts arrive there: busy
+    subreddits are polled more often, quiet ones at most every `interval` seconds (default is
+    1 hour). Due subreddits are fed into a staged pipeline (fetch, enrich, deliver, persist)
+    so that slow subreddits or slow LLM responses don't hold up the rest. Quiet subreddits
+    are fetched together through combined r/a+b+c listings (see fetch_planner.FetchPlanner).
+
+    With SHARDING_ENABLED, several of these loops can run in separate processes or on
+    separate machines: each one only polls the share of the subreddits it holds a lease on
+    (see sharding.ShardCoordinator), and the shares rebalance when a worker joins or dies.
+    """
+    scheduler = FetchPlanner(PollScheduler(max_interval=interval))
+    routes = get_registry()
+    subreddits = {}
+    for category_obj in subreddit_categories:
+        if category_obj["category"] not in routes:
+            print(f"Category {category_obj['category']} has no Telegram route, its alerts won't be sent.")
+        for subreddit_name in category_obj["subreddits"]:
+            subreddits[subreddit_name] = category_obj
+
+    coordinator, work_queue, embeddings = None, None, None
+    if SHARDING_ENABLED:
+        coordinator = ShardCoordinator(subreddits)
+        await asyncio.to_thread(coordinator.join)
+        # Each worker resumes its own unfinished posts, so they get a queue file of their own
+        root, ext = os.path.splitext(WORK_QUEUE_PATH)
+        work_queue = WorkQueue(f"{root}.{WORKER_ID}{ext}")
+        if EMBEDDING_INDEX_ENABLED:
+            # The index is local to each worker: duplicates are only caught among the subreddits of one shard,
+            # a post repeated across subreddits owned by different workers is alerted once per worker
+            embeddings = EmbeddingIndex(f"{EMBEDDING_INDEX_PATH}.{WORKER_ID}")
+    else:
+        for subreddit_name, category_obj in subreddits.items():
+            scheduler.add(subreddit_name, category_obj)
+
+    pipeline = Pipeline(reddit, limit=limit, scheduler=scheduler, work_queue=work_queue, embeddings=embeddings)
+    await pipeline.load()
+    pipeline.start()
+    try:
+        metrics_server = await metrics.serve()
+    except OSError as e:
+        # e.g. another worker on this host already took the port, set METRICS_PORT per worker
+        print(f"Metrics endpoint not started: {e}")
+        metrics_server = None
+    metrics_task = asyncio.create_task(metrics.log_periodically())
+    if coordinator is not None:
+        # The previous owner of a subreddit moved its cursor since we loaded it
+        coordinator_task = asyncio.create_task(
+            coordinator.run(scheduler, on_acquire=lambda acquired: pipeline.reload_cursors())
+        )
+    try:
+        while True:
+            group_name, members = await scheduler.next_due()
+            await pipeline.submit_group(group_name, members)
+    finally:
+        metrics_task.cancel()
+        if metrics_server is not None:
+            metrics_server.close()
+        if coordinator is not None:
+            coordinator_task.cancel()
+            await asyncio.gather(coordinator_task, return_exceptions=True)
+            await asyncio.to_thread(coordinator.leave)
+        await pipeline.stop()
+
+async def main():
+    connect_to_db()
+    ensure_indexes()
+    reddit = await create_reddit_client()
+    try:
+        await fetch_and_aggregate_data(reddit, limit=3)
+    finally:
+        await close_reddit_client()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,113 +1,388 @@
-from openai import OpenAI
-from dotenv import load_dotenv
-import os, json
-from datetime import datetime
-
-load_dotenv()
-
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-
-def extract_post_info(title, content, subreddit, category):
-    client = OpenAI(api_key=OPENAI_API_KEY)
-
-    response = client.chat.completions.create(
-        model="gpt-4o-2024-08-06",
-        messages=[
-            {
-                "role": "system",
-                "content": f"""
-                You are an AI assistant tasked with extracting structured data from online Reddit posts.
-                I will provide you with a title, the full text of a post, the subreddit, and the category of the subreddit.
-                Please analyze the post and extract the following information:
-
-                1. All topics discussed.
-                2. All specific questions or requests made.
-                3. Relevant keywords and phrases.
-                4. Sentiment is a list of contextualized sentiments -> here are examples of some (positive, negative, neutral, looking_for_help, angry, confused, excited, afraid, promoting.).
-                5. Any explicit actions or next steps based on the content in the post or the title that I can react to help?
-                6. A 75-word max summary of the post given that the goal is to help them by providing a ChatGPT prompt that will guide them through their issue.
-                7. Provide 3 optimal responses that help the user if the sentiment shows they are looking for help. These should create prompts that the user can use inside ChatGPT to walk them through their issue. Also give advice on how LLMs are perfect to explore questions and using YouTube as a guide will help tremendously.
-
-                Return the information in the following JSON structure:
-                
-                {{
-                    "title": "{title}",
-                    "subreddit": "{subreddit}",
-                    "category": "{category}",
-                    "topics_discussed": [],
-                    "questions_requests": [],
-                    "keywords": [],
-                    "sentiment": [],
-                    "actions_next_steps": [],
-                    "summary": "",
-                    "suggested_responses": []
-                }}
-                """
-            },
-            {
-                "role": "user",
-                "content": f"Title: {title}\nContent: {content}\nSubreddit: {subreddit}\nCategory: {category}"
-            }
-        ],
-        response_format={
-            "type": "json_schema",
-            "json_schema": {
-                "name": "post_extraction_schema",
-                "schema": {
-                    "type": "object",
-                    "properties": {
-                        "title": {"type": "string"},
-                        "subreddit": {"type": "string"},
-                        "category": {"type": "string"},
-                        "topics_discussed": {
-                            "type": "array",
-                            "items": {"type": "string"}
-                        },
-                        "questions_requests": {
-                            "type": "array",
-                            "items": {"type": "string"}
-                        },
-                        "keywords": {
-                            "type": "array",
-                            "items": {"type": "string"}
-                        },
-                        "sentiment": {
-                            "type": "array",
-                            "items": {"type": "string"}
-                        },
-                        "actions_next_steps": {
-                            "type": "array",
-                            "items": {"type": "string"}
-                        },
-                        "summary": {"type": "string"},
-                        "suggested_responses": {
-                            "type": "array",
-                            "items": {"type": "string"}
-                        },
-                    },
-                    "additionalProperties": False
-                }
-            }
-        }
-    )
-
-    # Get the json back from OpenAI in string format
-    str_json = response.choices[0].message.content
-
-    # Convert it to a Python object
-    data_obj = json.loads(str_json)
-
-    # Add the current time for when the data was scraped
-    data_obj["time_scraped"] = datetime.now().isoformat()
-
-    return data_obj
-
-if __name__ == "__main__":
-    import pprint
-    # Example Usage
-    title = "How to Learn Python Effectively"
-    content = "I am trying to learn Python but I am not sure where to start. What are the best resources?"
-    subreddit = "learnpython"
-    category = "Education"
-    json_output = extract_post_info(title, content, subreddit, category)
-    pprint.pprint(json_output)
+from openai import OpenAI, AsyncOpenAI
+from dotenv import load_dotenv
+import asyncio
+import os, json
+from datetime import datetime
+from extraction_cache import ExtractionCache, make_cache_key
+import metrics
+from prompt_builder import build_request
+import time
+
+load_dotenv()
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+# Point OPENAI_BASE_URL at a local stub of the chat-completions endpoint to run without the real API
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
+# Part of the extraction cache key, bump it whenever the prompt or the schema changes
+PROMPT_VERSION = 2
+
+# Number of chat-completion requests the async engine keeps in flight at once
+EXTRACTION_CONCURRENCY = int(os.getenv("EXTRACTION_CONCURRENCY", "4"))
+# Max number of small posts packed into a single request, and how long to wait for a batch to fill up
+EXTRACTION_BATCH_SIZE = int(os.getenv("EXTRACTION_BATCH_SIZE", "5"))
+EXTRACTION_BATCH_WINDOW = float(os.getenv("EXTRACTION_BATCH_WINDOW", "0.5"))
+# Posts whose title and content are shorter than this are considered small enough to be packed
+EXTRACTION_SMALL_POST_CHARS = int(os.getenv("EXTRACTION_SMALL_POST_CHARS", "1500"))
+
+POST_EXTRACTION_PROPERTIES = {
+    "title": {"type": "string"},
+    "subreddit": {"type": "string"},
+    "category": {"type": "string"},
+    "topics_discussed": {
+        "type": "array",
+        "items": {"type": "string"}
+    },
+    "questions_requests": {
+        "type": "array",
+        "items": {"type": "string"}
+    },
+    "keywords": {
+        "type": "array",
+        "items": {"type": "string"}
+    },
+    "sentiment": {
+        "type": "array",
+        "items": {"type": "string"}
+    },
+    "actions_next_steps": {
+        "type": "array",
+        "items": {"type": "string"}
+    },
+    "summary": {"type": "string"},
+    "suggested_responses": {
+        "type": "array",
+        "items": {"type": "string"}
+    },
+}
+
+POST_EXTRACTION_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "post_extraction_schema",
+        "schema": {
+            "type": "object",
+            "properties": POST_EXTRACTION_PROPERTIES,
+            "additionalProperties": False
+        }
+    }
+}
+
+BATCH_EXTRACTION_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "batch_post_extraction_schema",
+        "schema": {
+            "type": "object",
+            "properties": {
+                "posts": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {"reddit_post_id": {"type": "string"}, **POST_EXTRACTION_PROPERTIES},
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "additionalProperties": False
+        }
+    }
+}
+
+_client = None
+_async_client = None
+
+def get_client():
+    """
+    Returns the shared synchronous OpenAI client, creating it on first use.
+    """
+    global _client
+    if _client is None:
+        _client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
+    return _client
+
+def get_async_client():
+    """
+    Returns the shared AsyncOpenAI client, creating it on first use.
+    All async extractions go through its connection pool.
+    """
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
+    return _async_client
+
+def parse_extraction(str_json):
+    """
+    Converts the JSON string returned by OpenAI into a Python object and stamps the scrape time.
+    """
+    data_obj = json.loads(str_json)
+
+    # Add the current time for when the data was scraped
+    data_obj["time_scraped"] = datetime.now().isoformat()
+
+    return data_obj
+
+def empty_extraction(title, subreddit, category):
+    """
+    Returns an extraction with no LLM output, for posts stored without being analyzed.
+    """
+    return {
+        "title": title,
+        "subreddit": subreddit,
+        "category": category,
+        "topics_discussed": [],
+        "questions_requests": [],
+        "keywords": [],
+        "sentiment": [],
+        "actions_next_steps": [],
+        "summary": "",
+        "suggested_responses": [],
+        "time_scraped": datetime.now().isoformat(),
+    }
+
+def record_usage(response, kind, started, request):
+    """
+    Records the latency of a chat completion, the tokens it used, from response.usage, and the
+    tokens its prompt saved.
+    """
+    metrics.observe("llm_request_seconds", time.perf_counter() - started, kind=kind)
+    metrics.inc("llm_requests_total", kind=kind, model=request["model"])
+    metrics.observe("llm_tokens_saved", request["tokens_saved"], buckets=metrics.TOKEN_BUCKETS)
+    metrics.inc("llm_tokens_saved_total", request["tokens_saved"], reason="truncation")
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    metrics.inc("llm_tokens_total", usage.prompt_tokens or 0, type="prompt")
+    metrics.inc("llm_tokens_total", usage.completion_tokens or 0, type="completion")
+    details = getattr(usage, "prompt_tokens_details", None)
+    if details is not None and getattr(details, "cached_tokens", None):
+        metrics.inc("llm_tokens_total", details.cached_tokens, type="cached")
+
+def extract_post_info(title, content, subreddit, category):
+    request = build_request([{"title": title, "content": content, "subreddit": subreddit, "category": category}])
+    started = time.perf_counter()
+    response = get_client().chat.completions.create(
+        model=request["model"],
+        messages=request["messages"],
+        response_format=POST_EXTRACTION_FORMAT
+    )
+    record_usage(response, "single", started, request)
+
+    # Get the json back from OpenAI in string format
+    str_json = response.choices[0].message.content
+
+    return parse_extraction(str_json)
+
+async def extract_post_info_async(title, content, subreddit, category):
+    """
+    Async version of extract_post_info that doesn't block the event loop.
+    """
+    request = build_request([{"title": title, "content": content, "subreddit": subreddit, "category": category}])
+    started = time.perf_counter()
+    response = await get_async_client().chat.completions.create(
+        model=request["model"],
+        messages=request["messages"],
+        response_format=POST_EXTRACTION_FORMAT
+    )
+    record_usage(response, "single", started, request)
+    return parse_extraction(response.choices[0].message.content)
+
+async def extract_posts_batch(posts):
+    """
+    Extracts several posts with a single structured-output request.
+
+    Parameters:
+    ----------
+    posts : list
+        Post dicts with reddit_post_id, title, content, subreddit and category.
+
+    Returns:
+    -------
+    dict
+        The extracted data of each post keyed by reddit_post_id. Posts the model left out are missing.
+    """
+    request = build_request(posts, batch=True)
+    started = time.perf_counter()
+    response = await get_async_client().chat.completions.create(
+        model=request["model"],
+        messages=request["messages"],
+        response_format=BATCH_EXTRACTION_FORMAT
+    )
+    record_usage(response, "batch", started, request)
+    metrics.inc("llm_batched_posts_total", len(posts))
+    data_obj = parse_extraction(response.choices[0].message.content)
+
+    requested_ids = {post["reddit_post_id"] for post in posts}
+    results = {}
+    for post_info in data_obj.get("posts", []):
+        reddit_post_id = post_info.pop("reddit_post_id", None)
+        if reddit_post_id in requested_ids:
+            post_info["time_scraped"] = data_obj["time_scraped"]
+            results[reddit_post_id] = post_info
+    return results
+
+
+class ExtractionEngine:
+    """
+    Async extraction service shared by the whole pipeline.
+
+    Runs up to max_concurrency chat-completion requests at once over the pooled AsyncOpenAI
+    client. Small posts that arrive within batch_window seconds of each other are packed into
+    one batch request of up to batch_size posts and the result is split back per reddit_post_id.
+
+    Attributes:
+    ----------
+    max_concurrency : int
+        Max number of requests in flight.
+    batch_size : int
+        Max number of posts packed into one request, 1 disables packing.
+    batch_window : float
+        Seconds to wait for more small posts before sending a partial batch.
+    small_post_chars : int
+        Posts with a longer title plus content are always extracted on their own.
+    cache : ExtractionCache
+        Content-hash cache checked before any request, None disables it.
+    """
+    def __init__(self, max_concurrency=EXTRACTION_CONCURRENCY, batch_size=EXTRACTION_BATCH_SIZE,
+                 batch_window=EXTRACTION_BATCH_WINDOW, small_post_chars=EXTRACTION_SMALL_POST_CHARS,
+                 cache=None, use_cache=True):
+        self.cache = cache if cache is not None or not use_cache else ExtractionCache()
+        self.max_concurrency = max_concurrency
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.small_post_chars = small_post_chars
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._pending = []
+        self._flush_handle = None
+        self._tasks = set()
+        # Extractions in flight by cache key, so identical posts arriving together share one request
+        self._in_flight = {}
+
+    async def extract(self, reddit_post_id, title, content, subreddit, category):
+        """
+        Extracts the structured info of one post, packing it with other small posts when possible.
+        Near-duplicates of a post extracted before are answered from the cache without a request.
+        """
+        if self.cache is None:
+            return await self._extract_uncached(reddit_post_id, title, content, subreddit, category)
+
+        key = make_cache_key(title, content, category, PROMPT_VERSION)
+        cached = self.cache.get(key)
+        metrics.inc("extraction_cache_total", result="miss" if cached is None else "hit")
+        if cached is None:
+            if key not in self._in_flight:
+                self._in_flight[key] = asyncio.ensure_future(
+                    self._extract_uncached(reddit_post_id, title, content, subreddit, category)
+                )
+                self._in_flight[key].add_done_callback(lambda _: self._in_flight.pop(key, None))
+                cached = await asyncio.shield(self._in_flight[key])
+                self.cache.put(key, cached)
+            else:
+                cached = await asyncio.shield(self._in_flight[key])
+
+        # The cached extraction may come from a repost, so restamp it with this post's own values
+        data_obj = json.loads(json.dumps(cached))
+        data_obj["title"] = title
+        data_obj["subreddit"] = subreddit
+        data_obj["category"] = category
+        data_obj["time_scraped"] = datetime.now().isoformat()
+        return data_obj
+
+    async def _extract_uncached(self, reddit_post_id, title, content, subreddit, category):
+        if self.batch_size <= 1 or len(title) + len(content) > self.small_post_chars:
+            return await self._extract_single(title, content, subreddit, category)
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(({
+            "reddit_post_id": reddit_post_id,
+            "title": title,
+            "content": content,
+            "subreddit": subreddit,
+            "category": category,
+        }, future))
+
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.batch_window, self._flush)
+
+        return await future
+
+    async def _extract_single(self, title, content, subreddit, category):
+        async with self._semaphore:
+            return await extract_post_info_async(title, content, subreddit, category)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            self._spawn(self._run_batch(batch))
+
+    def _spawn(self, coro):
+        # Keep a reference so the task isn't garbage collected and close() can wait for it
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch):
+        posts = [post for post, _ in batch]
+        try:
+            if len(posts) == 1:
+                results = {posts[0]["reddit_post_id"]: await self._extract_single(
+                    posts[0]["title"], posts[0]["content"], posts[0]["subreddit"], posts[0]["category"]
+                )}
+            else:
+                async with self._semaphore:
+                    results = await extract_posts_batch(posts)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for post, future in batch:
+            if future.done():
+                continue
+            if post["reddit_post_id"] in results:
+                future.set_result(results[post["reddit_post_id"]])
+            else:
+                # The model dropped this post from the batch, extract it on its own
+                self._spawn(self._resolve_single(post, future))
+
+    async def _resolve_single(self, post, future):
+        try:
+            result = await self._extract_single(post["title"], post["content"], post["subreddit"], post["category"])
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result(result)
+
+    async def close(self):
+        """
+        Finishes pending extractions and closes the cache and the shared async client.
+        """
+        global _async_client
+        self._flush()
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.cache is not None:
+            print(f"Extraction cache: {self.cache.stats()}")
+            self.cache.close()
+            self.cache = None
+        if _async_client is not None:
+            await _async_client.close()
+            _async_client = None
+
+if __name__ == "__main__":
+    import pprint
+    # Example Usage
+    title = "How to Learn Python Effectively"
+    content = "I am trying to learn Python but I am not sure where to start. What are the best resources?"
+    subreddit = "learnpython"
+    category = "Education"
+    json_output = extract_post_info(title, content, subreddit, category)
+    pprint.pprint(json_output)
@@ -0,0 +1,235 @@
+from db import Post, load_post_terms
+from bson import ObjectId
+from dotenv import load_dotenv
+import datetime
+import json
+import os
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as pds
+import pyarrow.fs
+import pyarrow.parquet as pq
+
+load_dotenv()
+
+# Root directory of the Parquet archive, laid out as category=<category>/day=<YYYY-MM-DD>/part-*.parquet
+ARCHIVE_PATH = os.getenv("ARCHIVE_PATH", "archive")
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "10000"))
+# Posts are exported in saved_at order, stamped right before their write. Only posts saved longer ago
+# than this are exported, so a write still in progress isn't skipped by the next incremental run
+ARCHIVE_LAG = float(os.getenv("ARCHIVE_LAG", "300"))
+STATE_FILE = "_export_state.json"
+UNCATEGORIZED = "uncategorized"
+
+PROJECTION = {
+    "reddit_post_id": 1, "subreddit": 1, "category": 1, "time_created": 1, "time_scraped": 1, "title": 1,
+    "reddit_user_id": 1, "sentiment": 1, "summary": 1, "action_type": 1, "filter_type": 1,
+    "suggested_responses": 1, "cluster_id": 1, "topic_terms": 1, "keyword_terms": 1, "saved_at": 1,
+}
+
+SCHEMA = pa.schema([
+    ("object_id", pa.string()),
+    ("reddit_post_id", pa.string()),
+    ("subreddit", pa.string()),
+    ("category", pa.string()),
+    ("day", pa.string()),
+    ("time_created", pa.timestamp("ms")),
+    ("time_scraped", pa.timestamp("ms")),
+    ("title", pa.string()),
+    ("reddit_user_id", pa.string()),
+    ("summary", pa.string()),
+    ("action_type", pa.string()),
+    ("filter_type", pa.string()),
+    ("cluster_id", pa.string()),
+    ("sentiment", pa.list_(pa.string())),
+    ("topics", pa.list_(pa.string())),
+    ("keywords", pa.list_(pa.string())),
+    ("suggested_responses", pa.list_(pa.string())),
+])
+PARTITIONING = pds.partitioning(pa.schema([("category", pa.string()), ("day", pa.string())]), flavor="hive")
+TERM_COLUMNS = {"topic": "topics", "keyword": "keywords", "sentiment": "sentiment"}
+
+
+def _state_path(path):
+    return os.path.join(path, STATE_FILE)
+
+def load_state(path=ARCHIVE_PATH):
+    """
+    Returns the export state of an archive, {'last_saved_at': str, 'last_id': str, 'exported': int},
+    empty before the first export.
+    """
+    if not os.path.exists(_state_path(path)):
+        return {}
+    with open(_state_path(path)) as f:
+        return json.load(f)
+
+def _save_state(path, state):
+    # Written aside then renamed, so a crash never leaves a half-written state
+    temp_path = _state_path(path) + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(temp_path, _state_path(path))
+
+def post_rows(posts):
+    """
+    Flattens raw post documents and their topics and keywords into rows of SCHEMA.
+    """
+    terms = load_post_terms(posts)
+    rows = []
+    for post in posts:
+        time_created = post.get("time_created")
+        rows.append({
+            "object_id": str(post["_id"]),
+            "reddit_post_id": post.get("reddit_post_id"),
+            "subreddit": post.get("subreddit"),
+            "category": post.get("category") or UNCATEGORIZED,
+            "day": time_created.date().isoformat() if time_created else post["_id"].generation_time.date().isoformat(),
+            "time_created": time_created,
+            "time_scraped": post.get("time_scraped"),
+            "title": post.get("title"),
+            "reddit_user_id": post.get("reddit_user_id"),
+            "summary": post.get("summary"),
+            "action_type": post.get("action_type"),
+            "filter_type": post.get("filter_type"),
+            "cluster_id": post.get("cluster_id"),
+            "sentiment": [s for s in (post.get("sentiment") or "").split(", ") if s],
+            "topics": terms[post["_id"]]["topic"],
+            "keywords": terms[post["_id"]]["keyword"],
+            "suggested_responses": post.get("suggested_responses", []),
+        })
+    return rows
+
+def export_posts(path=ARCHIVE_PATH, batch_size=ARCHIVE_BATCH_SIZE, lag=ARCHIVE_LAG):
+    """
+    Appends the posts saved since the last export to the archive.
+
+    Posts are streamed in (saved_at, _id) order as raw documents, with only the archived fields
+    and no dereferencing, and each batch is written as one Parquet file per category and day.
+    The position of the last exported post is recorded after every batch, so an interrupted
+    export resumes where it stopped, and a batch exported twice overwrites its own files.
+    Posts written before saved_at existed need `python db.py backfill-saved-at` first.
+
+    Returns:
+    -------
+    int
+        Number of posts exported.
+    """
+    os.makedirs(path, exist_ok=True)
+    state = load_state(path)
+    collection = Post._get_collection()
+    if collection.find_one({"saved_at": None}, {"_id": 1}) is not None:
+        print("Some posts have no saved_at and are not exported, run `python db.py backfill-saved-at`.")
+    if state.get("last_id") and not state.get("last_saved_at"):
+        # Archives started in _id order, the backfilled saved_at of those posts follows the same order.
+        # Posts saved later than their _id are already exported up to last_id, the first run skips them.
+        state["last_saved_at"] = ObjectId(state["last_id"]).generation_time.replace(tzinfo=None).isoformat()
+        state["skip_through_id"] = state["last_id"]
+
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=lag)
+    query = {"saved_at": {"$lt": cutoff}}
+    if state.get("last_saved_at"):
+        last_saved_at = datetime.datetime.fromisoformat(state["last_saved_at"])
+        query = {"$and": [query, {"$or": [
+            {"saved_at": {"$gt": last_saved_at}},
+            {"saved_at": last_saved_at, "_id": {"$gt": ObjectId(state["last_id"])}},
+        ]}]}
+    if state.get("skip_through_id"):
+        query = {"$and": [query, {"_id": {"$gt": ObjectId(state["skip_through_id"])}}]}
+
+    cursor = collection.find(query, PROJECTION).sort([("saved_at", 1), ("_id", 1)]).batch_size(batch_size)
+    exported = 0
+    batch = []
+
+    def flush():
+        table = pa.Table.from_pylist(post_rows(batch), schema=SCHEMA)
+        pq.write_to_dataset(
+            table, path, partitioning=PARTITIONING, basename_template=f"part-{batch[0]['_id']}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore"
+        )
+        state["last_saved_at"] = batch[-1]["saved_at"].isoformat()
+        state["last_id"] = str(batch[-1]["_id"])
+        state["exported"] = state.get("exported", 0) + len(batch)
+        _save_state(path, state)
+
+    for post in cursor:
+        batch.append(post)
+        if len(batch) >= batch_size:
+            flush()
+            exported += len(batch)
+            batch = []
+    if batch:
+        flush()
+        exported += len(batch)
+    if state.pop("skip_through_id", None):
+        _save_state(path, state)
+    print(f"Exported {exported} posts to {path}.")
+    return exported
+
+def open_archive(path=ARCHIVE_PATH):
+    """
+    Opens the archive as a pyarrow dataset whose files are memory-mapped rather than read.
+    """
+    return pds.dataset(
+        path, format="parquet", partitioning=PARTITIONING, exclude_invalid_files=True,
+        filesystem=pyarrow.fs.LocalFileSystem(use_mmap=True)
+    )
+
+def _filter(categories=None, since=None, until=None):
+    # Partition fields, so whole directories are skipped rather than rows filtered
+    expression = None
+    conditions = []
+    if categories is not None:
+        conditions.append(pc.field("category").isin(list(categories)))
+    if since is not None:
+        conditions.append(pc.field("day") >= since.isoformat())
+    if until is not None:
+        conditions.append(pc.field("day") < until.isoformat())
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return expression
+
+def read_posts(categories=None, since=None, until=None, columns=None, path=ARCHIVE_PATH):
+    """
+    Reads archived posts into a pyarrow Table, call .to_pandas() on it for a DataFrame.
+
+    Parameters:
+    ----------
+    categories : list, optional
+        Categories to read, all of them by default.
+    since, until : datetime.date, optional
+        Days to read, since included and until excluded.
+    columns : list, optional
+        Columns to read, all of them by default. Reading fewer is much faster.
+    """
+    return open_archive(path).to_table(columns=columns, filter=_filter(categories, since, until))
+
+def term_counts(kind, categories=None, since=None, until=None, n=10, path=ARCHIVE_PATH):
+    """
+    Returns the n most frequent terms of a kind in the archived posts, as [(term, count), ...].
+    """
+    if kind not in TERM_COLUMNS:
+        raise ValueError("Invalid kind. Use 'keyword', 'topic', or 'sentiment'.")
+    column = read_posts(categories, since, until, [TERM_COLUMNS[kind]], path).column(TERM_COLUMNS[kind])
+    counts = pc.value_counts(pc.list_flatten(column))
+    if not len(counts):
+        return []
+    counts = counts.take(pc.sort_indices(counts.field("counts"), sort_keys=[("", "descending")])[:n])
+    return list(zip(counts.field("values").to_pylist(), counts.field("counts").to_pylist()))
+
+
+if __name__ == "__main__":
+    import sys
+
+    # python archive.py export | top <keyword|topic|sentiment> [category] [days]
+    command = sys.argv[1] if len(sys.argv) > 1 else "export"
+    if command == "top":
+        kind = sys.argv[2] if len(sys.argv) > 2 else "keyword"
+        categories = [sys.argv[3]] if len(sys.argv) > 3 else None
+        since = datetime.date.today() - datetime.timedelta(days=int(sys.argv[4])) if len(sys.argv) > 4 else None
+        for term, count in term_counts(kind, categories, since):
+            print(f"{count:>8}  {term}")
+    else:
+        from db import connect_to_db
+
+        connect_to_db()
+        export_posts()
@@ -0,0 +1,135 @@
+import asyncio
+from collections import OrderedDict
+from db import User
+from dotenv import load_dotenv
+import metrics
+import os
+import time
+
+load_dotenv()
+
+# How long a resolved author is trusted and how many are kept in memory
+AUTHOR_CACHE_TTL = float(os.getenv("AUTHOR_CACHE_TTL", str(24 * 3600)))
+AUTHOR_CACHE_MAX_ENTRIES = int(os.getenv("AUTHOR_CACHE_MAX_ENTRIES", "100000"))
+
+UNKNOWN_AUTHOR = ("Unknown", "Unknown")
+
+
+class AuthorCache:
+    """
+    Resolves the Reddit user ID of post authors without a Redditor load() per post.
+
+    Authors are looked up, in order, from:
+    1. the author_fullname Reddit already sends with every listing item,
+    2. this in-memory cache, shared across poll cycles,
+    3. the 'users' collection, with one query for all remaining authors of a batch,
+    4. a Redditor load() through the governor, once per remaining username.
+    Entries expire after ttl seconds and the least recently used ones are evicted past max_entries.
+
+    Attributes:
+    ----------
+    governor : RedditGovernor
+        Used for the load() fallback, None calls Reddit directly.
+    ttl : float
+        Seconds an entry stays valid.
+    max_entries : int
+        Max number of usernames kept.
+    hits, misses, loads : int
+        Cache hits, cache misses, and Reddit load() calls made.
+    """
+    def __init__(self, governor=None, ttl=AUTHOR_CACHE_TTL, max_entries=AUTHOR_CACHE_MAX_ENTRIES):
+        self.governor = governor
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self._entries = OrderedDict()
+
+    def get(self, username):
+        """
+        Returns the cached reddit_user_id of a username, or None.
+        """
+        entry = self._entries.get(username)
+        if entry is None or entry[1] < time.monotonic():
+            self._entries.pop(username, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(username)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, username, reddit_user_id):
+        self._entries[username] = (reddit_user_id, time.monotonic() + self.ttl)
+        self._entries.move_to_end(username)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _load_from_db(self, usernames):
+        return {
+            user["username"]: user["reddit_user_id"]
+            for user in User._get_collection().find(
+                {"username": {"$in": list(usernames)}}, {"username": 1, "reddit_user_id": 1, "_id": 0}
+            )
+        }
+
+    async def resolve_many(self, posts):
+        """
+        Resolves the authors of a batch of posts.
+
+        Returns:
+        -------
+        dict
+            (reddit_user_id, username) keyed by post id, ('Unknown', 'Unknown') for deleted authors.
+        """
+        authors = {}
+        missing = {}
+        for post in posts:
+            if not post.author:
+                authors[post.id] = UNKNOWN_AUTHOR
+                continue
+            username = post.author.name
+            fullname = getattr(post, "author_fullname", None)
+            if fullname:
+                # 't2_abc123' -> 'abc123', the same value Redditor.id holds after load()
+                self.put(username, fullname.split("_", 1)[-1])
+            reddit_user_id = self.get(username)
+            if reddit_user_id is None:
+                missing.setdefault(username, []).append(post)
+            else:
+                metrics.inc("author_lookups_total", source="listing" if fullname else "cache")
+                authors[post.id] = (reddit_user_id, username)
+
+        if missing:
+            with metrics.timer("author_db_lookup_seconds"):
+                found = await asyncio.to_thread(self._load_from_db, missing)
+            for username, reddit_user_id in found.items():
+                metrics.inc("author_lookups_total", source="db")
+                self.put(username, reddit_user_id)
+                for post in missing.pop(username):
+                    authors[post.id] = (reddit_user_id, username)
+
+        for username, user_posts in missing.items():
+            author = user_posts[0].author
+            self.loads += 1
+            metrics.inc("author_lookups_total", source="load")
+            try:
+                with metrics.timer("author_load_seconds"):
+                    if self.governor is not None:
+                        await self.governor.call(author.load)
+                    else:
+                        await author.load()
+            except Exception as e:
+                # Suspended or shadowbanned accounts can't be loaded, keep the name at least
+                print(f"Could not load author {username}: {e}")
+                reddit_user_id = UNKNOWN_AUTHOR[0]
+            else:
+                reddit_user_id = author.id
+                self.put(username, reddit_user_id)
+            for post in user_posts:
+                authors[post.id] = (reddit_user_id, username)
+
+        return authors
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "loads": self.loads, "size": len(self._entries)}
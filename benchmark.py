@@ -0,0 +1,424 @@
+"""
+Offline benchmark of the fetch -> enrich -> deliver -> persist pipeline.
+
+Runs the real Pipeline against in-process fakes: a synthetic asyncpraw-like listing
+generator, a chat-completions stub with configurable latency, a stub Telegram bot and
+mongomock, so no credentials or network are needed. Needs `pip install mongomock`.
+
+    python benchmark.py                       # every scenario
+    python benchmark.py baseline failures --duration 20 --json results.json
+"""
+import os
+
+# Every module reads its config at import time, so the fakes are wired in before importing them
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("EXTRACTION_CACHE_PATH", ":memory:")
+os.environ.setdefault("WORK_QUEUE_PATH", ":memory:")
+os.environ.setdefault("EMBEDDING_INDEX_PATH", ":memory:")
+os.environ.setdefault("WORK_QUEUE_BACKOFF_BASE", "0.5")
+os.environ.setdefault("WORK_QUEUE_POLL_INTERVAL", "0.5")
+os.environ.setdefault("POST_WRITER_MAX_AGE", "1")
+os.environ.setdefault("METRICS_LOG_INTERVAL", "0")
+os.environ.setdefault("BENCHMARK_LLM_PORT", "8790")
+os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{os.environ['BENCHMARK_LLM_PORT']}/v1"
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import random
+import re
+import time
+import tracemalloc
+import types
+
+from asyncprawcore.exceptions import ServerError
+from dotenv import load_dotenv
+import mongoengine
+
+load_dotenv()
+
+from bot_routes import BotRegistry
+from db import BulkPostWriter
+from metrics import Histogram, REGISTRY
+from pipeline import Pipeline
+from reddit_governor import RedditGovernor
+from relevance_filter import RelevanceFilter
+from fetch_planner import FetchPlanner
+from scheduler import PollScheduler
+from tele_bot import TelegramDispatcher
+from work_queue import WorkQueue
+
+BENCHMARK_CATEGORY = "Teaching Python"
+BENCHMARK_TOKEN = "0:benchmark"
+
+# Each scenario overrides DEFAULT_SCENARIO, rates are per subreddit
+DEFAULT_SCENARIO = {
+    "subreddits": 10,
+    "posts_per_minute": 60,
+    "duplicate_ratio": 0.0,
+    "long_post_ratio": 0.2,
+    "long_post_words": 400,
+    "llm_latency": 0.3,
+    "llm_failure_rate": 0.0,
+    "reddit_latency": 0.05,
+    "reddit_failure_rate": 0.0,
+    "telegram_latency": 0.02,
+    "poll_interval": 2.0,
+    "relevance_threshold": 0.0,
+    "max_group_size": 25,
+}
+SCENARIOS = {
+    "baseline": {},
+    "many_subreddits": {"subreddits": 100, "posts_per_minute": 12},
+    "many_subreddits_ungrouped": {"subreddits": 100, "posts_per_minute": 12, "max_group_size": 1},
+    "duplicates": {"duplicate_ratio": 0.5},
+    "slow_llm": {"llm_latency": 2.0},
+    "long_posts": {"long_post_ratio": 0.5, "long_post_words": 3000},
+    "failures": {"llm_failure_rate": 0.1, "reddit_failure_rate": 0.1},
+}
+
+WORDS = ("python error loop function pandas install help beginner saas startup pricing launch customers "
+         "question code list dict class async api deploy docker test bug").split()
+
+
+class FakeLLMServer:
+    """
+    Chat-completions stub on a local port, answering every request after `latency` seconds.
+
+    Batch requests get one entry per 'Reddit Post ID' of the prompt. A share of requests,
+    failure_rate, is answered with a 500 to exercise the client retries.
+    """
+    def __init__(self, port, latency=0.3, failure_rate=0.0):
+        self.port = port
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.requests = 0
+        self.failures = 0
+        self.models = {}
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", self.port)
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = json.loads(await reader.readexactly(int(headers.get("content-length", 0))))
+                status, payload = await self._complete(body)
+                data = json.dumps(payload).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode("latin-1") + data
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _complete(self, body):
+        self.requests += 1
+        self.models[body["model"]] = self.models.get(body["model"], 0) + 1
+        await asyncio.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            self.failures += 1
+            return "500 Internal Server Error", {"error": {"message": "injected failure", "type": "server_error"}}
+
+        item = {
+            "title": "", "subreddit": "", "category": "",
+            "topics_discussed": random.sample(WORDS, 2), "questions_requests": [],
+            "keywords": random.sample(WORDS, 3), "sentiment": ["looking_for_help"],
+            "actions_next_steps": [], "summary": "Benchmark summary.", "suggested_responses": ["Benchmark reply."],
+        }
+        schema = body["response_format"]["json_schema"]["schema"]
+        text = "\n".join(message["content"] for message in body["messages"])
+        if "posts" in schema.get("properties", {}):
+            content = {"posts": [dict(item, reddit_post_id=reddit_post_id)
+                                 for reddit_post_id in re.findall(r"Reddit Post ID: (\S+)", text)]}
+        else:
+            content = item
+        prompt_tokens = len(text) // 4
+        return "200 OK", {
+            "id": f"chatcmpl-{self.requests}", "object": "chat.completion", "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": json.dumps(content)}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 60 * max(1, text.count("Reddit Post ID")),
+                      "total_tokens": prompt_tokens + 60},
+        }
+
+
+class FakeSubreddit:
+    def __init__(self, reddit, name):
+        self.reddit = reddit
+        self.display_name = name
+
+    async def new(self, limit=100, **kwargs):
+        self.reddit.requests += 1
+        await asyncio.sleep(self.reddit.latency)
+        if random.random() < self.reddit.failure_rate:
+            self.reddit.failures += 1
+            raise ServerError(types.SimpleNamespace(status=503, headers={}))
+        # r/a+b+c merges the listings of its subreddits
+        posts = sorted(
+            (post for name in self.display_name.split("+") for post in self.reddit.listings.get(name, [])),
+            key=lambda post: post.created_utc
+        )
+        for post in reversed(posts[-limit:] if limit else posts):
+            yield post
+
+
+class FakeReddit:
+    """
+    asyncpraw-like client serving synthetic 'new' listings that fill up while the benchmark runs.
+
+    Attributes:
+    ----------
+    listings : dict
+        Posts of every subreddit, oldest first.
+    arrivals : dict
+        perf_counter() time each post was published at, keyed by post id.
+    """
+    def __init__(self, subreddits, posts_per_minute, duplicate_ratio=0.0, long_post_ratio=0.0,
+                 latency=0.05, failure_rate=0.0, long_post_words=400):
+        self.subreddits = subreddits
+        self.posts_per_minute = posts_per_minute
+        self.duplicate_ratio = duplicate_ratio
+        self.long_post_ratio = long_post_ratio
+        self.long_post_words = long_post_words
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failures = 0
+        self.requests = 0
+        self.listings = {name: [] for name in subreddits}
+        self.arrivals = {}
+        self.auth = types.SimpleNamespace(limits={"remaining": None, "used": None})
+        self._counter = 0
+        self._published = []
+
+    async def subreddit(self, name):
+        return FakeSubreddit(self, name)
+
+    def _make_post(self, subreddit_name):
+        self._counter += 1
+        if self._published and random.random() < self.duplicate_ratio:
+            # A repost: new id, same content as an earlier post
+            title, text = random.choice(self._published)
+        else:
+            words = self.long_post_words if random.random() < self.long_post_ratio else 40
+            title = " ".join(random.choices(WORDS, k=8)) + f" #{self._counter}?"
+            text = " ".join(random.choices(WORDS, k=words))
+            self._published.append((title, text))
+        author = types.SimpleNamespace(name=f"user{self._counter % 500}")
+        post = types.SimpleNamespace(
+            id=f"b{self._counter:x}", title=title, selftext=text, created_utc=time.time(),
+            author=author, author_fullname=f"t2_u{self._counter % 500}",
+            subreddit=types.SimpleNamespace(display_name=subreddit_name),
+        )
+        post.name = f"t3_{post.id}"
+        return post
+
+    async def publish(self, duration):
+        """
+        Publishes posts at the scenario rate for duration seconds and returns how many were published.
+        """
+        interval = 60 / (self.posts_per_minute * len(self.subreddits))
+        deadline = time.perf_counter() + duration
+        published = 0
+        while time.perf_counter() < deadline:
+            name = random.choice(self.subreddits)
+            post = self._make_post(name)
+            self.listings[name].append(post)
+            self.arrivals[post.id] = time.perf_counter()
+            published += 1
+            await asyncio.sleep(random.expovariate(1 / interval))
+        return published
+
+
+class StubBot:
+    def __init__(self, token, latency):
+        self.token = token
+        self.latency = latency
+        self.messages = 0
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        await asyncio.sleep(self.latency)
+        self.messages += 1
+
+
+class StubRegistry(BotRegistry):
+    """
+    Routes the benchmark category to a StubBot instead of a real Telegram bot.
+    """
+    def __init__(self, latency):
+        super().__init__({BENCHMARK_CATEGORY: {"token": BENCHMARK_TOKEN, "chat_ids": ["1"]}})
+        self.bot = StubBot(BENCHMARK_TOKEN, latency)
+
+    def bot_for_token(self, token):
+        return self.bot
+
+    async def close(self):
+        pass
+
+
+class BenchmarkPipeline(Pipeline):
+    """
+    Pipeline that records when each post reached the deliver stage and when it got saved.
+
+    Writes go to mongomock, whose rollup upserts cost far more than a real MongoDB's, so the
+    time to deliver and the time to persist, writer batching included, are reported apart from
+    the end-to-end latency.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.delivered_at = {}
+        self.saved_at = {}
+
+    async def _deliver(self, item):
+        self.delivered_at.setdefault(item["reddit_post_id"], time.perf_counter())
+        await super()._deliver(item)
+
+    def _saved(self, reddit_post_ids):
+        now = time.perf_counter()
+        for reddit_post_id in reddit_post_ids:
+            self.saved_at.setdefault(reddit_post_id, now)
+        super()._saved(reddit_post_ids)
+
+
+async def run_scenario(name, overrides, duration=10.0, drain_timeout=60.0):
+    """
+    Runs one scenario and returns its results.
+
+    Returns:
+    -------
+    dict
+        Posts published and saved, posts/sec, p50/p99 end-to-end latency, p50/p99 latency from
+        publication to the alert being queued and from there to the post being saved, peak traced memory,
+        the number of LLM requests, injected failures and requests per model, and the prompt
+        tokens saved by truncation.
+    """
+    config = dict(DEFAULT_SCENARIO, **overrides)
+    mongoengine.disconnect_all()
+    import mongomock
+    mongoengine.connect(f"benchmark_{name}", host="mongodb://localhost", mongo_client_class=mongomock.MongoClient)
+
+    llm = FakeLLMServer(int(os.environ["BENCHMARK_LLM_PORT"]), config["llm_latency"], config["llm_failure_rate"])
+    await llm.start()
+    subreddits = [f"bench{i}" for i in range(config["subreddits"])]
+    reddit = FakeReddit(subreddits, config["posts_per_minute"], config["duplicate_ratio"],
+                        config["long_post_ratio"], config["reddit_latency"], config["reddit_failure_rate"],
+                        config["long_post_words"])
+    registry = StubRegistry(config["telegram_latency"])
+    scheduler = FetchPlanner(
+        PollScheduler(min_interval=config["poll_interval"], max_interval=config["poll_interval"],
+                      budget_per_minute=100000),
+        max_group_size=config["max_group_size"]
+    )
+    category_obj = {"category": BENCHMARK_CATEGORY, "subreddits": subreddits, "tele_addy": "1"}
+    for subreddit_name in subreddits:
+        scheduler.add(subreddit_name, category_obj)
+
+    tokens_saved_before = sum(REGISTRY.counters.get("llm_tokens_saved_total", {}).values())
+    tracemalloc.start()
+    pipeline = BenchmarkPipeline(
+        reddit, limit=100, scheduler=scheduler, writer=BulkPostWriter(max_age=1),
+        governor=RedditGovernor(reddit, requests_per_minute=60000, burst=1000, backoff_base=0.1),
+        dispatcher=TelegramDispatcher(registry=registry, messages_per_minute=60000, digest_window=0.1),
+        relevance=RelevanceFilter(threshold=config["relevance_threshold"]),
+        work_queue=WorkQueue(":memory:", backoff_base=0.5),
+    )
+    # The stage and cache prints would drown the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        await pipeline.load()
+        pipeline.start()
+
+        async def poll():
+            while True:
+                group_name, members = await scheduler.next_due()
+                await pipeline.submit_group(group_name, members)
+
+        poller = asyncio.create_task(poll())
+        started = time.perf_counter()
+        published = await reddit.publish(duration)
+        deadline = time.perf_counter() + drain_timeout
+        while len(pipeline.saved_at) < published and time.perf_counter() < deadline:
+            await asyncio.sleep(0.2)
+        elapsed = time.perf_counter() - started
+        poller.cancel()
+        await asyncio.gather(poller, return_exceptions=True)
+        await pipeline.stop()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    await llm.close()
+
+    buckets = tuple(x / 100 for x in range(1, 10)) + tuple(x / 10 for x in range(1, 10)) + tuple(range(1, 121))
+    latencies, deliver_latencies, persist_latencies = Histogram(buckets), Histogram(buckets), Histogram(buckets)
+    for reddit_post_id, saved_at in pipeline.saved_at.items():
+        if reddit_post_id in reddit.arrivals:
+            latencies.observe(saved_at - reddit.arrivals[reddit_post_id])
+        if reddit_post_id in pipeline.delivered_at:
+            persist_latencies.observe(saved_at - pipeline.delivered_at[reddit_post_id])
+    for reddit_post_id, delivered_at in pipeline.delivered_at.items():
+        if reddit_post_id in reddit.arrivals:
+            deliver_latencies.observe(delivered_at - reddit.arrivals[reddit_post_id])
+    return {
+        "scenario": name,
+        "published": published,
+        "saved": len(pipeline.saved_at),
+        "posts_per_sec": round(len(pipeline.saved_at) / elapsed, 2),
+        "p50_latency": round(latencies.quantile(0.5) or 0, 3),
+        "p99_latency": round(latencies.quantile(0.99) or 0, 3),
+        "p50_deliver_latency": round(deliver_latencies.quantile(0.5) or 0, 3),
+        "p99_deliver_latency": round(deliver_latencies.quantile(0.99) or 0, 3),
+        "p50_persist_latency": round(persist_latencies.quantile(0.5) or 0, 3),
+        "p99_persist_latency": round(persist_latencies.quantile(0.99) or 0, 3),
+        "peak_memory_mb": round(peak_memory / 2 ** 20, 2),
+        "llm_requests": llm.requests,
+        "llm_failures": llm.failures,
+        "llm_models": llm.models,
+        "llm_tokens_saved": sum(REGISTRY.counters.get("llm_tokens_saved_total", {}).values()) - tokens_saved_before,
+        "reddit_requests": reddit.requests,
+        "reddit_failures": reddit.failures,
+        "alerts": registry.bot.messages,
+    }
+
+
+async def main(names, duration, drain_timeout):
+    results = []
+    for name in names:
+        print(f"Running scenario {name} for {duration} seconds...")
+        results.append(await run_scenario(name, SCENARIOS[name], duration, drain_timeout))
+        print("  " + ", ".join(f"{key}={value}" for key, value in results[-1].items() if key != "scenario"))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmark of the aggregation pipeline.")
+    parser.add_argument("scenarios", nargs="*", help=f"Scenarios to run, among {', '.join(SCENARIOS)} (default is all).")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds posts are published for.")
+    parser.add_argument("--drain-timeout", type=float, default=60.0, help="Max seconds to wait for the backlog.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"Unknown scenarios {unknown}, use {list(SCENARIOS)}.")
+    random.seed(args.seed)
+    results = asyncio.run(main(args.scenarios or list(SCENARIOS), args.duration, args.drain_timeout))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,105 @@
+from dotenv import load_dotenv
+from telegram import Bot
+from telegram.request import HTTPXRequest
+import json
+import os
+
+load_dotenv()
+
+# JSON file mapping each category to the env var holding its bot token and, optionally, its chat ids:
+# {"Teaching Python": {"token_env": "TELEGRAM_BOT_PYTHON_GUIDANCE_API_KEY", "chat_ids": ["5871291837"]}}
+TELEGRAM_ROUTES_FILE = os.getenv("TELEGRAM_ROUTES_FILE", "telegram_routes.json")
+# Size of the HTTP connection pool shared by all bots
+TELEGRAM_CONNECTION_POOL_SIZE = int(os.getenv("TELEGRAM_CONNECTION_POOL_SIZE", "16"))
+
+# Used when there is no routes file, the categories we started with
+DEFAULT_ROUTES = {
+    "Teaching Python": {"token_env": "TELEGRAM_BOT_PYTHON_GUIDANCE_API_KEY"},
+    "SaaS Development": {"token_env": "TELEGRAM_BOT_SAAS_CREATION_API_KEY"},
+}
+
+
+def load_routes(path=TELEGRAM_ROUTES_FILE):
+    """
+    Reads the category routes from the JSON routes file, or returns DEFAULT_ROUTES if there is none.
+    """
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return DEFAULT_ROUTES
+
+
+class BotRegistry:
+    """
+    Maps categories to the Telegram bot and chats that receive their alerts.
+
+    Routes come from config, so new categories and channels need no code change. Bots are
+    created on first use and shared by every category routed to the same token, and all of
+    them send through a single pooled HTTP client.
+
+    Attributes:
+    ----------
+    routes : dict
+        category -> {'token': str, 'chat_ids': list}
+    """
+    def __init__(self, routes, pool_size=TELEGRAM_CONNECTION_POOL_SIZE):
+        self.routes = {}
+        for category, route in routes.items():
+            token = route.get("token") or os.getenv(route.get("token_env", ""))
+            if not token:
+                print(f"No Telegram bot token configured for category {category}, skipping it.")
+                continue
+            self.routes[category] = {"token": token, "chat_ids": [str(chat_id) for chat_id in route.get("chat_ids", [])]}
+        self.pool_size = pool_size
+        self._bots = {}
+        self._request = None
+
+    @classmethod
+    def from_config(cls, path=TELEGRAM_ROUTES_FILE):
+        return cls(load_routes(path))
+
+    def __contains__(self, category):
+        return category in self.routes
+
+    def bot_for_token(self, token):
+        """
+        Returns the shared Bot of a token, creating it on first use.
+        """
+        bot = self._bots.get(token)
+        if bot is None:
+            if self._request is None:
+                self._request = HTTPXRequest(connection_pool_size=self.pool_size)
+            bot = self._bots[token] = Bot(token=token, request=self._request, get_updates_request=self._request)
+        return bot
+
+    def resolve(self, category, default_chat_id=None):
+        """
+        Returns (bot, chat_ids) for a category, or (None, []) if it has no route.
+        The chat ids of the route win over default_chat_id.
+        """
+        route = self.routes.get(category)
+        if route is None:
+            return None, []
+        chat_ids = route["chat_ids"] or ([str(default_chat_id)] if default_chat_id is not None else [])
+        return self.bot_for_token(route["token"]), chat_ids
+
+    async def close(self):
+        """
+        Closes the shared HTTP client of all bots.
+        """
+        if self._request is not None:
+            await self._request.shutdown()
+            self._request = None
+        self._bots = {}
+
+
+_registry = None
+
+def get_registry():
+    """
+    Returns the process-wide registry loaded from config.
+    """
+    global _registry
+    if _registry is None:
+        _registry = BotRegistry.from_config()
+    return _registry
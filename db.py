@@ -1,212 +1,785 @@
-from dotenv import load_dotenv
-from mongoengine import DoesNotExist
-from mongoengine import Document, StringField, DateTimeField, ReferenceField, ListField, connect
-import os, datetime
-
-load_dotenv()
-
-MONGODB_PWD = os.getenv("MONGODB_PWD")
-MONGODB_USER = os.getenv("MONGODB_USER")
-MONGODB_CLUSTER_URL = os.getenv("MONGODB_CLUSTER_URL")
-MONGODB_DATABASE = os.getenv("MONGODB_DATABASE")
-
-connection_string = f"mongodb+srv://{MONGODB_USER}:{MONGODB_PWD}@{MONGODB_CLUSTER_URL}/?retryWrites=true&w=majority&appName=Cluster0"
-
-# connect to db
-def connect_to_db(): 
-    
-    # Connect to the database
-    try:
-        connect(MONGODB_DATABASE, host=connection_string)
-        print("Connected to the MongoDB Atlas database!")
-    except Exception as e:
-        print(f"Error connecting to MongoDB: {e}")
-
-# Define the ORM models (collections) for MongoDB using mongoengine
-
-class User(Document):
-    """
-    This class represents a Reddit user and will be stored in the 'users' collection.
-    
-    Attributes:
-    ----------
-    reddit_user_id : str
-        The unique Reddit user ID (e.g., 'u/example_user').
-    username : str
-        The Reddit username.
-    created_at : datetime
-        Timestamp for when the user was first encountered.
-    """
-    reddit_user_id = StringField(required=True, unique=True)
-    username = StringField(required=True)
-    created_at = DateTimeField(required=True)
-
-    meta = {'collection': 'users'}
-
-class Post(Document):
-    """
-    This class represents a Reddit post and will be stored in the 'posts' collection.
-
-    Attributes:
-    ----------
-    reddit_post_id : str
-        The unique Reddit post ID (e.g., 't3_abc123').
-    subreddit : str
-        The subreddit where the post was made.
-    time_scraped : datetime
-        Timestamp for when the data was scraped.
-    time_created : datetime
-        Timestamp for when the post was created.
-    title : str
-        Title of the Reddit post.
-    reddit_user_id : str
-        The Reddit user ID of the user who made the post.
-    sentiment : str
-        Sentiment label (e.g., 'positive', 'neutral', 'negative').
-    summary : str
-        A brief summary of the Reddit post.
-    action_type : str
-        The action type (e.g., 'promoting', 'asking for help', 'sharing a story').
-    category : str
-        Category of the subreddit.
-    filter_type : str
-        Filter type for internal categorization.
-    suggested_responses : list
-        A list of suggested responses generated by AI.
-
-    keywords : list
-        A list of keywords associated with the post (linked to the 'Keyword' collection).
-    topics : list
-        A list of topics associated with the post (linked to the 'Topic' collection).
-    """
-    reddit_post_id = StringField(required=True, unique=True)
-    subreddit = StringField(required=True)
-    time_scraped = DateTimeField(required=True)
-    time_created = DateTimeField(required=True)
-    title = StringField(required=True)
-    reddit_user_id = StringField(required=True)
-    sentiment = StringField()
-    summary = StringField()
-    action_type = StringField()
-    category = StringField()
-    filter_type = StringField()
-    suggested_responses = ListField(StringField())  # New field to store the AI-generated responses
-
-    # Many-to-One relationships with Keywords and Topics
-    keywords = ListField(ReferenceField('Keyword'))
-    topics = ListField(ReferenceField('Topic'))
-
-    meta = {'collection': 'posts'}
-
-
-class Topic(Document):
-    """
-    This class represents a topic associated with a Reddit post and is stored in the 'topics' collection.
-
-    Attributes:
-    ----------
-    post : Post
-        Reference to the post this topic is associated with.
-    topic : str
-        The extracted topic from the Reddit post.
-    created_at : datetime
-        Timestamp for when the topic was created.
-    """
-    post = ReferenceField(Post, reverse_delete_rule='CASCADE')
-    topic = StringField(required=True)
-    created_at = DateTimeField(required=True)
-
-    meta = {'collection': 'topics'}
-
-class Keyword(Document):
-    """
-    This class represents a keyword associated with a Reddit post and is stored in the 'keywords' collection.
-
-    Attributes:
-    ----------
-    post : Post
-        Reference to the post this keyword is associated with.
-    keyword : str
-        The extracted keyword from the Reddit post.
-    created_at : datetime
-        Timestamp for when the keyword was created.
-    """
-    post = ReferenceField(Post, reverse_delete_rule='CASCADE')
-    keyword = StringField(required=True)
-    created_at = DateTimeField(required=True)
-
-    meta = {'collection': 'keywords'}
-
-
-# Connect to the MongoDB database
-def connect_to_db():
-    try:
-        connect(MONGODB_DATABASE, host=connection_string)
-        print("Connected to the MongoDB Atlas database!")
-    except Exception as e:
-        print(f"Error connecting to MongoDB: {e}")
-
-def save_post_to_db(extracted_data, username):
-    """
-    Function to save the scraped post data to the MongoDB database.
-    This function checks if the user already exists and if the post is already saved,
-    then it saves the post, topics, and keywords.
-    """
-    # Check if user exists, otherwise create a new user
-    try:
-        user = User.objects.get(reddit_user_id=extracted_data['reddit_user_id'])
-    except DoesNotExist:
-        user = User(
-            reddit_user_id=extracted_data['reddit_user_id'],
-            username=username,  # Assumes you are using reddit_user_id as the username (you can modify this)
-            created_at=datetime.datetime.now()
-        )
-        user.save()
-
-
-    # Save the post
-    post = Post(
-        reddit_post_id=extracted_data['reddit_post_id'],  # You might have another ID for Reddit post, adjust if needed
-        subreddit=extracted_data['subreddit'],
-        time_scraped=extracted_data['time_scraped'],
-        time_created=extracted_data["time_created"],
-        title=extracted_data['title'],
-        reddit_user_id=extracted_data['reddit_user_id'],
-        sentiment=', '.join(extracted_data['sentiment']),
-        action_type=', '.join(extracted_data['actions_next_steps']),
-        keywords=[],  # Will add keywords separately
-        topics=[],  # Will add topics separately
-        category=extracted_data["category"],
-        filter_type=extracted_data["filter_type"],
-        suggested_responses=extracted_data["suggested_responses"],
-        summary=extracted_data["summary"]
-    )
-    post.save()
-
-    # Save associated topics
-    for topic in extracted_data['topics_discussed']:
-        topic_obj = Topic(
-            post=post,
-            topic=topic,
-            created_at=datetime.datetime.now()
-        )
-        topic_obj.save()
-        post.topics.append(topic_obj)
-
-    # Save associated keywords
-    for keyword in extracted_data['keywords']:
-        keyword_obj = Keyword(
-            post=post,
-            keyword=keyword,
-            created_at=datetime.datetime.now()
-        )
-        keyword_obj.save()
-        post.keywords.append(keyword_obj)
-
-    # Save the post again to update with references to topics and keywords
-    post.save()
-
-    
-if __name__ == "__main__":
-    connect_to_db()
-
+from dotenv import load_dotenv
+from mongoengine import DoesNotExist
+from mongoengine import Document, StringField, DateTimeField, FloatField, IntField, ReferenceField, ListField, connect
+from mongoengine import BooleanField
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, ConnectionFailure, PyMongoError
+from collections import Counter
+import metrics
+import os, datetime, threading, time
+
+load_dotenv()
+
+MONGODB_PWD = os.getenv("MONGODB_PWD")
+MONGODB_USER = os.getenv("MONGODB_USER")
+MONGODB_CLUSTER_URL = os.getenv("MONGODB_CLUSTER_URL")
+MONGODB_DATABASE = os.getenv("MONGODB_DATABASE")
+
+# A poll cycle's posts are written together once this many are waiting or the oldest waited this long
+POST_WRITER_BATCH_SIZE = int(os.getenv("POST_WRITER_BATCH_SIZE", "50"))
+POST_WRITER_MAX_AGE = float(os.getenv("POST_WRITER_MAX_AGE", "30"))
+
+# How topics and keywords are stored: 'referenced' writes Topic/Keyword documents only,
+# 'embedded' writes them as string arrays on the Post only, 'both' writes both
+TERMS_LAYOUT = os.getenv("TERMS_LAYOUT", "referenced")
+
+# Keep hourly and daily trend counters up to date as posts are written
+ROLLUPS_ENABLED = os.getenv("ROLLUPS_ENABLED", "true").lower() == "true"
+ROLLUP_GRANULARITIES = ("hour", "day")
+# Subreddit value of the counters summed over a whole category
+ALL_SUBREDDITS = "*"
+
+DUPLICATE_KEY_ERROR = 11000
+
+connection_string = f"mongodb+srv://{MONGODB_USER}:{MONGODB_PWD}@{MONGODB_CLUSTER_URL}/?retryWrites=true&w=majority&appName=Cluster0"
+
+# connect to db
+def connect_to_db(): 
+    
+    # Connect to the database
+    try:
+        connect(MONGODB_DATABASE, host=connection_string)
+        print("Connected to the MongoDB Atlas database!")
+    except Exception as e:
+        print(f"Error connecting to MongoDB: {e}")
+
+# Define the ORM models (collections) for MongoDB using mongoengine
+
+class User(Document):
+    """
+    This class represents a Reddit user and will be stored in the 'users' collection.
+    
+    Attributes:
+    ----------
+    reddit_user_id : str
+        The unique Reddit user ID (e.g., 'u/example_user').
+    username : str
+        The Reddit username.
+    created_at : datetime
+        Timestamp for when the user was first encountered.
+    """
+    reddit_user_id = StringField(required=True, unique=True)
+    username = StringField(required=True)
+    created_at = DateTimeField(required=True)
+
+    meta = {'collection': 'users', 'indexes': ['username']}
+
+class Post(Document):
+    """
+    This class represents a Reddit post and will be stored in the 'posts' collection.
+
+    Attributes:
+    ----------
+    reddit_post_id : str
+        The unique Reddit post ID (e.g., 't3_abc123').
+    subreddit : str
+        The subreddit where the post was made.
+    time_scraped : datetime
+        Timestamp for when the data was scraped.
+    time_created : datetime
+        Timestamp for when the post was created.
+    title : str
+        Title of the Reddit post.
+    reddit_user_id : str
+        The Reddit user ID of the user who made the post.
+    sentiment : str
+        Sentiment label (e.g., 'positive', 'neutral', 'negative').
+    summary : str
+        A brief summary of the Reddit post.
+    action_type : str
+        The action type (e.g., 'promoting', 'asking for help', 'sharing a story').
+    category : str
+        Category of the subreddit.
+    filter_type : str
+        Filter type for internal categorization.
+    suggested_responses : list
+        A list of suggested responses generated by AI.
+
+    keywords : list
+        A list of keywords associated with the post (linked to the 'Keyword' collection).
+    topics : list
+        A list of topics associated with the post (linked to the 'Topic' collection).
+    keyword_terms : list
+        The keywords as plain strings, filled when TERMS_LAYOUT embeds them.
+    topic_terms : list
+        The topics as plain strings, filled when TERMS_LAYOUT embeds them.
+    cluster_id : str
+        reddit_post_id of the first post of its near-duplicate cluster, see EmbeddingIndex.
+    saved_at : datetime
+        UTC time the post was written at, stamped by write_posts. Incremental exports follow it.
+    search_terms : list
+        The topics and keywords stripped and lowercased, whatever TERMS_LAYOUT, for case-insensitive lookups.
+    rolled_up : bool
+        Set once the post's terms were added to the trend rollups, so a replayed write never counts them twice.
+    """
+    reddit_post_id = StringField(required=True, unique=True)
+    subreddit = StringField(required=True)
+    time_scraped = DateTimeField(required=True)
+    time_created = DateTimeField(required=True)
+    title = StringField(required=True)
+    reddit_user_id = StringField(required=True)
+    sentiment = StringField()
+    summary = StringField()
+    action_type = StringField()
+    category = StringField()
+    filter_type = StringField()
+    suggested_responses = ListField(StringField())  # New field to store the AI-generated responses
+
+    # Many-to-One relationships with Keywords and Topics
+    keywords = ListField(ReferenceField('Keyword'))
+    topics = ListField(ReferenceField('Topic'))
+
+    # Denormalized copies of the terms, indexed as multikey arrays for analytics queries
+    keyword_terms = ListField(StringField())
+    topic_terms = ListField(StringField())
+
+    cluster_id = StringField()
+    saved_at = DateTimeField()
+    search_terms = ListField(StringField())
+    rolled_up = BooleanField()
+
+    meta = {
+        'collection': 'posts',
+        'indexes': [
+            ('category', '-time_created'),
+            ('subreddit', '-time_created'),
+            ('keyword_terms', '-time_created'),
+            ('topic_terms', '-time_created'),
+            ('category', 'keyword_terms', '-time_created'),
+            {'fields': ['cluster_id', '-time_created'], 'sparse': True},
+            ('saved_at', 'id'),
+            ('search_terms', '-time_created'),
+        ]
+    }
+
+
+class Topic(Document):
+    """
+    This class represents a topic associated with a Reddit post and is stored in the 'topics' collection.
+
+    Attributes:
+    ----------
+    post : Post
+        Reference to the post this topic is associated with.
+    topic : str
+        The extracted topic from the Reddit post.
+    created_at : datetime
+        Timestamp for when the topic was created.
+    """
+    post = ReferenceField(Post, reverse_delete_rule='CASCADE')
+    topic = StringField(required=True)
+    created_at = DateTimeField(required=True)
+
+    meta = {
+        'collection': 'topics',
+        'indexes': [
+            ('topic', '-created_at'),
+            ('post', 'topic'),
+        ]
+    }
+
+class Keyword(Document):
+    """
+    This class represents a keyword associated with a Reddit post and is stored in the 'keywords' collection.
+
+    Attributes:
+    ----------
+    post : Post
+        Reference to the post this keyword is associated with.
+    keyword : str
+        The extracted keyword from the Reddit post.
+    created_at : datetime
+        Timestamp for when the keyword was created.
+    """
+    post = ReferenceField(Post, reverse_delete_rule='CASCADE')
+    keyword = StringField(required=True)
+    created_at = DateTimeField(required=True)
+
+    meta = {
+        'collection': 'keywords',
+        'indexes': [
+            ('keyword', '-created_at'),
+            ('post', 'keyword'),
+        ]
+    }
+
+class SubredditCursor(Document):
+    """
+    This class represents the high-water mark of a subreddit's 'new' listing and is stored in the 'subreddit_cursors' collection.
+
+    Attributes:
+    ----------
+    subreddit : str
+        The lowercased subreddit name.
+    newest_fullname : str
+        Fullname of the newest post seen (e.g., 't3_abc123').
+    newest_created_utc : float
+        Creation time of the newest post seen, as a UTC timestamp.
+    read_through_utc : float
+        Creation time of the newest post of the last listing read down to this subreddit's mark. The
+        subreddit is caught up to it even without a post of its own, e.g. a quiet member of a combined listing.
+    read_through_fullname : str
+        Fullname of that post, it orders the posts created in the same second.
+    updated_at : datetime
+        Timestamp for when the cursor last moved.
+    """
+    subreddit = StringField(required=True, unique=True)
+    # Unset while the subreddit was only read through, before any post of its own was seen
+    newest_fullname = StringField()
+    newest_created_utc = FloatField()
+    read_through_utc = FloatField()
+    read_through_fullname = StringField()
+    updated_at = DateTimeField(required=True)
+
+    meta = {'collection': 'subreddit_cursors'}
+
+
+class WorkerLease(Document):
+    """
+    This class represents a live aggregator worker and is stored in the 'worker_leases' collection.
+    A worker whose heartbeat is older than the lease TTL is considered dead.
+
+    Attributes:
+    ----------
+    worker_id : str
+        Unique identifier of the worker.
+    host : str
+        Host the worker runs on.
+    pid : int
+        Process ID of the worker.
+    started_at : datetime
+        Timestamp for when the worker joined.
+    heartbeat_at : datetime
+        Timestamp of the worker's latest heartbeat.
+    """
+    worker_id = StringField(required=True, unique=True)
+    host = StringField()
+    pid = IntField()
+    started_at = DateTimeField(required=True)
+    heartbeat_at = DateTimeField(required=True)
+
+    meta = {'collection': 'worker_leases', 'indexes': ['heartbeat_at']}
+
+
+class SubredditLease(Document):
+    """
+    This class represents a worker's ownership of a subreddit and is stored in the 'subreddit_leases' collection.
+    Only the owner of an unexpired lease polls the subreddit.
+
+    Attributes:
+    ----------
+    subreddit : str
+        The lowercased subreddit name.
+    owner : str
+        worker_id of the worker polling the subreddit.
+    expires_at : datetime
+        Timestamp after which another worker may take the subreddit over.
+    """
+    subreddit = StringField(required=True, unique=True)
+    owner = StringField(required=True)
+    expires_at = DateTimeField(required=True)
+
+    meta = {'collection': 'subreddit_leases', 'indexes': ['owner']}
+
+
+class TermRollup(Document):
+    """
+    This class represents a pre-aggregated trend counter and is stored in the 'term_rollups' collection.
+    There is one document per (granularity, bucket, kind, category, subreddit, term).
+
+    Attributes:
+    ----------
+    granularity : str
+        Size of the time bucket, 'hour' or 'day'.
+    bucket : datetime
+        Start of the time bucket, based on the posts' creation time.
+    kind : str
+        What is counted: 'keyword', 'topic' or 'sentiment'.
+    category : str
+        Category of the subreddit.
+    subreddit : str
+        The subreddit, or '*' for the whole category.
+    term : str
+        The lowercased term.
+    count : int
+        Number of posts in the bucket mentioning the term.
+    """
+    granularity = StringField(required=True)
+    bucket = DateTimeField(required=True)
+    kind = StringField(required=True)
+    category = StringField(required=True)
+    subreddit = StringField(required=True)
+    term = StringField(required=True)
+    count = IntField(default=0)
+
+    meta = {
+        'collection': 'term_rollups',
+        'indexes': [
+            {'fields': ('granularity', 'kind', 'category', 'subreddit', 'bucket', 'term'), 'unique': True},
+        ]
+    }
+
+# Connect to the MongoDB database
+def connect_to_db():
+    try:
+        connect(MONGODB_DATABASE, host=connection_string)
+        print("Connected to the MongoDB Atlas database!")
+    except Exception as e:
+        print(f"Error connecting to MongoDB: {e}")
+
+def ensure_indexes():
+    """
+    Creates the indexes declared in the models' meta. Safe to call at every startup,
+    existing indexes are left alone.
+    """
+    for document in (User, Post, Topic, Keyword, SubredditCursor, WorkerLease, SubredditLease, TermRollup):
+        document.ensure_indexes()
+    print("Database indexes are in place.")
+
+def migrate_embedded_terms(batch_size=1000):
+    """
+    Copies the existing Topic and Keyword documents into the topic_terms and keyword_terms arrays of their posts,
+    and adds them to their search_terms. Posts written with the embedded arrays before search_terms existed get
+    theirs from their own arrays. Can be run again at any time, the arrays are recomputed from the collections.
+    """
+    posts = Post._get_collection()
+    for document, term_field, array_field in ((Topic, "topic", "topic_terms"), (Keyword, "keyword", "keyword_terms")):
+        groups = document._get_collection().aggregate(
+            [{"$group": {"_id": "$post", "terms": {"$addToSet": f"${term_field}"}}}],
+            allowDiskUse=True
+        )
+        ops, updated = [], 0
+        for group in groups:
+            ops.append(UpdateOne({"_id": group["_id"]}, {
+                "$set": {array_field: sorted(group["terms"])},
+                "$addToSet": {"search_terms": {"$each": search_terms(group["terms"])}},
+            }))
+            if len(ops) >= batch_size:
+                updated += posts.bulk_write(ops, ordered=False).modified_count
+                ops = []
+        if ops:
+            updated += posts.bulk_write(ops, ordered=False).modified_count
+        print(f"Migrated {array_field} of {updated} posts.")
+
+    ops, updated = [], 0
+    for post in posts.find({"search_terms": None}, {"topic_terms": 1, "keyword_terms": 1}):
+        terms = search_terms(post.get("topic_terms", []) + post.get("keyword_terms", []))
+        ops.append(UpdateOne({"_id": post["_id"]}, {"$set": {"search_terms": terms}}))
+        if len(ops) >= batch_size:
+            updated += posts.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        updated += posts.bulk_write(ops, ordered=False).modified_count
+    print(f"Set search_terms of {updated} posts from their own terms.")
+
+def backfill_saved_at(batch_size=1000):
+    """
+    Sets saved_at on the posts written before it existed, from the creation time of their _id,
+    so they sort in the same order as by _id. Can be run again at any time.
+    """
+    posts = Post._get_collection()
+    ops, updated = [], 0
+    for post in posts.find({"saved_at": None}, {"_id": 1}):
+        ops.append(UpdateOne({"_id": post["_id"]}, {"$set": {"saved_at": post["_id"].generation_time}}))
+        if len(ops) >= batch_size:
+            updated += posts.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        updated += posts.bulk_write(ops, ordered=False).modified_count
+    print(f"Set saved_at of {updated} posts.")
+
+def load_subreddit_cursors():
+    """
+    Returns the stored cursors as a dict of subreddit -> (newest_fullname, newest_created_utc).
+    """
+    return {
+        cursor.subreddit: (cursor.newest_fullname, cursor.newest_created_utc)
+        for cursor in SubredditCursor.objects(newest_fullname__exists=True)
+    }
+
+def load_read_through():
+    """
+    Returns the stored read-through marks as a dict of subreddit -> (read_through_utc, read_through_fullname).
+    """
+    return {
+        cursor.subreddit: (cursor.read_through_utc, cursor.read_through_fullname)
+        for cursor in SubredditCursor.objects(read_through_utc__exists=True)
+    }
+
+def save_read_through(read_through):
+    """
+    Stores a dict of subreddit -> (read_through_utc, read_through_fullname) with one bulk write,
+    creating the cursors if needed.
+    """
+    now = datetime.datetime.now()
+    SubredditCursor._get_collection().bulk_write([
+        UpdateOne({"subreddit": subreddit}, {"$set": {
+            "read_through_utc": created_utc, "read_through_fullname": fullname, "updated_at": now
+        }}, upsert=True)
+        for subreddit, (created_utc, fullname) in read_through.items()
+    ], ordered=False)
+
+def save_subreddit_cursor(subreddit, newest_fullname, newest_created_utc):
+    """
+    Moves the cursor of a subreddit forward, creating it if needed.
+    """
+    SubredditCursor.objects(subreddit=subreddit).update_one(
+        set__newest_fullname=newest_fullname,
+        set__newest_created_utc=newest_created_utc,
+        set__updated_at=datetime.datetime.now(),
+        upsert=True
+    )
+
+def subreddit_activity(since):
+    """
+    Returns the number of posts saved per lowercased subreddit since a datetime, e.g. to plan fetches.
+    Matched on the _id index, which is the time the posts were fetched, so no collection scan is needed.
+    """
+    pipeline = [
+        {"$match": {"_id": {"$gte": ObjectId.from_datetime(since)}}},
+        {"$group": {"_id": {"$toLower": "$subreddit"}, "count": {"$sum": 1}}},
+    ]
+    return {doc["_id"]: doc["count"] for doc in Post._get_collection().aggregate(pipeline)}
+
+def load_post_terms(posts):
+    """
+    Returns the topics and keywords of raw post documents as {post _id: {'topic': [...], 'keyword': [...]}},
+    from their embedded arrays or, with the referenced layout, with one query per collection for all of them.
+    """
+    if TERMS_LAYOUT != "referenced":
+        return {post["_id"]: {"topic": post.get("topic_terms", []), "keyword": post.get("keyword_terms", [])}
+                for post in posts}
+    ids = [post["_id"] for post in posts]
+    terms = {post_id: {"topic": [], "keyword": []} for post_id in ids}
+    for topic in Topic._get_collection().find({"post": {"$in": ids}}, {"post": 1, "topic": 1}):
+        terms[topic["post"]]["topic"].append(topic["topic"])
+    for keyword in Keyword._get_collection().find({"post": {"$in": ids}}, {"post": 1, "keyword": 1}):
+        terms[keyword["post"]]["keyword"].append(keyword["keyword"])
+    return terms
+
+def search_terms(terms):
+    """
+    Normalizes topics and keywords for case-insensitive lookups: stripped, lowercased, deduplicated and sorted.
+    """
+    return sorted({term.strip().lower() for term in terms if term.strip()})
+
+def build_post_documents(extracted_data, username, now=None, post_id=None):
+    """
+    Builds the user upsert and the post, topic and keyword documents of one extracted post.
+
+    ObjectIds are assigned up front so the post can reference its topics and keywords
+    before any of them is written, which saves a second write of the post. Passing the
+    same post_id on every attempt makes a retried post count as a replay, not a duplicate.
+
+    Returns:
+    -------
+    dict
+        The user UpdateOne under 'user', the raw documents under 'post', 'topics' and 'keywords'.
+    """
+    now = now or datetime.datetime.now()
+
+    post = Post(
+        id=ObjectId(post_id) if post_id else ObjectId(),
+        reddit_post_id=extracted_data['reddit_post_id'],
+        subreddit=extracted_data['subreddit'],
+        time_scraped=extracted_data['time_scraped'],
+        time_created=extracted_data["time_created"],
+        title=extracted_data['title'],
+        reddit_user_id=extracted_data['reddit_user_id'],
+        sentiment=', '.join(extracted_data['sentiment']),
+        action_type=', '.join(extracted_data['actions_next_steps']),
+        category=extracted_data["category"],
+        filter_type=extracted_data["filter_type"],
+        suggested_responses=extracted_data["suggested_responses"],
+        summary=extracted_data["summary"],
+        cluster_id=extracted_data.get("cluster_id")
+    )
+    if TERMS_LAYOUT != "embedded":
+        post.topics = [
+            Topic(id=ObjectId(), post=post, topic=topic, created_at=now)
+            for topic in extracted_data['topics_discussed']
+        ]
+        post.keywords = [
+            Keyword(id=ObjectId(), post=post, keyword=keyword, created_at=now)
+            for keyword in extracted_data['keywords']
+        ]
+    if TERMS_LAYOUT != "referenced":
+        post.topic_terms = list(extracted_data['topics_discussed'])
+        post.keyword_terms = list(extracted_data['keywords'])
+    post.search_terms = search_terms(extracted_data['topics_discussed'] + extracted_data['keywords'])
+    # Terms counted by the trend rollups, whatever the layout
+    terms = {
+        "topic": extracted_data['topics_discussed'],
+        "keyword": extracted_data['keywords'],
+        "sentiment": extracted_data['sentiment'],
+    }
+    for document in [post] + post.topics + post.keywords:
+        document.validate()
+
+    return {
+        # Only set the user fields on insert, an existing user is left untouched
+        "user": UpdateOne(
+            {"reddit_user_id": extracted_data['reddit_user_id']},
+            {"$setOnInsert": {"username": username, "created_at": now}},
+            upsert=True
+        ),
+        "post": post.to_mongo().to_dict(),
+        "topics": [topic.to_mongo().to_dict() for topic in post.topics],
+        "keywords": [keyword.to_mongo().to_dict() for keyword in post.keywords],
+        "terms": terms,
+    }
+
+def truncate_to_bucket(moment, granularity):
+    """
+    Returns the start of the hour or day containing moment.
+    """
+    if granularity == "hour":
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def build_rollup_ops(batch):
+    """
+    Builds the $inc upserts that add a batch of posts to the hourly and daily trend counters.
+    Each term is counted once per post, for its subreddit and for its whole category.
+    """
+    counts = Counter()
+    for documents in batch:
+        post = documents["post"]
+        time_created = post["time_created"]
+        for kind, terms in documents["terms"].items():
+            for term in {term.strip().lower() for term in terms if term.strip()}:
+                for granularity in ROLLUP_GRANULARITIES:
+                    bucket = truncate_to_bucket(time_created, granularity)
+                    for subreddit in (post["subreddit"], ALL_SUBREDDITS):
+                        counts[(granularity, bucket, kind, post.get("category") or "", subreddit, term)] += 1
+
+    return [
+        UpdateOne(
+            {"granularity": granularity, "kind": kind, "category": category,
+             "subreddit": subreddit, "bucket": bucket, "term": term},
+            {"$inc": {"count": count}},
+            upsert=True
+        )
+        for (granularity, bucket, kind, category, subreddit, term), count in counts.items()
+    ]
+
+def _term_upsert(document, term_field):
+    # Keyed on (post, term) so replaying a batch never duplicates a topic or keyword
+    return UpdateOne(
+        {"post": document["post"], term_field: document[term_field]},
+        {"$setOnInsert": {"_id": document["_id"], "created_at": document["created_at"]}},
+        upsert=True
+    )
+
+def write_posts(batch):
+    """
+    Writes a batch of posts built by build_post_documents with one bulk request per collection.
+
+    Users, topics and keywords are unordered upserts and posts are inserted with an unordered
+    insert_many, so a whole batch costs four round trips instead of 2 + T + K + 2 per post.
+    Posts that were already saved by an earlier write are skipped with their topics and keywords,
+    while a replay of the same batch completes whatever a failed attempt left out. Trend counters
+    follow the rolled_up flag of each post, set right after its $inc, rather than whether the post
+    was inserted by this attempt: an attempt that failed before its rollups leaves them to the replay.
+
+    Parameters:
+    ----------
+    batch : list
+        Documents returned by build_post_documents.
+
+    Returns:
+    -------
+    list
+        The reddit_post_id of every post in the batch, including the skipped duplicates.
+    """
+    if not batch:
+        return []
+
+    started = time.perf_counter()
+    user_ops = {}
+    for documents in batch:
+        user_ops.setdefault(documents["post"]["reddit_user_id"], documents["user"])
+    User._get_collection().bulk_write(list(user_ops.values()), ordered=False)
+
+    posts = [documents["post"] for documents in batch]
+    # Stamped at every attempt, a post stored by an earlier one keeps the time it was actually written at
+    saved_at = datetime.datetime.now(datetime.timezone.utc)
+    for post in posts:
+        post["saved_at"] = saved_at
+    skipped, duplicates, counted = set(), {}, set()
+    try:
+        Post._get_collection().insert_many(posts, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(error["code"] != DUPLICATE_KEY_ERROR for error in errors):
+            raise
+        duplicates = {posts[error["index"]]["reddit_post_id"]: error["index"] for error in errors}
+        stored = Post._get_collection().find(
+            {"reddit_post_id": {"$in": list(duplicates)}}, {"reddit_post_id": 1, "rolled_up": 1}
+        )
+        for doc in stored:
+            index = duplicates[doc["reddit_post_id"]]
+            # A post stored under our own _id comes from a replayed batch, its terms still need writing
+            if doc["_id"] != posts[index]["_id"]:
+                skipped.add(index)
+            elif doc.get("rolled_up"):
+                counted.add(index)
+
+    kept = [documents for i, documents in enumerate(batch) if i not in skipped]
+    inserted = [documents for documents in kept if documents["post"]["reddit_post_id"] not in duplicates]
+    topic_ops = [_term_upsert(topic, "topic") for documents in kept for topic in documents["topics"]]
+    if topic_ops:
+        Topic._get_collection().bulk_write(topic_ops, ordered=False)
+    keyword_ops = [_term_upsert(keyword, "keyword") for documents in kept for keyword in documents["keywords"]]
+    if keyword_ops:
+        Keyword._get_collection().bulk_write(keyword_ops, ordered=False)
+
+    uncounted = [documents for i, documents in enumerate(batch) if i not in skipped and i not in counted]
+    rollup_ops = build_rollup_ops(uncounted) if ROLLUPS_ENABLED else []
+    if rollup_ops:
+        TermRollup._get_collection().bulk_write(rollup_ops, ordered=False)
+        Post._get_collection().update_many(
+            {"_id": {"$in": [documents["post"]["_id"] for documents in uncounted]}}, {"$set": {"rolled_up": True}}
+        )
+
+    metrics.observe("db_write_seconds", time.perf_counter() - started)
+    metrics.inc("db_posts_written_total", len(inserted))
+    metrics.inc("db_duplicates_skipped_total", len(skipped))
+
+    return [post["reddit_post_id"] for post in posts]
+
+def save_post_to_db(extracted_data, username):
+    """
+    Function to save the scraped post data to the MongoDB database.
+    This function creates the user if it doesn't exist yet, then saves the post, topics, and keywords.
+    """
+    write_posts([build_post_documents(extracted_data, username)])
+
+
+def is_transient_error(error):
+    """
+    Returns True for connection and timeout errors, after which the same write may well succeed.
+    """
+    return isinstance(error, ConnectionFailure) or (isinstance(error, PyMongoError) and error.timeout)
+
+class BulkPostWriter:
+    """
+    Collects the posts of a poll cycle and writes them in bulk with write_posts.
+
+    A flush happens when batch_size posts are waiting or when the oldest waiting post is
+    older than max_age seconds. The writer is thread-safe so it can be used from worker threads.
+
+    A batch that fails on a connection or timeout error is kept whole for the next flush.
+    Any other error is blamed on its posts: the batch is split in halves down to single
+    posts, and the posts that still fail alone are set aside for take_rejected(), so one bad
+    post never holds back the rest of its batch.
+
+    Attributes:
+    ----------
+    batch_size : int
+        Number of waiting posts that triggers a flush.
+    max_age : float
+        Seconds the oldest waiting post may wait before a flush.
+    """
+    def __init__(self, batch_size=POST_WRITER_BATCH_SIZE, max_age=POST_WRITER_MAX_AGE):
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self._entries = []
+        self._oldest = None
+        self._rejected = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, extracted_data, username, post_id=None):
+        """
+        Queues a post and flushes if the batch is full or too old.
+        Once queued the post is kept until a flush writes or rejects it, so a failed flush is only printed.
+
+        Returns:
+        -------
+        list
+            The reddit_post_ids written by the flush, empty if no flush happened.
+        """
+        documents = build_post_documents(extracted_data, username, post_id=post_id)
+        with self._lock:
+            if not self._entries:
+                self._oldest = time.monotonic()
+            self._entries.append(documents)
+        try:
+            return self.flush_if_due()
+        except Exception as e:
+            print(f"Error writing posts, {len(self)} posts kept for the next flush: {e}")
+            return []
+
+    def flush_if_due(self):
+        """
+        Flushes only if the size or age limit was reached.
+        """
+        with self._lock:
+            due = len(self._entries) >= self.batch_size or (
+                self._entries and time.monotonic() - self._oldest >= self.max_age
+            )
+        return self.flush() if due else []
+
+    def _write_apart(self, entries, written):
+        # Halves a failing batch until the posts that can't be written are isolated
+        try:
+            written.extend(write_posts(entries))
+        except Exception as e:
+            if is_transient_error(e):
+                raise
+            if len(entries) == 1:
+                print(f"Post {entries[0]['post']['reddit_post_id']} can't be written, rejected: {e}")
+                metrics.inc("db_posts_rejected_total")
+                with self._lock:
+                    self._rejected.append((entries[0]["post"]["reddit_post_id"], e))
+                return
+            middle = len(entries) // 2
+            self._write_apart(entries[:middle], written)
+            self._write_apart(entries[middle:], written)
+
+    def flush(self):
+        """
+        Writes all waiting posts and returns their reddit_post_ids, rejected posts excluded.
+        """
+        with self._lock:
+            entries, self._entries = self._entries, []
+            self._oldest = None
+        written = []
+        try:
+            self._write_apart(entries, written)
+        except Exception as e:
+            # Put back what wasn't written so the next flush replays it with the same ObjectIds
+            done = set(written)
+            with self._lock:
+                self._entries = [documents for documents in entries
+                                 if documents["post"]["reddit_post_id"] not in done] + self._entries
+                self._oldest = time.monotonic()
+            if not written:
+                raise
+            print(f"Error writing posts, {len(self)} posts kept for the next flush: {e}")
+        return written
+
+    def take_rejected(self):
+        """
+        Returns the (reddit_post_id, error) of the posts rejected since the last call, and forgets them.
+        """
+        with self._lock:
+            rejected, self._rejected = self._rejected, []
+        return rejected
+
+
+if __name__ == "__main__":
+    import sys
+    connect_to_db()
+    ensure_indexes()
+
+    # python db.py migrate-terms | backfill-saved-at
+    if sys.argv[1:] == ["migrate-terms"]:
+        migrate_embedded_terms()
+    elif sys.argv[1:] == ["backfill-saved-at"]:
+        backfill_saved_at()
+
@@ -0,0 +1,341 @@
+from dotenv import load_dotenv
+import metrics
+import numpy as np
+import os
+from relevance_filter import hashed_features
+import sqlite3
+import threading
+import time
+
+load_dotenv()
+
+# Near-duplicate detection across subreddits, posts close enough to one already alerted skip the LLM and the alert
+EMBEDDING_INDEX_ENABLED = os.getenv("EMBEDDING_INDEX_ENABLED", "false").lower() == "true"
+# Files are PATH.vectors, PATH.scales and PATH.sqlite3, ':memory:' keeps the index in memory only
+EMBEDDING_INDEX_PATH = os.getenv("EMBEDDING_INDEX_PATH", "embeddings")
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "256"))
+# 'int8' takes a quarter of float32 with one scale per vector, 'float16' half of it
+EMBEDDING_DTYPE = os.getenv("EMBEDDING_DTYPE", "int8")
+# Cosine similarity from which a post joins the cluster of its nearest post, and from which it is a duplicate
+EMBEDDING_CLUSTER_THRESHOLD = float(os.getenv("EMBEDDING_CLUSTER_THRESHOLD", "0.75"))
+EMBEDDING_DUPLICATE_THRESHOLD = float(os.getenv("EMBEDDING_DUPLICATE_THRESHOLD", "0.9"))
+# A duplicate is only suppressed if its cluster was alerted within this many seconds
+EMBEDDING_SUPPRESS_WINDOW = float(os.getenv("EMBEDDING_SUPPRESS_WINDOW", str(24 * 3600)))
+# Vectors scored per matrix product, small enough for the converted chunk to stay in cache
+EMBEDDING_CHUNK_ROWS = int(os.getenv("EMBEDDING_CHUNK_ROWS", "16384"))
+EMBEDDING_INITIAL_CAPACITY = 4096
+
+
+def embed_texts(texts, dim=EMBEDDING_DIM):
+    """
+    Embeds texts as unit float32 rows of a (len(texts), dim) matrix, from their hashed unigrams and
+    bigrams. Needs no model or network, and texts sharing most of their words end up close.
+    """
+    vectors = np.zeros((len(texts), dim), dtype=np.float32)
+    for i, text in enumerate(texts):
+        for index, value in hashed_features(text, dim).items():
+            vectors[i, index] = value
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class EmbeddingIndex:
+    """
+    Compact vector index of the posts, used to cluster near-duplicates and find similar posts.
+
+    Vectors are stored quantized, as int8 with a float32 scale per row or as float16, in
+    memory-mapped files that grow by doubling, so millions of posts cost a few hundred MB of
+    page cache rather than Python objects. Searches score chunk_rows vectors per matrix product.
+    The reddit_post_id, category and cluster of every row live in a SQLite file next to them.
+    Only the reddit_post_ids are also kept in memory, in a list and a dict mapping them to their
+    rows, i.e. a string and two references per post.
+
+    A new post joins the cluster of its nearest post of the same category if their cosine
+    similarity reaches cluster_threshold, and starts its own cluster otherwise. A post at
+    duplicate_threshold or more from a cluster alerted in the last suppress_window seconds is
+    suppressed: the cluster's first alert already covers it. Clusters count as alerted once
+    mark_alerted() is called, i.e. once an alert of theirs actually went out.
+
+    The index is local to its files, so it only sees the posts of the process that fills it.
+
+    Attributes:
+    ----------
+    path : str
+        Prefix of the index files, ':memory:' keeps the index in memory only.
+    dim : int
+        Dimension of the vectors.
+    dtype : str
+        Storage type of the vectors, 'int8' or 'float16'.
+    cluster_threshold, duplicate_threshold : float
+        Cosine similarities from which a post joins a cluster, and is a duplicate.
+    suppress_window : float
+        Seconds after an alert during which the duplicates of its cluster are suppressed.
+    size : int
+        Number of indexed posts.
+    """
+    def __init__(self, path=EMBEDDING_INDEX_PATH, dim=EMBEDDING_DIM, dtype=EMBEDDING_DTYPE,
+                 cluster_threshold=EMBEDDING_CLUSTER_THRESHOLD, duplicate_threshold=EMBEDDING_DUPLICATE_THRESHOLD,
+                 suppress_window=EMBEDDING_SUPPRESS_WINDOW, chunk_rows=EMBEDDING_CHUNK_ROWS):
+        if dtype not in ("int8", "float16"):
+            raise ValueError("Invalid dtype. Use 'int8' or 'float16'.")
+        self.path = path
+        self.dim = dim
+        self.dtype = dtype
+        self.cluster_threshold = cluster_threshold
+        self.duplicate_threshold = duplicate_threshold
+        self.suppress_window = suppress_window
+        self.chunk_rows = chunk_rows
+        self._lock = threading.Lock()
+        self._in_memory = path == ":memory:"
+        self._conn = sqlite3.connect(path if self._in_memory else f"{path}.sqlite3", check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "row INTEGER PRIMARY KEY, reddit_post_id TEXT UNIQUE NOT NULL, category TEXT NOT NULL, "
+            "cluster_id TEXT NOT NULL, similarity REAL NOT NULL, suppressed INTEGER NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_cluster ON embeddings (cluster_id)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS clusters ("
+            "cluster_id TEXT PRIMARY KEY, size INTEGER NOT NULL, suppressed INTEGER NOT NULL DEFAULT 0, "
+            "last_alert_at REAL, created_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+        # Row -> post and category code, the only per-row state kept in Python
+        self._ids = [row[0] for row in self._conn.execute("SELECT reddit_post_id FROM embeddings ORDER BY row")]
+        self._rows = {reddit_post_id: row for row, reddit_post_id in enumerate(self._ids)}
+        self._category_codes = {}
+        codes = [self._category_code(category)
+                 for (category,) in self._conn.execute("SELECT category FROM embeddings ORDER BY row")]
+        self.size = len(self._ids)
+        self._capacity = 0
+        self._vectors = None
+        self._scales = None
+        self._categories = np.zeros(0, dtype=np.int32)
+        self._grow(max(EMBEDDING_INITIAL_CAPACITY, self.size))
+        self._categories[:self.size] = codes
+        metrics.register_gauge("embedding_index_posts", lambda: self.size)
+
+    def _category_code(self, category):
+        return self._category_codes.setdefault(category, len(self._category_codes))
+
+    def _grow(self, capacity):
+        # Doubling keeps the number of remaps logarithmic in the number of posts
+        capacity = max(capacity, 2 * self._capacity)
+        storage = np.int8 if self.dtype == "int8" else np.float16
+        if self._in_memory:
+            vectors = np.zeros((capacity, self.dim), dtype=storage)
+            scales = np.zeros(capacity, dtype=np.float32)
+            if self._vectors is not None:
+                vectors[:self._capacity] = self._vectors
+                scales[:self._capacity] = self._scales
+        else:
+            if self._vectors is not None:
+                self._vectors.flush()
+                self._scales.flush()
+            for suffix, itemsize, width in ((".vectors", np.dtype(storage).itemsize, self.dim), (".scales", 4, 1)):
+                with open(self.path + suffix, "ab") as f:
+                    if f.tell() < capacity * itemsize * width:
+                        f.truncate(capacity * itemsize * width)
+            vectors = np.memmap(self.path + ".vectors", dtype=storage, mode="r+", shape=(capacity, self.dim))
+            scales = np.memmap(self.path + ".scales", dtype=np.float32, mode="r+", shape=(capacity,))
+        categories = np.full(capacity, -1, dtype=np.int32)
+        categories[:len(self._categories)] = self._categories
+        self._vectors, self._scales, self._categories = vectors, scales, categories
+        self._capacity = capacity
+
+    def _store(self, row, vector):
+        if self.dtype == "int8":
+            scale = float(np.abs(vector).max()) / 127 or 1.0
+            self._vectors[row] = np.round(vector / scale).astype(np.int8)
+            self._scales[row] = scale
+        else:
+            self._vectors[row] = vector.astype(np.float16)
+            self._scales[row] = 1.0
+
+    def search(self, queries, k=10, category=None, exclude=()):
+        """
+        Finds the k nearest posts of every query vector by cosine similarity, in one pass over the index.
+
+        Parameters:
+        ----------
+        queries : numpy.ndarray
+            Unit vectors, one per row, as returned by embed_texts.
+        category : str
+            Only posts of this category are returned, None returns any category.
+        exclude : iterable
+            reddit_post_ids left out of the results.
+
+        Returns:
+        -------
+        list
+            One list of (reddit_post_id, similarity) per query, most similar first.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        size = self.size
+        code = self._category_codes.get(category) if category is not None else None
+        excluded = [self._rows[reddit_post_id] for reddit_post_id in exclude if reddit_post_id in self._rows]
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        if size == 0 or (category is not None and code is None):
+            return [[] for _ in range(len(queries))]
+
+        started = time.perf_counter()
+        for start in range(0, size, self.chunk_rows):
+            end = min(start + self.chunk_rows, size)
+            scores = (queries @ self._vectors[start:end].astype(np.float32).T) * self._scales[start:end]
+            if code is not None:
+                scores[:, self._categories[start:end] != code] = -np.inf
+            for row in excluded:
+                if start <= row < end:
+                    scores[:, row - start] = -np.inf
+            # Keep the k best of this chunk, then the k best of those and the previous ones
+            top = min(k, end - start)
+            chunk_rows = np.argpartition(-scores, top - 1, axis=1)[:, :top]
+            scores = np.concatenate([best_scores, np.take_along_axis(scores, chunk_rows, axis=1)], axis=1)
+            rows = np.concatenate([best_rows, chunk_rows + start], axis=1)
+            keep = np.argsort(-scores, axis=1)[:, :k]
+            best_scores = np.take_along_axis(scores, keep, axis=1)
+            best_rows = np.take_along_axis(rows, keep, axis=1)
+        metrics.observe("embedding_search_seconds", time.perf_counter() - started)
+
+        return [
+            # Quantization can put an exact duplicate a hair above 1
+            [(self._ids[row], min(float(score), 1.0)) for row, score in zip(rows, scores) if score > -np.inf]
+            for rows, scores in zip(best_rows, best_scores)
+        ]
+
+    def _nearest_since(self, vector, start, category):
+        # Scores the rows added after start, i.e. while a search was running without the lock
+        code = self._category_codes.get(category)
+        if start >= self.size or code is None:
+            return None
+        scores = (self._vectors[start:self.size].astype(np.float32) @ vector) * self._scales[start:self.size]
+        scores[self._categories[start:self.size] != code] = -np.inf
+        best = int(np.argmax(scores))
+        if scores[best] == -np.inf:
+            return None
+        return self._ids[start + best], min(float(scores[best]), 1.0)
+
+    def assign(self, reddit_post_id, text, category):
+        """
+        Indexes a post and attaches it to a cluster. Assigning the same post again returns its first assignment.
+
+        The index is scanned without holding the lock, which is only taken to score the few posts
+        added meanwhile and to store the new one, so concurrent assigns don't queue behind a scan.
+
+        Returns:
+        -------
+        dict
+            cluster_id, the reddit_post_id of the cluster's first post, similarity to the nearest
+            post, and suppressed, True if the post duplicates a recently alerted cluster.
+        """
+        vector = embed_texts([text], self.dim)[0]
+        searched = self.size
+        nearest = self.search(vector, k=1, category=category)[0]
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT cluster_id, similarity, suppressed FROM embeddings WHERE reddit_post_id = ?", (reddit_post_id,)
+            ).fetchone()
+            if row is not None:
+                return {"cluster_id": row[0], "similarity": row[1], "suppressed": bool(row[2])}
+
+            latest = self._nearest_since(vector, searched, category)
+            if latest is not None and (not nearest or latest[1] > nearest[0][1]):
+                nearest = [latest]
+            now = time.time()
+            cluster_id, suppressed = reddit_post_id, False
+            similarity = nearest[0][1] if nearest else 0.0
+            if similarity >= self.cluster_threshold:
+                cluster_id = self._conn.execute(
+                    "SELECT cluster_id FROM embeddings WHERE reddit_post_id = ?", (nearest[0][0],)
+                ).fetchone()[0]
+                last_alert_at = self._conn.execute(
+                    "SELECT last_alert_at FROM clusters WHERE cluster_id = ?", (cluster_id,)
+                ).fetchone()[0]
+                suppressed = (similarity >= self.duplicate_threshold and last_alert_at is not None
+                              and now - last_alert_at <= self.suppress_window)
+
+            if self.size == self._capacity:
+                self._grow(self._capacity * 2)
+            self._store(self.size, vector)
+            self._categories[self.size] = self._category_code(category)
+            self._conn.execute(
+                "INSERT INTO embeddings (row, reddit_post_id, category, cluster_id, similarity, suppressed, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.size, reddit_post_id, category, cluster_id, similarity, int(suppressed), now)
+            )
+            self._conn.execute(
+                "INSERT INTO clusters (cluster_id, size, suppressed, created_at) VALUES (?, 1, ?, ?) "
+                "ON CONFLICT (cluster_id) DO UPDATE SET size = size + 1, suppressed = suppressed + excluded.suppressed",
+                (cluster_id, int(suppressed), now)
+            )
+            self._conn.commit()
+            self._ids.append(reddit_post_id)
+            self._rows[reddit_post_id] = self.size
+            self.size += 1
+
+        result = "suppressed" if suppressed else "clustered" if cluster_id != reddit_post_id else "new_cluster"
+        metrics.inc("embedding_posts_total", result=result)
+        return {"cluster_id": cluster_id, "similarity": similarity, "suppressed": suppressed}
+
+    def mark_alerted(self, cluster_id):
+        """
+        Records that an alert of the cluster was sent, its duplicates are suppressed for suppress_window seconds.
+        """
+        with self._lock:
+            self._conn.execute("UPDATE clusters SET last_alert_at = ? WHERE cluster_id = ?", (time.time(), cluster_id))
+            self._conn.commit()
+
+    def similar(self, query, k=10, category=None):
+        """
+        Returns the k posts most similar to query, a reddit_post_id of the index or any text,
+        as (reddit_post_id, similarity) pairs.
+        """
+        if query in self._rows:
+            row = self._rows[query]
+            vector = self._vectors[row].astype(np.float32) * self._scales[row]
+            return self.search(vector / (np.linalg.norm(vector) or 1), k, category, exclude=(query,))[0]
+        return self.search(embed_texts([query], self.dim), k, category)[0]
+
+    def cluster(self, cluster_id):
+        """
+        Returns the reddit_post_ids of a cluster, oldest first.
+        """
+        return [row[0] for row in self._conn.execute(
+            "SELECT reddit_post_id FROM embeddings WHERE cluster_id = ? ORDER BY row", (cluster_id,)
+        )]
+
+    def stats(self):
+        """
+        Returns the number of posts, clusters, clustered and suppressed posts.
+        """
+        clusters, clustered, suppressed = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size - 1), 0), COALESCE(SUM(suppressed), 0) FROM clusters"
+        ).fetchone()
+        return {"posts": self.size, "clusters": clusters, "clustered": clustered, "suppressed": suppressed}
+
+    def close(self):
+        metrics.unregister_gauge("embedding_index_posts")
+        if not self._in_memory:
+            self._vectors.flush()
+            self._scales.flush()
+        self._conn.close()
+
+
+if __name__ == "__main__":
+    import sys
+
+    index = EmbeddingIndex()
+    # python embedding_index.py [stats | similar <reddit_post_id or text> [k] | cluster <cluster_id>]
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    if command == "similar" and len(sys.argv) > 2:
+        for reddit_post_id, similarity in index.similar(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 10):
+            print(f"{similarity:.3f}  {reddit_post_id}")
+    elif command == "cluster" and len(sys.argv) > 2:
+        print("\n".join(index.cluster(sys.argv[2])))
+    else:
+        print(index.stats())
+    index.close()
@@ -0,0 +1,183 @@
+from dotenv import load_dotenv
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+import unicodedata
+
+load_dotenv()
+
+EXTRACTION_CACHE_PATH = os.getenv("EXTRACTION_CACHE_PATH", "extraction_cache.sqlite3")
+EXTRACTION_CACHE_MAX_ENTRIES = int(os.getenv("EXTRACTION_CACHE_MAX_ENTRIES", "50000"))
+# Default is one week, reposts older than that get a fresh extraction
+EXTRACTION_CACHE_TTL = float(os.getenv("EXTRACTION_CACHE_TTL", str(7 * 24 * 3600)))
+# Hits only note their access time in memory, the times are written with the next put or once this many are pending
+EXTRACTION_CACHE_ACCESS_BATCH = int(os.getenv("EXTRACTION_CACHE_ACCESS_BATCH", "100"))
+
+
+def normalize_text(text):
+    """
+    Normalizes text so that reposts differing only in case, punctuation or whitespace hash the same.
+    """
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+def make_cache_key(title, content, category, prompt_version):
+    """
+    Builds the cache key of a post from its normalized title, content and category and the prompt version.
+    """
+    parts = [normalize_text(title), normalize_text(content), normalize_text(category), str(prompt_version)]
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+class ExtractionCache:
+    """
+    Persistent content-hash cache of LLM extractions, stored in a local SQLite file.
+
+    Entries expire ttl seconds after they were written, and once the cache holds more than
+    max_entries the least recently used entries are evicted. A hit is a single read: its access
+    time, like the removal of an expired entry, is kept in memory and written in one commit
+    with the next put or once access_batch of them are pending.
+
+    Attributes:
+    ----------
+    path : str
+        Path of the SQLite file, ':memory:' keeps the cache in memory only.
+    max_entries : int
+        Max number of extractions kept.
+    ttl : float
+        Seconds an extraction stays valid.
+    access_batch : int
+        Number of pending access times that triggers a write.
+    hits, misses, evictions, expirations : int
+        Counters since the cache was opened.
+    """
+    def __init__(self, path=EXTRACTION_CACHE_PATH, max_entries=EXTRACTION_CACHE_MAX_ENTRIES,
+                 ttl=EXTRACTION_CACHE_TTL, access_batch=EXTRACTION_CACHE_ACCESS_BATCH):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.access_batch = access_batch
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._accessed = {}
+        self._expired = set()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS extractions ("
+            "key TEXT PRIMARY KEY, data TEXT NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS extractions_last_access ON extractions (last_access)")
+        self._conn.commit()
+        # Kept up to date on every insert and removal, so a put never has to count the table
+        self._size = self._conn.execute("SELECT COUNT(*) FROM extractions").fetchone()[0]
+
+    def get(self, key):
+        """
+        Returns the cached extraction for key, or None on a miss or an expired entry.
+        """
+        now = time.time()
+        row = self._conn.execute("SELECT data, created_at FROM extractions WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        data, created_at = row
+        if now - created_at > self.ttl:
+            if key not in self._expired:
+                self._expired.add(key)
+                self._accessed.pop(key, None)
+                self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._accessed[key] = now
+        if len(self._accessed) >= self.access_batch:
+            self.flush_access()
+        self.hits += 1
+        return json.loads(data)
+
+    def _write_access(self):
+        # Left uncommitted, the caller commits it along with its own changes
+        if self._accessed:
+            self._conn.executemany(
+                "UPDATE extractions SET last_access = ? WHERE key = ?",
+                [(last_access, key) for key, last_access in self._accessed.items()]
+            )
+        if self._expired:
+            cursor = self._conn.executemany("DELETE FROM extractions WHERE key = ?", [(key,) for key in self._expired])
+            self._size -= cursor.rowcount
+        self._accessed = {}
+        self._expired = set()
+
+    def flush_access(self):
+        """
+        Writes the pending access times and removals of expired entries.
+        """
+        self._write_access()
+        self._conn.commit()
+
+    def put(self, key, data):
+        """
+        Stores an extraction and evicts the least recently used entries if the cache is full.
+        """
+        now = time.time()
+        self._accessed.pop(key, None)
+        self._expired.discard(key)
+        # Access times go first, so the eviction below sees them
+        self._write_access()
+        cursor = self._conn.execute(
+            "UPDATE extractions SET data = ?, created_at = ?, last_access = ? WHERE key = ?",
+            (json.dumps(data), now, now, key)
+        )
+        if cursor.rowcount == 0:
+            self._conn.execute(
+                "INSERT INTO extractions (key, data, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(data), now, now)
+            )
+            self._size += 1
+        if self._size > self.max_entries:
+            cursor = self._conn.execute(
+                "DELETE FROM extractions WHERE key IN "
+                "(SELECT key FROM extractions ORDER BY last_access LIMIT ?)",
+                (self._size - self.max_entries,)
+            )
+            self._size -= cursor.rowcount
+            self.evictions += cursor.rowcount
+        self._conn.commit()
+
+    def purge_expired(self):
+        """
+        Deletes all expired entries and returns how many were removed.
+        """
+        self.flush_access()
+        cursor = self._conn.execute("DELETE FROM extractions WHERE created_at < ?", (time.time() - self.ttl,))
+        self._conn.commit()
+        self._size -= cursor.rowcount
+        self.expirations += cursor.rowcount
+        return cursor.rowcount
+
+    def stats(self):
+        """
+        Returns the hit/miss counters and the current size of the cache.
+        """
+        self.flush_access()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "size": self._size,
+        }
+
+    def close(self):
+        self.flush_access()
+        self._conn.close()
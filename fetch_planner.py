@@ -0,0 +1,167 @@
+import asyncio
+from db import subreddit_activity
+from dotenv import load_dotenv
+from reddit_scraper import LISTING_PAGE_SIZE
+from scheduler import PollScheduler
+import datetime
+import os
+import time
+
+load_dotenv()
+
+# Max subreddits combined into one r/a+b+c listing, 1 fetches every subreddit on its own
+MULTIREDDIT_MAX_GROUP_SIZE = int(os.getenv("MULTIREDDIT_MAX_GROUP_SIZE", "25"))
+# Share of a listing page a group may fill between two polls, leaves room for bursts
+MULTIREDDIT_PAGE_FILL = float(os.getenv("MULTIREDDIT_PAGE_FILL", "0.5"))
+# Activity of each subreddit is measured over this many days of saved posts, and refreshed this often
+MULTIREDDIT_ACTIVITY_DAYS = float(os.getenv("MULTIREDDIT_ACTIVITY_DAYS", "7"))
+MULTIREDDIT_REPLAN_INTERVAL = float(os.getenv("MULTIREDDIT_REPLAN_INTERVAL", "3600"))
+
+
+def group_key(names):
+    """
+    Returns the multireddit name of a group, e.g. 'learnpython+python'.
+    """
+    return "+".join(sorted(names, key=str.lower))
+
+
+class FetchPlanner:
+    """
+    Groups subreddits into combined r/a+b+c listings so quiet subreddits share requests.
+
+    Subreddits are packed, busiest first, into groups whose expected posts per poll stay
+    within page_fill of a listing page at the slowest poll interval, with at most
+    max_group_size subreddits per group. Subreddits busier than that are fetched alone.
+    Activity is the rate of saved posts over the last activity_days, refreshed every
+    replan_interval seconds. A group whose fetch overflowed a page is split in two at once.
+
+    The planner is used in place of a PollScheduler: the wrapped scheduler polls the groups,
+    and next_due() returns (group name, {subreddit: category_obj}).
+
+    Attributes:
+    ----------
+    scheduler : PollScheduler
+        Schedules the polls of every group.
+    max_group_size : int
+        Max subreddits in one group.
+    capacity : float
+        Max posts per second a group may receive, from the page size, page_fill and max_interval.
+    subreddits : dict
+        category_obj of every planned subreddit.
+    groups : dict
+        {subreddit: category_obj} members of every group, keyed by group name.
+    rates : dict
+        Estimated posts per second of every subreddit, keyed by lowercased name.
+    """
+    def __init__(self, scheduler=None, max_group_size=MULTIREDDIT_MAX_GROUP_SIZE, page_size=LISTING_PAGE_SIZE,
+                 page_fill=MULTIREDDIT_PAGE_FILL, activity_days=MULTIREDDIT_ACTIVITY_DAYS,
+                 replan_interval=MULTIREDDIT_REPLAN_INTERVAL):
+        self.scheduler = scheduler or PollScheduler()
+        self.max_group_size = max(1, max_group_size)
+        self.capacity = page_size * page_fill / self.scheduler.max_interval
+        self.activity_days = activity_days
+        self.replan_interval = replan_interval
+        self.subreddits = {}
+        self.groups = {}
+        self.rates = {}
+        self._activity_loaded_at = None
+
+    def add(self, name, payload=None, delay=0):
+        """
+        Adds a subreddit and regroups.
+        """
+        self.subreddits[name] = payload
+        self.plan(delay)
+
+    def remove(self, name):
+        """
+        Removes a subreddit and regroups.
+        """
+        if self.subreddits.pop(name, None) is not None:
+            self.plan()
+
+    def __contains__(self, name):
+        return name in self.subreddits
+
+    def refresh_activity(self):
+        """
+        Reloads the rate of every subreddit from the posts saved over the last activity_days.
+        Rates raised by an overflow only decay by half, so a split group isn't merged right back.
+        """
+        window = self.activity_days * 24 * 3600
+        counts = subreddit_activity(datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=window))
+        names = set(counts) | set(self.rates)
+        self.rates = {name: max(counts.get(name, 0) / window, self.rates.get(name, 0.0) / 2) for name in names}
+        self._activity_loaded_at = time.monotonic()
+
+    def _pack(self):
+        # First-fit decreasing: busiest subreddits first, each into the first group with room left
+        names = sorted(self.subreddits, key=lambda name: (-self.rates.get(name.lower(), 0.0), name.lower()))
+        groups = []
+        for name in names:
+            rate = self.rates.get(name.lower(), 0.0)
+            for group in groups:
+                if len(group["names"]) < self.max_group_size and group["rate"] + rate <= self.capacity:
+                    group["names"].append(name)
+                    group["rate"] += rate
+                    break
+            else:
+                groups.append({"names": [name], "rate": rate})
+        return {group_key(group["names"]): group["names"] for group in groups}
+
+    def plan(self, delay=0):
+        """
+        Regroups the subreddits. Groups that didn't change keep their place in the schedule.
+        """
+        planned = self._pack()
+        for key in list(self.groups):
+            if key not in planned:
+                self.scheduler.remove(key)
+                del self.groups[key]
+        for key, names in planned.items():
+            members = {name: self.subreddits[name] for name in names}
+            if key in self.groups:
+                # Same members, only their categories may have changed
+                self.groups[key].clear()
+                self.groups[key].update(members)
+            else:
+                self.groups[key] = members
+                self.scheduler.add(key, members, delay)
+
+    async def next_due(self):
+        """
+        Waits for the next due group and returns (group name, {subreddit: category_obj}).
+        """
+        if self._activity_loaded_at is None or time.monotonic() - self._activity_loaded_at >= self.replan_interval:
+            try:
+                await asyncio.to_thread(self.refresh_activity)
+            except Exception as e:
+                print(f"Could not load subreddit activity, keeping the current groups: {e}")
+                self._activity_loaded_at = time.monotonic()
+            else:
+                self.plan()
+        return await self.scheduler.next_due()
+
+    def record(self, key, created_utcs, overflow=False):
+        """
+        Records the result of a group poll, and splits the group if the poll overflowed a page.
+        """
+        self.scheduler.record(key, created_utcs, overflow)
+        members = self.groups.get(key)
+        if not overflow or members is None or len(members) < 2:
+            return
+        # Rate the members as twice a full group, so packing puts them in at least two groups
+        total = sum(self.rates.get(name.lower(), 0.0) for name in members)
+        for name in members:
+            share = self.rates.get(name.lower(), 0.0) / total if total else 1 / len(members)
+            self.rates[name.lower()] = 2 * self.capacity * share
+        self.plan()
+        parts = sum(1 for group in self.groups.values() if group.keys() & members.keys())
+        print(f"r/{key} overflowed a page, split into {parts} groups.")
+
+    def stats(self):
+        """
+        Returns the members and poll stats of every group.
+        """
+        scheduler_stats = self.scheduler.stats()
+        return {key: {"subreddits": len(members), **scheduler_stats.get(key, {})} for key, members in self.groups.items()}
@@ -0,0 +1,264 @@
+import asyncio
+from contextlib import contextmanager
+from dotenv import load_dotenv
+import bisect
+import json
+import math
+import os
+import threading
+import time
+
+load_dotenv()
+
+# Serve the metrics on http://METRICS_HOST:METRICS_PORT/metrics, 0 disables the endpoint
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+# Seconds between two structured metric logs, 0 disables them
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", "60"))
+METRICS_PREFIX = "aggregator_"
+
+# Upper bounds of the latency buckets, in seconds, from a Mongo write to a slow LLM batch
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Buckets for token counts per request
+TOKEN_BUCKETS = (0, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000)
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Histogram:
+    """
+    Cumulative latency histogram with fixed buckets, as Prometheus expects them.
+
+    Attributes:
+    ----------
+    buckets : tuple
+        Upper bounds of the buckets, +Inf is implied.
+    counts : list
+        Observations per bucket, the last one being +Inf.
+    sum : float
+        Sum of all observations.
+    count : int
+        Number of observations.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Estimates a quantile by linear interpolation inside its bucket.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Registry:
+    """
+    In-process store of counters, gauges and histograms, keyed by name and labels.
+
+    Recording a value is a dict lookup and an addition under a lock, cheap enough to leave
+    on in production. Gauges that are costly or already tracked elsewhere, like queue
+    depths, are registered as callbacks and only read when the metrics are exported.
+
+    Attributes:
+    ----------
+    counters : dict
+        {name: {labels: value}}
+    gauges : dict
+        {name: {labels: value}}
+    histograms : dict
+        {name: {labels: Histogram}}
+    """
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._callbacks = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges.setdefault(name, {})[_labels_key(labels)] = value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        """
+        Adds value to a histogram, buckets only matter on the first observation of a series.
+        """
+        key = _labels_key(labels)
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observes the seconds spent in the with block, also when it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def register_gauge(self, name, callback):
+        """
+        Registers a gauge read on export. callback returns a number, or numbers keyed by
+        label tuples such as (('stage', 'fetch'),).
+        """
+        self._callbacks[name] = callback
+
+    def unregister_gauge(self, name):
+        self._callbacks.pop(name, None)
+
+    def _collect_gauges(self):
+        with self._lock:
+            gauges = {name: dict(series) for name, series in self.gauges.items()}
+        for name, callback in list(self._callbacks.items()):
+            try:
+                value = callback()
+            except Exception as e:
+                print(f"Error reading gauge {name}: {e}")
+                continue
+            gauges[name] = value if isinstance(value, dict) else {(): value}
+        return gauges
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            counters = {name: dict(series) for name, series in self.counters.items()}
+            histograms = {
+                name: {key: (list(h.buckets), list(h.counts), h.sum, h.count) for key, h in series.items()}
+                for name, series in self.histograms.items()
+            }
+
+        for name, series in sorted(counters.items()):
+            lines.append(f"# TYPE {METRICS_PREFIX}{name} counter")
+            lines.extend(f"{METRICS_PREFIX}{name}{_format_labels(key)} {value}" for key, value in series.items())
+        for name, series in sorted(self._collect_gauges().items()):
+            lines.append(f"# TYPE {METRICS_PREFIX}{name} gauge")
+            lines.extend(f"{METRICS_PREFIX}{name}{_format_labels(key)} {value}" for key, value in series.items())
+        for name, series in sorted(histograms.items()):
+            lines.append(f"# TYPE {METRICS_PREFIX}{name} histogram")
+            for key, (buckets, counts, total, count) in series.items():
+                cumulative = 0
+                for bound, bucket_count in zip(list(buckets) + [math.inf], counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == math.inf else repr(float(bound))
+                    lines.append(f"{METRICS_PREFIX}{name}_bucket{_format_labels(key, [('le', le)])} {cumulative}")
+                lines.append(f"{METRICS_PREFIX}{name}_sum{_format_labels(key)} {total}")
+                lines.append(f"{METRICS_PREFIX}{name}_count{_format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """
+        Returns the metrics as a JSON-friendly dict, histograms summarized as count, mean, p50 and p99.
+        """
+        def label_string(key):
+            return ",".join(f"{name}={value}" for name, value in key) or "all"
+
+        with self._lock:
+            counters = {name: {label_string(k): v for k, v in series.items()} for name, series in self.counters.items()}
+            histograms = {
+                name: {
+                    label_string(key): {
+                        "count": h.count,
+                        "mean": round(h.sum / h.count, 4) if h.count else None,
+                        "p50": round(h.quantile(0.5), 4) if h.count else None,
+                        "p99": round(h.quantile(0.99), 4) if h.count else None,
+                    }
+                    for key, h in series.items()
+                }
+                for name, series in self.histograms.items()
+            }
+        gauges = {name: {label_string(k): v for k, v in series.items()} for name, series in self._collect_gauges().items()}
+        return {"counters": counters, "gauges": gauges, "histograms": histograms}
+
+
+REGISTRY = Registry()
+
+# Module-level shortcuts so call sites read metrics.inc(...), metrics.timer(...)
+inc = REGISTRY.inc
+set_gauge = REGISTRY.set
+observe = REGISTRY.observe
+timer = REGISTRY.timer
+register_gauge = REGISTRY.register_gauge
+unregister_gauge = REGISTRY.unregister_gauge
+
+
+async def _handle_request(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # Skip the headers, the request never has a body
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", REGISTRY.render().encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"Not found, try /metrics\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(host=METRICS_HOST, port=METRICS_PORT):
+    """
+    Starts the HTTP endpoint serving /metrics and returns the asyncio server, or None if port is 0.
+    """
+    if not port:
+        return None
+    server = await asyncio.start_server(_handle_request, host, port)
+    print(f"Metrics served on http://{host}:{port}/metrics")
+    return server
+
+async def log_periodically(interval=METRICS_LOG_INTERVAL):
+    """
+    Prints a one-line JSON snapshot of all metrics every interval seconds, forever.
+    """
+    if not interval:
+        return
+    while True:
+        await asyncio.sleep(interval)
+        print(json.dumps({"event": "metrics", "time": time.time(), **REGISTRY.snapshot()}))
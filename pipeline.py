@@ -0,0 +1,454 @@
+import asyncio
+from bson import ObjectId
+from datetime import datetime
+from ai_engine import ExtractionEngine, empty_extraction
+from author_cache import AuthorCache
+from dotenv import load_dotenv
+from functools import partial
+from reddit_governor import RedditGovernor
+from reddit_scraper import get_listing, post_to_dict
+from relevance_filter import RelevanceFilter
+from seen_index import SeenIndex
+from db import BulkPostWriter, load_read_through, load_subreddit_cursors, save_read_through, save_subreddit_cursor
+from embedding_index import EMBEDDING_INDEX_ENABLED, EmbeddingIndex
+import metrics
+from tele_bot import TelegramDispatcher
+from work_queue import WorkQueue
+import os
+import time
+
+load_dotenv()
+
+# Concurrency limit per stage and the bound on every queue between stages
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "4"))
+# Enrich workers mostly wait on the extraction engine, which caps the actual LLM requests itself
+ENRICH_CONCURRENCY = int(os.getenv("ENRICH_CONCURRENCY", "16"))
+DELIVER_CONCURRENCY = int(os.getenv("DELIVER_CONCURRENCY", "2"))
+PERSIST_CONCURRENCY = int(os.getenv("PERSIST_CONCURRENCY", "2"))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "100"))
+# Max posts read from a listing that has a high-water mark, Reddit serves up to 100 per page
+HWM_MAX_POSTS = int(os.getenv("HWM_MAX_POSTS", "100"))
+# Seconds between two looks at the work queue for items whose retry is due
+WORK_QUEUE_POLL_INTERVAL = float(os.getenv("WORK_QUEUE_POLL_INTERVAL", "5"))
+
+STAGES = ("fetch", "enrich", "deliver", "persist")
+
+
+def post_order(created_utc, fullname):
+    """
+    Sort key of a post in a 'new' listing. Fullnames are base 36 counters, they order the posts of the same second.
+    """
+    return created_utc, int(fullname.split("_", 1)[-1], 36) if fullname else -1
+
+
+class Pipeline:
+    """
+    Staged asyncio pipeline that moves Reddit posts through fetch -> enrich -> deliver -> persist.
+
+    Every stage is a pool of worker tasks reading from its own bounded queue, so a slow
+    subreddit or a slow LLM response only occupies one worker instead of the whole loop.
+
+    Attributes:
+    ----------
+    reddit : asyncpraw.Reddit
+        The Reddit client used by the fetch stage.
+    limit : int
+        The number of posts to read from a subreddit listing that has no high-water mark yet.
+    concurrency : dict
+        Number of workers for each stage.
+    queues : dict
+        The bounded input queue of each stage.
+    extractor : ExtractionEngine
+        The async LLM extraction service used by the enrich stage.
+    writer : BulkPostWriter
+        Batches the posts of the persist stage into bulk writes.
+    seen_index : SeenIndex
+        In-memory index of the saved posts used by the fetch stage to skip duplicates.
+    cursors : dict
+        High-water mark of each subreddit as (newest_fullname, newest_created_utc).
+    read_through : dict
+        (created_utc, fullname) of the newest post of the last listing read down to each subreddit's mark.
+    scheduler : PollScheduler
+        Optional scheduler that is told how many posts each fetch found.
+    governor : RedditGovernor
+        Paces and retries every Reddit call made by the pipeline.
+    authors : AuthorCache
+        Resolves post authors for the fetch stage, shared across cycles.
+    dispatcher : TelegramDispatcher
+        Queues the alerts of the deliver stage, so a slow Telegram never holds up the pipeline.
+    relevance : RelevanceFilter
+        Scores posts in the enrich stage so low-value ones skip the LLM.
+    work_queue : WorkQueue
+        Durable record of every post between fetch and persist, used to retry and resume them.
+    embeddings : EmbeddingIndex
+        Clusters the posts of the enrich stage so near-duplicates skip the LLM and the alert, None disables it.
+    """
+    def __init__(self, reddit, limit=1, extractor=None, writer=None, seen_index=None, scheduler=None,
+                 governor=None, authors=None, dispatcher=None, relevance=None, work_queue=None, embeddings=None,
+                 fetch_concurrency=FETCH_CONCURRENCY,
+                 enrich_concurrency=ENRICH_CONCURRENCY, deliver_concurrency=DELIVER_CONCURRENCY,
+                 persist_concurrency=PERSIST_CONCURRENCY, queue_size=PIPELINE_QUEUE_SIZE):
+        self.reddit = reddit
+        self.limit = limit
+        self.extractor = extractor or ExtractionEngine()
+        self.writer = writer or BulkPostWriter()
+        self.seen_index = seen_index or SeenIndex()
+        self.cursors = {}
+        self.read_through = {}
+        self.scheduler = scheduler
+        self.governor = governor or RedditGovernor(reddit)
+        self.authors = authors or AuthorCache(self.governor)
+        self.dispatcher = dispatcher or TelegramDispatcher()
+        self.relevance = relevance or RelevanceFilter()
+        self.work_queue = work_queue or WorkQueue()
+        self.embeddings = embeddings if embeddings is not None or not EMBEDDING_INDEX_ENABLED else EmbeddingIndex()
+        self.concurrency = {
+            "fetch": fetch_concurrency,
+            "enrich": enrich_concurrency,
+            "deliver": deliver_concurrency,
+            "persist": persist_concurrency,
+        }
+        self.queues = {stage: asyncio.Queue(maxsize=queue_size) for stage in STAGES}
+        self._handlers = {
+            "fetch": self._fetch,
+            "enrich": self._enrich,
+            "deliver": self._deliver,
+            "persist": self._persist,
+        }
+        self._workers = []
+        # Posts currently moving through the pipeline, so a listing seen twice isn't processed twice
+        self._in_flight = set()
+        metrics.register_gauge("pipeline_queue_depth", lambda: {
+            (("stage", stage),): queue.qsize() for stage, queue in self.queues.items()
+        })
+        metrics.register_gauge("pipeline_in_flight_posts", lambda: len(self._in_flight))
+        metrics.register_gauge("work_queue_items", lambda: {
+            (("stage", stage), ("state", state)): count
+            for state, stages in self.work_queue.stats().items() for stage, count in stages.items()
+        })
+
+    async def load(self):
+        """
+        Loads the seen index and the subreddit cursors from the database, call it once before start().
+        Posts a previous run left unfinished in the work queue are resumed by start().
+        """
+        await asyncio.to_thread(self.seen_index.load)
+        await self.reload_cursors()
+        recovered = self.work_queue.recover()
+        if recovered:
+            print(f"Resuming {recovered} posts left unfinished by the last run.")
+
+    async def reload_cursors(self):
+        """
+        Reloads the subreddit cursors and read-through times, e.g. after taking over subreddits
+        another worker was polling.
+        """
+        self.cursors = await asyncio.to_thread(load_subreddit_cursors)
+        self.read_through = await asyncio.to_thread(load_read_through)
+
+    def start(self):
+        """
+        Starts the worker tasks of every stage.
+        """
+        for stage in STAGES:
+            for _ in range(self.concurrency[stage]):
+                self._workers.append(asyncio.create_task(self._worker(stage)))
+        self._workers.append(asyncio.create_task(self._flush_loop()))
+        self._workers.append(asyncio.create_task(self._retry_loop()))
+
+    async def stop(self):
+        """
+        Cancels all worker tasks, waits for them to exit and writes the posts still waiting in the writer.
+        """
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        await self.flush()
+        await self.extractor.close()
+        await self.dispatcher.close()
+        print(f"Relevance filter: {self.relevance.stats()}")
+        print(f"Work queue: {self.work_queue.stats()}")
+        metrics.unregister_gauge("work_queue_items")
+        self.work_queue.close()
+        if self.embeddings is not None:
+            print(f"Embedding index: {self.embeddings.stats()}")
+            self.embeddings.close()
+
+    async def submit(self, category_obj, subreddit_name):
+        """
+        Queues a subreddit to be fetched. Waits if the fetch queue is full.
+        """
+        await self.queues["fetch"].put({"category_obj": category_obj, "subreddit": subreddit_name})
+
+    async def submit_group(self, group_name, members):
+        """
+        Queues a combined r/a+b+c listing to be fetched, members maps each subreddit to its category_obj.
+        """
+        await self.queues["fetch"].put({"subreddit": group_name, "members": members})
+
+    async def drain(self):
+        """
+        Waits until every submitted subreddit and every post produced from it has gone through all stages.
+        """
+        # Upstream items are only marked done after they were handed downstream,
+        # so joining the queues in stage order waits for the whole pipeline
+        for stage in STAGES:
+            await self.queues[stage].join()
+        await self.flush()
+
+    async def flush(self):
+        """
+        Writes the posts waiting in the bulk writer.
+        """
+        self._saved(await asyncio.to_thread(self.writer.flush))
+
+    def _saved(self, reddit_post_ids):
+        # Posts the writer couldn't write even on their own are retried like any failed stage
+        for reddit_post_id, error in self.writer.take_rejected():
+            self._in_flight.discard(reddit_post_id)
+            if self.work_queue.fail(reddit_post_id, error) == "dead":
+                print(f"[persist] Post {reddit_post_id} failed too many times, moved to the dead letters.")
+        self.work_queue.complete(reddit_post_ids)
+        metrics.inc("posts_saved_total", len(reddit_post_ids))
+        for reddit_post_id in reddit_post_ids:
+            self.seen_index.add(reddit_post_id)
+            self._in_flight.discard(reddit_post_id)
+        if reddit_post_ids:
+            print(f"{len(reddit_post_ids)} posts saved.")
+
+    async def _flush_loop(self):
+        # Makes sure a half-full batch is written once it gets too old, even when no new posts arrive
+        while True:
+            await asyncio.sleep(self.writer.max_age)
+            try:
+                self._saved(await asyncio.to_thread(self.writer.flush_if_due))
+            except Exception as e:
+                print(f"[persist] Error flushing posts: {e}")
+
+    async def _retry_loop(self):
+        # Feeds the failed posts whose backoff is over, and those resumed from the last run, back to their stage
+        while True:
+            for reddit_post_id, stage, item in self.work_queue.claim_due(self.queues["enrich"].maxsize or 100):
+                self._in_flight.add(reddit_post_id)
+                await self.queues[stage].put(item)
+            await asyncio.sleep(WORK_QUEUE_POLL_INTERVAL)
+
+    async def _worker(self, stage):
+        queue = self.queues[stage]
+        handler = self._handlers[stage]
+        while True:
+            item = await queue.get()
+            start = time.perf_counter()
+            try:
+                await handler(item)
+                metrics.inc("stage_items_total", stage=stage, outcome="ok")
+            except Exception as e:
+                metrics.inc("stage_items_total", stage=stage, outcome="error")
+                print(f"[{stage}] Error processing {item.get('reddit_post_id') or item['subreddit']}: {e}")
+                reddit_post_id = item.get("reddit_post_id")
+                if reddit_post_id is not None:
+                    self._in_flight.discard(reddit_post_id)
+                    # Subreddits are simply fetched again on their next poll, posts are retried from the work queue
+                    if self.work_queue.fail(reddit_post_id, e) == "dead":
+                        print(f"[{stage}] Post {reddit_post_id} failed too many times, moved to the dead letters.")
+            finally:
+                metrics.observe("stage_seconds", time.perf_counter() - start, stage=stage)
+                queue.task_done()
+
+    async def _fetch(self, item):
+        # A single subreddit is fetched as a group of one
+        members = item.get("members") or {item["subreddit"]: item["category_obj"]}
+        members = {name.lower(): (name, category_obj) for name, category_obj in members.items()}
+        posts, overflow = [], False
+        read_through = {name: self.read_through.get(name) for name in members}
+        try:
+            # The whole listing is read inside one governed call, so a retry starts it over cleanly
+            posts, overflow = await self.governor.call(self._read_listing, item["subreddit"], members)
+        finally:
+            if self.scheduler is not None:
+                self.scheduler.record(item["subreddit"], [post.created_utc for post in posts], overflow=overflow)
+        # Stored with the cursors, so a restart or a new owner doesn't start from the old marks again
+        moved = {name: self.read_through[name] for name in members if self.read_through.get(name) != read_through[name]}
+        if moved:
+            await asyncio.to_thread(save_read_through, moved)
+
+        new_posts = []
+        for post in posts:
+            reddit_post_id = post.id
+
+            # Check if the post is already being processed or already exists in the database
+            if reddit_post_id in self._in_flight:
+                continue
+            seen = self.seen_index.check(reddit_post_id)
+            if seen is None:
+                # Probable match, only now is the database asked
+                seen = await asyncio.to_thread(self.seen_index.confirm, reddit_post_id)
+            if seen:
+                print(f"Post {reddit_post_id} already exists in the database. Skipping...")
+                continue
+            new_posts.append(post)
+
+        metrics.inc("posts_fetched_total", len(posts), subreddit=item["subreddit"])
+        metrics.inc("posts_new_total", len(new_posts), subreddit=item["subreddit"])
+        # Resolve all authors of the listing at once instead of one load() per post
+        with metrics.timer("author_resolve_seconds"):
+            authors = await self.authors.resolve_many(new_posts)
+        for post in new_posts:
+            reddit_user_id, username = authors[post.id]
+            # Combined listings are demultiplexed back to the subreddit and category of each post
+            subreddit_name, category_obj = members[post.subreddit.display_name.lower()]
+            # Only plain data goes down the pipeline, so the item can be stored and resumed as is
+            work_item = {
+                "category_obj": category_obj,
+                "subreddit": subreddit_name,
+                "reddit_post_id": post.id,
+                "post": post_to_dict(post),
+                "reddit_user_id": reddit_user_id,
+                "username": username,
+                # Fixed up front so a retried write replays the same post instead of duplicating it
+                "post_object_id": str(ObjectId()),
+            }
+            if not self.work_queue.add(post.id, "enrich", work_item):
+                print(f"Post {post.id} is already in the work queue. Skipping...")
+                continue
+            self._in_flight.add(post.id)
+            await self.queues["enrich"].put(work_item)
+
+        # Posts are newest first, so the first post of each subreddit moves its cursor
+        newest = {}
+        for post in posts:
+            newest.setdefault(post.subreddit.display_name.lower(), (post.name, post.created_utc))
+        for cursor_key, mark in newest.items():
+            cursor = self.cursors.get(cursor_key)
+            if cursor is None or post_order(mark[1], mark[0]) > post_order(cursor[1], cursor[0]):
+                self.cursors[cursor_key] = mark
+                await asyncio.to_thread(save_subreddit_cursor, cursor_key, *mark)
+
+    async def _read_listing(self, listing_name, members):
+        """
+        Reads the 'new' listing of a subreddit, or of a combined r/a+b+c listing, down to the
+        high-water marks of its subreddits.
+
+        Every subreddit is followed on its own: it is done once the listing reaches its mark,
+        or gets older than it, while subreddits without a mark yet only get their latest
+        `limit` posts. The listing is paged until every subreddit is done, or until
+        HWM_MAX_POSTS posts were read. A subreddit that is done moves its read-through time to
+        the newest post of the listing, so a quiet one doesn't hold the next read back to its own old mark.
+
+        Returns:
+        -------
+        tuple
+            (posts newer than the mark of their subreddit, newest first,
+             True if the page limit was hit before a subreddit reached its mark, so posts may have been missed)
+        """
+        subreddit = await self.reddit.subreddit(listing_name)
+        cursors = {name: self.cursors.get(name) for name in members}
+        marks = {}
+        for name, cursor in cursors.items():
+            orders = [post_order(*self.read_through[name])] if name in self.read_through else []
+            if cursor is not None:
+                orders.append(post_order(cursor[1], cursor[0]))
+            marks[name] = max(orders) if orders else None
+        # Marked subreddits still above their mark, and posts taken so far by the unmarked ones
+        pending = {name for name, mark in marks.items() if mark is not None}
+        taken = {name: 0 for name, mark in marks.items() if mark is None}
+        # With no mark at all only the latest posts are read, as on a first run
+        first_run = not pending
+        max_posts = min(self.limit * len(members), HWM_MAX_POSTS) if first_run else HWM_MAX_POSTS
+        posts, read, newest = [], 0, None
+
+        async for post in get_listing(subreddit, 'new', max_posts):
+            read += 1
+            if newest is None:
+                newest = (post.created_utc, post.name)
+            # Posts come newest first, a subreddit whose mark is this post or a newer one has nothing left to read
+            order = post_order(post.created_utc, post.name)
+            pending = {name for name in pending if order > marks[name]}
+            name = post.subreddit.display_name.lower()
+            if name in pending:
+                posts.append(post)
+            elif name in taken and taken[name] < self.limit:
+                taken[name] += 1
+                posts.append(post)
+            if not pending and all(count >= self.limit for count in taken.values()):
+                break
+        # When the page ran out, posts of a subreddit still above its mark may be further down
+        overflow = bool(pending) and read >= max_posts
+        done = [
+            name for name in members
+            if name not in pending and (not overflow or taken.get(name, self.limit) >= self.limit)
+        ]
+        if newest is not None:
+            for name in done:
+                if name not in self.read_through or post_order(*newest) > post_order(*self.read_through[name]):
+                    self.read_through[name] = newest
+        return posts, overflow
+
+    async def _enrich(self, item):
+        post = item.pop("post")
+        category = item["category_obj"]["category"]
+        posted_time = datetime.fromtimestamp(post["created_utc"])
+
+        # Cheap local scoring first, only posts worth it go to the LLM
+        relevant, score = self.relevance.is_relevant(post["title"], post["text"], category)
+        if not relevant and self.relevance.action == "drop":
+            print(f"Post {item['reddit_post_id']} scored {score:.2f}, dropping it.")
+            self.work_queue.complete([item["reddit_post_id"]])
+            self.seen_index.add(item["reddit_post_id"])
+            self._in_flight.discard(item["reddit_post_id"])
+            return
+
+        cluster = None
+        if self.embeddings is not None:
+            cluster = await asyncio.to_thread(
+                self.embeddings.assign, item["reddit_post_id"], f"{post['title']}\n{post['text']}", category
+            )
+        if relevant and cluster is not None and cluster["suppressed"]:
+            print(f"Post {item['reddit_post_id']} duplicates cluster {cluster['cluster_id']} "
+                  f"({cluster['similarity']:.2f}), storing it without extraction or alert.")
+            relevant = False
+            extracted_info = empty_extraction(post["title"], item["subreddit"], category)
+        elif relevant:
+            extracted_info = await self.extractor.extract(
+                item["reddit_post_id"], post["title"], post["text"], item["subreddit"], category
+            )
+        else:
+            print(f"Post {item['reddit_post_id']} scored {score:.2f}, storing it without extraction.")
+            extracted_info = empty_extraction(post["title"], item["subreddit"], category)
+
+        # Add the posted time before uploading to the database
+        extracted_info["time_created"] = posted_time.isoformat()
+        extracted_info["reddit_post_id"] = item["reddit_post_id"]
+        extracted_info["category"] = category
+        extracted_info["filter_type"] = "new"
+        extracted_info["username"] = item["username"]
+        extracted_info["reddit_user_id"] = item["reddit_user_id"]
+        extracted_info["cluster_id"] = cluster["cluster_id"] if cluster is not None else None
+
+        item["extracted_info"] = extracted_info
+        # Posts stored without extraction have nothing worth an alert
+        next_stage = "deliver" if relevant else "persist"
+        # The extraction is stored before moving on, a retry or a restart never pays for it again
+        self.work_queue.advance(item["reddit_post_id"], next_stage, item)
+        await self.queues[next_stage].put(item)
+
+    async def _deliver(self, item):
+        category_obj = item["category_obj"]
+        cluster_id = item["extracted_info"].get("cluster_id")
+        # Duplicates are only suppressed once the cluster's alert actually went out
+        on_sent = None
+        if self.embeddings is not None and cluster_id is not None:
+            on_sent = partial(self.embeddings.mark_alerted, cluster_id)
+        if not self.dispatcher.enqueue(category_obj["tele_addy"], item["extracted_info"], category_obj["category"],
+                                       on_sent):
+            print(f"No Telegram bot for category {category_obj['category']}, alert not sent.")
+        self.work_queue.advance(item["reddit_post_id"], "persist", item)
+        await self.queues["persist"].put(item)
+
+    async def _persist(self, item):
+        extracted_info = item["extracted_info"]
+        # The post stays in flight until its batch is written, so it isn't fetched again meanwhile
+        self._saved(await asyncio.to_thread(
+            self.writer.add, extracted_info, extracted_info["username"], item["post_object_id"]
+        ))
@@ -0,0 +1,144 @@
+from dotenv import load_dotenv
+import math
+import os
+import re
+
+load_dotenv()
+
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-2024-08-06")
+# Cheaper, faster model for short posts, empty sends every post to OPENAI_MODEL
+OPENAI_SMALL_MODEL = os.getenv("OPENAI_SMALL_MODEL", "gpt-4o-mini")
+# Posts whose title and content fit in this many tokens, and hold no code, go to OPENAI_SMALL_MODEL
+EXTRACTION_SMALL_MODEL_TOKENS = int(os.getenv("EXTRACTION_SMALL_MODEL_TOKENS", "250"))
+# Post bodies longer than this are cut down to their beginning and end before being sent
+EXTRACTION_MAX_CONTENT_TOKENS = int(os.getenv("EXTRACTION_MAX_CONTENT_TOKENS", "1500"))
+# Share of a cut body taken from its beginning, the rest comes from its end
+EXTRACTION_HEAD_SHARE = 2 / 3
+
+# Rough size of a token in English text, close enough for budgets without a tokenizer
+CHARS_PER_TOKEN = 4
+
+EXTRACTION_INSTRUCTIONS = """1. All topics discussed.
+2. All specific questions or requests made.
+3. Relevant keywords and phrases.
+4. Sentiment is a list of contextualized sentiments -> here are examples of some (positive, negative, neutral, looking_for_help, angry, confused, excited, afraid, promoting.).
+5. Any explicit actions or next steps based on the content in the post or the title that I can react to help?
+6. A 75-word max summary of the post given that the goal is to help them by providing a ChatGPT prompt that will guide them through their issue.
+7. Provide 3 optimal responses that help the user if the sentiment shows they are looking for help. These should create prompts that the user can use inside ChatGPT to walk them through their issue. Also give advice on how LLMs are perfect to explore questions and using YouTube as a guide will help tremendously."""
+
+# The system prompts never contain post data, anything request-specific goes in the user message.
+# At a few hundred tokens they stay below the 1024 tokens from which OpenAI caches a prompt prefix,
+# so they are not expected to be served from the prompt cache and aren't padded to get there.
+_SYSTEM_PREFIX = f"""You are an AI assistant tasked with extracting structured data from online Reddit posts.
+Each post comes with its title, full text, subreddit and the category of the subreddit. Text between [... and ...] was cut from a long post.
+Extract the following information:
+{EXTRACTION_INSTRUCTIONS}
+"""
+
+SYSTEM_PROMPT = _SYSTEM_PREFIX + (
+    "You are given one post. Copy its title, subreddit and category as given and fill in the other fields."
+)
+
+BATCH_SYSTEM_PROMPT = _SYSTEM_PREFIX + (
+    "You are given several posts, analyze every post on its own. Return one entry per post in the \"posts\" "
+    "list, copying its reddit_post_id, title, subreddit and category as given."
+)
+
+
+def estimate_tokens(text):
+    """
+    Estimates the number of tokens of text from its length.
+    """
+    return math.ceil(len(text or "") / CHARS_PER_TOKEN)
+
+def compact_whitespace(text):
+    """
+    Collapses runs of spaces and blank lines, which cost tokens and carry nothing.
+    """
+    text = re.sub(r"[ \t\u00a0\u200b]+", " ", text or "")
+    text = re.sub(r" ?\n[ \n]*\n", "\n\n", text)
+    return text.strip()
+
+def truncate_content(content, max_tokens=EXTRACTION_MAX_CONTENT_TOKENS):
+    """
+    Fits a post body in max_tokens, keeping its beginning and its end where the question
+    and the ask usually are, and marking what was cut. Cuts fall between words.
+    """
+    content = compact_whitespace(content)
+    if not max_tokens or estimate_tokens(content) <= max_tokens:
+        return content
+
+    budget = max_tokens * CHARS_PER_TOKEN
+    head_end = int(budget * EXTRACTION_HEAD_SHARE)
+    tail_start = len(content) - (budget - head_end)
+    head_end = content.rfind(" ", 0, head_end) if " " in content[:head_end] else head_end
+    tail_start = content.find(" ", tail_start) + 1 if " " in content[tail_start:] else tail_start
+    omitted = estimate_tokens(content[head_end:tail_start])
+    return f"{content[:head_end].rstrip()}\n[... about {omitted} tokens cut ...]\n{content[tail_start:].lstrip()}"
+
+def choose_model(posts, small_model=OPENAI_SMALL_MODEL, max_small_tokens=EXTRACTION_SMALL_MODEL_TOKENS):
+    """
+    Picks the model for a request: the small model if every post in it is short and holds no
+    code, the full model otherwise.
+    """
+    if small_model and all(
+        estimate_tokens(post["title"]) + estimate_tokens(post["content"]) <= max_small_tokens
+        and "```" not in post["content"]
+        for post in posts
+    ):
+        return small_model
+    return OPENAI_MODEL
+
+def format_post(post):
+    """
+    Formats a post for the user message, with its reddit_post_id if it has one.
+    """
+    post_id = f"Reddit Post ID: {post['reddit_post_id']}\n" if post.get("reddit_post_id") else ""
+    return (f"{post_id}Title: {post['title']}\nContent: {post['content']}\n"
+            f"Subreddit: {post['subreddit']}\nCategory: {post['category']}")
+
+def build_messages(title, content, subreddit, category):
+    """
+    Builds the chat messages for the extraction of a single post.
+    """
+    post = {"title": title, "content": content, "subreddit": subreddit, "category": category}
+    return [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": format_post(post)}]
+
+def build_batch_messages(posts):
+    """
+    Builds the chat messages for the extraction of several posts in one request.
+    Each post dict needs reddit_post_id, title, content, subreddit and category.
+    """
+    return [
+        {"role": "system", "content": BATCH_SYSTEM_PROMPT},
+        {"role": "user", "content": "\n\n".join(format_post(post) for post in posts)},
+    ]
+
+def build_request(posts, batch=False, max_content_tokens=EXTRACTION_MAX_CONTENT_TOKENS):
+    """
+    Assembles the chat-completion request for one post, or several with batch=True.
+
+    Parameters:
+    ----------
+    posts : list
+        Post dicts with title, content, subreddit and category, and reddit_post_id for batches.
+
+    Returns:
+    -------
+    dict
+        model and messages of the request, and tokens_saved, the estimated prompt tokens the
+        truncation of the post bodies saved.
+    """
+    prepared = []
+    tokens_saved = 0
+    for post in posts:
+        content = truncate_content(post["content"], max_content_tokens)
+        tokens_saved += max(0, estimate_tokens(post["content"]) - estimate_tokens(content))
+        prepared.append(dict(post, content=content))
+
+    if batch:
+        messages = build_batch_messages(prepared)
+    else:
+        post = prepared[0]
+        messages = build_messages(post["title"], post["content"], post["subreddit"], post["category"])
+    return {"model": choose_model(prepared), "messages": messages, "tokens_saved": tokens_saved}
@@ -0,0 +1,236 @@
+import asyncio
+from bson import ObjectId
+from collections import OrderedDict, deque
+from db import Post, load_post_terms, search_terms
+from dotenv import load_dotenv
+import datetime
+import metrics
+import os
+import re
+import threading
+import time
+from trends import top_terms
+
+load_dotenv()
+
+# Newest posts kept per category for /recent, and results shown per query
+QUERY_CACHE_RECENT_SIZE = int(os.getenv("QUERY_CACHE_RECENT_SIZE", "50"))
+QUERY_CACHE_RESULTS = int(os.getenv("QUERY_CACHE_RESULTS", "10"))
+# Max /top and /search results kept, least recently used ones are evicted
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_CACHE_MAX_ENTRIES", "500"))
+# Seconds between two reads of the newly saved posts, and how long a /top result is kept before a full recount
+QUERY_CACHE_REFRESH_INTERVAL = float(os.getenv("QUERY_CACHE_REFRESH_INTERVAL", "15"))
+QUERY_CACHE_TOP_TTL = float(os.getenv("QUERY_CACHE_TOP_TTL", "600"))
+# Posts get their ObjectId when fetched and can be saved a bit later, so every refresh looks back this far
+QUERY_CACHE_LOOKBACK = float(os.getenv("QUERY_CACHE_LOOKBACK", "600"))
+
+PROJECTION = {"reddit_post_id": 1, "subreddit": 1, "category": 1, "title": 1, "time_created": 1,
+              "topic_terms": 1, "keyword_terms": 1}
+# Bound on the reddit_post_ids remembered across refreshes, far more than a lookback ever holds
+SEEN_IDS = 100000
+WINDOW_PATTERN = re.compile(r"^(\d+)([mhdw])$")
+WINDOW_UNITS = {"m": "minutes", "h": "hours", "d": "days", "w": "weeks"}
+
+
+def parse_window(text):
+    """
+    Parses a window such as '30m', '24h', '7d' or '2w' into a timedelta, None if it isn't one.
+    """
+    match = WINDOW_PATTERN.match(text.strip().lower())
+    if match is None or int(match.group(1)) == 0:
+        return None
+    return datetime.timedelta(**{WINDOW_UNITS[match.group(2)]: int(match.group(1))})
+
+def _summary(post, terms):
+    return {
+        "reddit_post_id": post["reddit_post_id"],
+        "subreddit": post.get("subreddit"),
+        "category": post.get("category"),
+        "title": post.get("title", ""),
+        "time_created": post.get("time_created"),
+        "terms": set(search_terms(terms["topic"] + terms["keyword"])),
+    }
+
+def _insert(posts, summary):
+    """
+    Inserts a post into a bounded deque of posts kept newest first by time_created, the order they are
+    loaded from the database in. Posts are saved in _id order, which a post created earlier can come last in.
+    """
+    # A post saved while its list was loaded can come back from the next refresh
+    if any(post["reddit_post_id"] == summary["reddit_post_id"] for post in posts):
+        return
+    index = next((i for i, post in enumerate(posts) if post["time_created"] < summary["time_created"]), len(posts))
+    if len(posts) == posts.maxlen:
+        if index == len(posts):
+            # Older than every post kept, it isn't among the newest
+            return
+        posts.pop()
+    posts.insert(index, summary)
+
+
+class QueryCache:
+    """
+    In-process cache of the results served by the Telegram query commands.
+
+    refresh() reads the posts saved since the previous call, one indexed query on _id,
+    and folds them into the newest posts of their category and the /search results whose
+    term they mention. /top results are kept as counted for top_ttl seconds and then
+    recounted, as posts leaving their window can't be taken out of the counts. Repeated
+    queries are answered from memory, and only a first query, or a /top result older than
+    top_ttl, goes to the database.
+
+    Attributes:
+    ----------
+    recent_size : int
+        Newest posts kept per category.
+    results : int
+        Posts or terms returned per query.
+    max_entries : int
+        Max number of cached /top and /search results.
+    top_ttl : float
+        Seconds a /top result is served before being recounted.
+    hits, misses : int
+        Queries answered from memory, and from the database.
+    """
+    def __init__(self, recent_size=QUERY_CACHE_RECENT_SIZE, results=QUERY_CACHE_RESULTS,
+                 max_entries=QUERY_CACHE_MAX_ENTRIES, top_ttl=QUERY_CACHE_TOP_TTL, lookback=QUERY_CACHE_LOOKBACK):
+        self.recent_size = recent_size
+        self.results = results
+        self.max_entries = max_entries
+        self.top_ttl = top_ttl
+        self.lookback = lookback
+        self.hits = 0
+        self.misses = 0
+        self._recent = {}
+        self._entries = OrderedDict()
+        # Posts already folded in, so the lookback of the next refresh doesn't count them twice
+        self._seen = OrderedDict()
+        self._last_id = None
+        # Queries and refreshes run in worker threads, the lock guards the cached results
+        self._lock = threading.Lock()
+
+    def _count(self, query, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        metrics.inc("query_cache_total", query=query, result="hit" if hit else "miss")
+
+    def _put(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def refresh(self):
+        """
+        Folds the posts saved since the last refresh into the cached results. Returns how many were new.
+        The first call only records which posts are already saved.
+        """
+        first = self._last_id is None
+        if first:
+            self._last_id = ObjectId.from_datetime(datetime.datetime.now(datetime.timezone.utc))
+        since = self._last_id.generation_time - datetime.timedelta(seconds=self.lookback)
+        cursor = Post._get_collection().find({"_id": {"$gt": ObjectId.from_datetime(since)}}, PROJECTION)
+        posts = [post for post in cursor.sort("_id", 1) if post["reddit_post_id"] not in self._seen]
+        terms = load_post_terms(posts) if posts and not first else {}
+
+        folded = 0
+        with self._lock:
+            for post in posts:
+                # Checked again under the lock, a concurrent refresh may have folded it meanwhile
+                if post["reddit_post_id"] in self._seen:
+                    continue
+                folded += 1
+                self._last_id = max(self._last_id, post["_id"])
+                self._seen[post["reddit_post_id"]] = None
+                if len(self._seen) > SEEN_IDS:
+                    self._seen.popitem(last=False)
+                if first:
+                    continue
+                summary = _summary(post, terms[post["_id"]])
+                recent = self._recent.get(summary["category"])
+                if recent is not None:
+                    _insert(recent, summary)
+                for key, entry in self._entries.items():
+                    if key[0] == "search" and key[1] in summary["terms"]:
+                        _insert(entry["posts"], summary)
+        return 0 if first else folded
+
+    def recent(self, category):
+        """
+        Returns the newest posts of a category, newest first.
+        """
+        with self._lock:
+            recent = self._recent.get(category)
+            self._count("recent", recent is not None)
+            if recent is not None:
+                return list(recent)[:self.results]
+
+        # Catch up first, so the posts loaded now and the ones folded in later don't overlap
+        self.refresh()
+        cursor = Post._get_collection().find({"category": category}, PROJECTION).sort("time_created", -1)
+        posts = list(cursor.limit(self.recent_size))
+        terms = load_post_terms(posts)
+        recent = deque((_summary(post, terms[post["_id"]]) for post in posts), maxlen=self.recent_size)
+        with self._lock:
+            self._recent[category] = recent
+            return list(recent)[:self.results]
+
+    def top(self, category, window):
+        """
+        Returns the most mentioned keywords of a category over a window, as (term, count) tuples.
+        """
+        key = ("top", category, window)
+        with self._lock:
+            entry = self._entries.get(key)
+            hit = entry is not None and entry["expires_at"] > time.monotonic()
+            self._count("top", hit)
+            if hit:
+                self._entries.move_to_end(key)
+                return list(entry["terms"])
+
+        terms = top_terms("keyword", category, window=window, n=self.results)
+        with self._lock:
+            self._put(key, {"terms": terms, "expires_at": time.monotonic() + self.top_ttl})
+            return list(terms)
+
+    def _find_term(self, term):
+        # Terms come from the LLM in any case, search_terms holds them lowercased under one index
+        query = {"search_terms": term.strip().lower()}
+        cursor = Post._get_collection().find(query, PROJECTION).sort("time_created", -1).limit(self.results)
+        posts = list(cursor)
+        terms = load_post_terms(posts)
+        return [_summary(post, terms[post["_id"]]) for post in posts]
+
+    def search(self, term):
+        """
+        Returns the newest posts whose topics or keywords include term, case-insensitively.
+        """
+        key = ("search", term.strip().lower())
+        with self._lock:
+            entry = self._entries.get(key)
+            self._count("search", entry is not None)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return list(entry["posts"])
+
+        self.refresh()
+        posts = deque(self._find_term(term), maxlen=self.results)
+        with self._lock:
+            self._put(key, {"posts": posts})
+            return list(posts)
+
+    async def refresh_periodically(self, interval=QUERY_CACHE_REFRESH_INTERVAL):
+        """
+        Refreshes the cache every interval seconds, forever.
+        """
+        while True:
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception as e:
+                print(f"Error refreshing the query cache: {e}")
+            await asyncio.sleep(interval)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "categories": len(self._recent)}
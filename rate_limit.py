@@ -0,0 +1,72 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Async token bucket used to pace calls to rate-limited APIs.
+
+    Tokens refill continuously at `rate` per second up to `capacity`. acquire() waits until
+    enough tokens are available, so callers sharing a bucket are spread out evenly.
+
+    Attributes:
+    ----------
+    rate : float
+        Tokens added per second. Can be changed at any time to speed up or slow down callers.
+    capacity : float
+        Max number of tokens, i.e. the largest burst allowed.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def tokens(self):
+        self._refill()
+        return self._tokens
+
+    def try_acquire(self, tokens=1):
+        """
+        Takes tokens without waiting. Returns False if there aren't enough.
+        """
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens=1):
+        """
+        Waits until tokens are available and takes them.
+
+        Returns:
+        -------
+        float
+            The number of seconds spent waiting.
+        """
+        waited = 0.0
+        # The lock keeps waiters in FIFO order so no caller starves
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                delay = (tokens - self._tokens) / self.rate
+                await asyncio.sleep(delay)
+                waited += delay
+
+    def drain(self):
+        """
+        Empties the bucket, e.g. after the server said we are over the limit.
+        """
+        self._refill()
+        self._tokens = 0.0
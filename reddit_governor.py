@@ -0,0 +1,147 @@
+import asyncio
+from asyncprawcore.exceptions import RequestException, ServerError, TooManyRequests
+from dotenv import load_dotenv
+from rate_limit import TokenBucket
+import metrics
+import os
+import random
+import time
+
+load_dotenv()
+
+# Steady request rate allowed to the Reddit API, Reddit grants 100 requests per minute per OAuth client
+REDDIT_REQUESTS_PER_MINUTE = float(os.getenv("REDDIT_REQUESTS_PER_MINUTE", "90"))
+REDDIT_BURST = float(os.getenv("REDDIT_BURST", "10"))
+# Retries of a call that got a 429, a 5xx or a network error, with jittered exponential backoff
+REDDIT_MAX_RETRIES = int(os.getenv("REDDIT_MAX_RETRIES", "5"))
+REDDIT_BACKOFF_BASE = float(os.getenv("REDDIT_BACKOFF_BASE", "1"))
+REDDIT_BACKOFF_MAX = float(os.getenv("REDDIT_BACKOFF_MAX", "60"))
+# Below this many remaining requests in the window, calls are paced to last until the window resets
+REDDIT_QUOTA_RESERVE = int(os.getenv("REDDIT_QUOTA_RESERVE", "10"))
+
+
+class RedditGovernor:
+    """
+    Shared gate for every call made through the asyncpraw client.
+
+    Calls are paced by a token bucket. After each call the remaining/used/reset budget
+    reported in Reddit's rate-limit headers is read back from the client, and when the
+    remaining quota gets low the bucket is slowed down to stretch it until the window resets.
+    A 429, 5xx or network error is retried with jittered exponential backoff.
+
+    Attributes:
+    ----------
+    reddit : asyncpraw.Reddit
+        The client whose rate-limit state is read after each call.
+    bucket : TokenBucket
+        The bucket all calls take a token from.
+    max_retries : int
+        Number of retries before the error is raised to the caller.
+    """
+    def __init__(self, reddit=None, requests_per_minute=REDDIT_REQUESTS_PER_MINUTE, burst=REDDIT_BURST,
+                 max_retries=REDDIT_MAX_RETRIES, backoff_base=REDDIT_BACKOFF_BASE,
+                 backoff_max=REDDIT_BACKOFF_MAX, quota_reserve=REDDIT_QUOTA_RESERVE):
+        self.reddit = reddit
+        self.base_rate = requests_per_minute / 60
+        self.bucket = TokenBucket(self.base_rate, burst)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.quota_reserve = quota_reserve
+        self.remaining = None
+        self.used = None
+        self.reset_at = None
+        self.requests = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.server_errors = 0
+        self.throttle_seconds = 0.0
+
+    async def call(self, func, *args, **kwargs):
+        """
+        Awaits func(*args, **kwargs) once a token is available, retrying transient failures.
+        """
+        attempt = 0
+        while True:
+            waited = await self.bucket.acquire()
+            self.throttle_seconds += waited
+            metrics.observe("reddit_throttle_seconds", waited)
+            self.requests += 1
+            start = time.perf_counter()
+            try:
+                result = await func(*args, **kwargs)
+            except TooManyRequests as e:
+                error = e
+                self.rate_limited += 1
+                metrics.inc("reddit_requests_total", outcome="rate_limited")
+                # Nobody else should go through until the server lets us back in
+                self.bucket.drain()
+                delay = self._retry_after(e)
+            except (ServerError, RequestException) as e:
+                error = e
+                if isinstance(e, ServerError):
+                    self.server_errors += 1
+                    metrics.inc("reddit_requests_total", outcome="server_error")
+                else:
+                    metrics.inc("reddit_requests_total", outcome="network_error")
+                delay = None
+            else:
+                metrics.inc("reddit_requests_total", outcome="ok")
+                self._read_quota()
+                return result
+            finally:
+                metrics.observe("reddit_request_seconds", time.perf_counter() - start)
+
+            if attempt >= self.max_retries:
+                raise error
+            backoff = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+            delay = max(delay or 0, backoff)
+            attempt += 1
+            self.retries += 1
+            self.throttle_seconds += delay
+            print(f"Reddit call failed, retry {attempt}/{self.max_retries} in {delay:.1f} seconds...")
+            await asyncio.sleep(delay)
+
+    def _retry_after(self, error):
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None) or {}
+        try:
+            return float(headers.get("retry-after") or headers.get("x-ratelimit-reset"))
+        except (TypeError, ValueError):
+            return None
+
+    def _read_quota(self):
+        # asyncpraw keeps the x-ratelimit-* headers of the last response on the client
+        if self.reddit is None:
+            return
+        limits = self.reddit.auth.limits
+        self.remaining = limits.get("remaining")
+        self.used = limits.get("used")
+        self.reset_at = limits.get("reset_timestamp")
+        if self.remaining is not None:
+            metrics.set_gauge("reddit_quota_remaining", self.remaining)
+
+        if self.remaining is None:
+            return
+        if self.remaining > self.quota_reserve:
+            self.bucket.rate = self.base_rate
+        else:
+            # Spread what is left over the rest of the window, 10 minutes when Reddit didn't say
+            seconds_left = self.reset_at - time.time() if self.reset_at else 600
+            self.bucket.rate = max(self.remaining, 1) / max(seconds_left, 1)
+
+    def stats(self):
+        """
+        Returns the current quota and the throttling counters.
+        """
+        return {
+            "remaining": self.remaining,
+            "used": self.used,
+            "reset_in": round(self.reset_at - time.time(), 1) if self.reset_at else None,
+            "rate_per_minute": round(self.bucket.rate * 60, 2),
+            "requests": self.requests,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "server_errors": self.server_errors,
+            "throttle_seconds": round(self.throttle_seconds, 2),
+        }
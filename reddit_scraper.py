@@ -1,81 +1,205 @@
-import asyncpraw
-from datetime import datetime
-from dotenv import load_dotenv
-import os
-
-load_dotenv()
-
-REDDIT_CLIENT_ID = os.getenv("REDDIT_CLIENT_ID")
-REDDIT_CLIENT_SECRET = os.getenv("REDDIT_CLIENT_SECRET")
-REDDIT_USER_AGENT = os.getenv("REDDIT_USER_AGENT")
-
-# Step 1: Setup Reddit API Client using PRAW
-def reddit_client():
-    """
-    Creates a Reddit API client using PRAW.
-
-    Returns:
-    -------
-    praw.Reddit
-        The authenticated Reddit client object.
-    """
-    return asyncpraw.Reddit(
-        client_id=REDDIT_CLIENT_ID,  # Replace with your Reddit API client ID
-        client_secret=REDDIT_CLIENT_SECRET,  # Replace with your Reddit API client secret
-        user_agent=REDDIT_USER_AGENT,  # Replace with your user agent
-    )
-
-# Step 2: Function to Extract Data from Reddit Posts with Filter Options
-def extract_post_data(subreddit_name, limit=10, filter_type='new'):
-    """
-    Extracts title, text, time posted, and poster ID from Reddit posts based on a filter type.
-
-    Parameters:
-    ----------
-    subreddit_name : str
-        The name of the subreddit to extract data from (e.g., 'python').
-    limit : int, optional
-        The number of posts to extract (default is 10).
-    filter_type : str, optional
-        The type of filtering for subreddit posts: 'new', 'hot', 'top', 'rising' (default is 'new').
-
-    Returns:
-    -------
-    pd.DataFrame
-        A pandas DataFrame containing the extracted post data.
-    """
-    reddit = reddit_client()
-    subreddit = reddit.subreddit(subreddit_name)
-
-    # Initialize an empty list to store post data
-    post_data = []
-
-    # Filter posts based on the filter_type parameter
-    if filter_type == 'new':
-        posts = subreddit.new(limit=limit)
-    elif filter_type == 'hot':
-        posts = subreddit.hot(limit=limit)
-    elif filter_type == 'top':
-        posts = subreddit.top(limit=limit)
-    elif filter_type == 'rising':
-        posts = subreddit.rising(limit=limit)
-    else:
-        raise ValueError("Invalid filter_type. Use 'new', 'hot', 'top', or 'rising'.")
-
-    # Loop through the filtered posts and extract the necessary information
-    for post in posts:
-        post_info = {
-            'title': post.title,
-            'text': post.selftext,  # This is the post body
-            'time_posted': datetime.fromtimestamp(post.created_utc).strftime('%Y-%m-%d %H:%M:%S'),
-            'poster_id': post.author.name if post.author else 'N/A'  # Some posts may have deleted users
-        }
-        post_data.append(post_info)
-    return post_data
-
-# Example Usage
-if __name__ == "__main__":
-    import pprint
-    subreddit_name = 'python'  # Replace with the subreddit you want to scrape
-    data = extract_post_data(subreddit_name, limit=10, filter_type='hot')  # Change filter_type as needed
-    pprint.pprint(data)
+import asyncio
+import asyncpraw
+from datetime import datetime
+from dotenv import load_dotenv
+import os
+
+load_dotenv()
+
+REDDIT_CLIENT_ID = os.getenv("REDDIT_CLIENT_ID")
+REDDIT_CLIENT_SECRET = os.getenv("REDDIT_CLIENT_SECRET")
+REDDIT_USER_AGENT = os.getenv("REDDIT_USER_AGENT")
+# Optional overrides of the Reddit endpoints, e.g. to run against a local fake server
+REDDIT_OAUTH_URL = os.getenv("REDDIT_OAUTH_URL")
+REDDIT_URL = os.getenv("REDDIT_URL")
+
+FILTER_TYPES = ('new', 'hot', 'top', 'rising')
+# Reddit serves listings in pages of up to 100 posts
+LISTING_PAGE_SIZE = 100
+
+_reddit = None
+
+# Step 1: Setup Reddit API Client using PRAW
+def reddit_client():
+    """
+    Returns the Reddit API client shared by the whole process, creating it on first use.
+    Every caller goes through the same client and therefore the same HTTP session.
+
+    Returns:
+    -------
+    asyncpraw.Reddit
+        The authenticated Reddit client object.
+    """
+    global _reddit
+    if _reddit is None:
+        endpoints = {}
+        if REDDIT_OAUTH_URL:
+            endpoints["oauth_url"] = REDDIT_OAUTH_URL
+        if REDDIT_URL:
+            endpoints["reddit_url"] = REDDIT_URL
+        _reddit = asyncpraw.Reddit(
+            client_id=REDDIT_CLIENT_ID,
+            client_secret=REDDIT_CLIENT_SECRET,
+            user_agent=REDDIT_USER_AGENT,
+            **endpoints
+        )
+    return _reddit
+
+async def close_reddit_client():
+    """
+    Closes the shared Reddit client and its HTTP session.
+    """
+    global _reddit
+    if _reddit is not None:
+        await _reddit.close()
+        _reddit = None
+
+def get_listing(subreddit, filter_type='new', limit=10):
+    """
+    Returns the async listing of a subreddit for the given filter type.
+    """
+    if filter_type == 'new':
+        return subreddit.new(limit=limit)
+    elif filter_type == 'hot':
+        return subreddit.hot(limit=limit)
+    elif filter_type == 'top':
+        return subreddit.top(limit=limit)
+    elif filter_type == 'rising':
+        return subreddit.rising(limit=limit)
+    raise ValueError("Invalid filter_type. Use 'new', 'hot', 'top', or 'rising'.")
+
+def post_to_dict(post, filter_type='new'):
+    """
+    Converts a listing item into a plain dict without making any extra request.
+    """
+    return {
+        'id': post.id,
+        'fullname': post.name,
+        'subreddit': post.subreddit.display_name,
+        'filter_type': filter_type,
+        'title': post.title,
+        'text': post.selftext,  # This is the post body
+        'created_utc': post.created_utc,
+        'time_posted': datetime.fromtimestamp(post.created_utc).strftime('%Y-%m-%d %H:%M:%S'),
+        'poster_id': post.author.name if post.author else 'N/A',  # Some posts may have deleted users
+        'author_fullname': getattr(post, 'author_fullname', None),
+    }
+
+# Step 2: Function to Extract Data from Reddit Posts with Filter Options
+async def extract_post_data(subreddit_name, limit=10, filter_type='new', reddit=None, governor=None):
+    """
+    Async generator that yields title, text, time posted, and poster ID of Reddit posts based on a filter type.
+
+    Parameters:
+    ----------
+    subreddit_name : str
+        The name of the subreddit to extract data from (e.g., 'python').
+    limit : int, optional
+        The number of posts to extract (default is 10).
+    filter_type : str, optional
+        The type of filtering for subreddit posts: 'new', 'hot', 'top', 'rising' (default is 'new').
+    reddit : asyncpraw.Reddit, optional
+        The client to use (default is the shared client).
+    governor : RedditGovernor, optional
+        When given, a token is taken from its bucket before every page of the listing.
+
+    Yields:
+    ------
+    dict
+        One dict per post, see post_to_dict.
+    """
+    if filter_type not in FILTER_TYPES:
+        raise ValueError("Invalid filter_type. Use 'new', 'hot', 'top', or 'rising'.")
+
+    reddit = reddit or reddit_client()
+    subreddit = await reddit.subreddit(subreddit_name)
+
+    count = 0
+    if governor is not None:
+        await governor.bucket.acquire()
+    async for post in get_listing(subreddit, filter_type, limit):
+        yield post_to_dict(post, filter_type)
+        count += 1
+        # The next item comes from a new page request
+        if governor is not None and count % LISTING_PAGE_SIZE == 0:
+            await governor.bucket.acquire()
+
+async def stream_posts(subreddit_names, filter_types=('new',), limit=10, reddit=None, governor=None,
+                       concurrency=4, queue_size=100):
+    """
+    Async generator that reads many subreddits and filter types at once and yields posts as they arrive.
+
+    Each (subreddit, filter_type) listing is read by its own task, at most `concurrency` at
+    a time, into a bounded queue, so memory stays flat however many posts are read.
+
+    Parameters:
+    ----------
+    subreddit_names : list
+        The subreddits to read.
+    filter_types : tuple, optional
+        Filter types to read for every subreddit (default is ('new',)).
+    limit : int, optional
+        The number of posts per listing (default is 10).
+    concurrency : int, optional
+        Max number of listings read at the same time (default is 4).
+    queue_size : int, optional
+        Max number of posts buffered before readers wait (default is 100).
+
+    Yields:
+    ------
+    dict
+        One dict per post, see post_to_dict. Errors of a listing are printed and skipped.
+    """
+    for filter_type in filter_types:
+        if filter_type not in FILTER_TYPES:
+            raise ValueError("Invalid filter_type. Use 'new', 'hot', 'top', or 'rising'.")
+
+    reddit = reddit or reddit_client()
+    queue = asyncio.Queue(maxsize=queue_size)
+    semaphore = asyncio.Semaphore(concurrency)
+    done = object()
+
+    async def read(subreddit_name, filter_type):
+        try:
+            async with semaphore:
+                async for post_info in extract_post_data(subreddit_name, limit, filter_type, reddit, governor):
+                    await queue.put(post_info)
+        except asyncio.CancelledError:
+            # The consumer is gone and the queue may be full, nobody waits for the sentinel
+            raise
+        except Exception as e:
+            print(f"Error reading r/{subreddit_name} ({filter_type}): {e}")
+        await queue.put(done)
+
+    tasks = [
+        asyncio.create_task(read(subreddit_name, filter_type))
+        for subreddit_name in subreddit_names
+        for filter_type in filter_types
+    ]
+    remaining = len(tasks)
+    try:
+        while remaining:
+            post_info = await queue.get()
+            if post_info is done:
+                remaining -= 1
+            else:
+                yield post_info
+    finally:
+        # The consumer may stop early, don't leave readers blocked on a full queue
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+# Example Usage
+if __name__ == "__main__":
+    import pprint
+
+    async def main():
+        subreddit_names = ['python', 'learnpython']  # Replace with the subreddits you want to scrape
+        try:
+            async for post_info in stream_posts(subreddit_names, filter_types=('hot', 'new'), limit=10):
+                pprint.pprint(post_info)
+        finally:
+            await close_reddit_client()
+
+    asyncio.run(main())
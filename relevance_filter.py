@@ -0,0 +1,209 @@
+from collections import Counter
+from dotenv import load_dotenv
+import hashlib
+import json
+import math
+import metrics
+import os
+import re
+
+load_dotenv()
+
+# Posts scoring below the threshold skip the LLM, they are either stored without extraction or dropped
+RELEVANCE_THRESHOLD = float(os.getenv("RELEVANCE_THRESHOLD", "0.3"))
+RELEVANCE_ACTION = os.getenv("RELEVANCE_ACTION", "store")
+# Optional JSON file with per-category rules, see DEFAULT_RULES for the format
+RELEVANCE_RULES_FILE = os.getenv("RELEVANCE_RULES_FILE", "relevance_rules.json")
+# Optional JSON file with the per-category hashed-feature models written by HashedLinearModel.save()
+RELEVANCE_MODEL_FILE = os.getenv("RELEVANCE_MODEL_FILE", "relevance_model.json")
+HASHED_FEATURES = 2 ** 18
+
+# Scores are summed as log-odds, so +1 roughly means "almost three times as likely to be worth it"
+DEFAULT_RULES = {
+    "*": {
+        "patterns": {
+            r"\?": 1.0,
+            r"\b(how (do|can|should) i|any (advice|tips|recommendations)|help|struggling|stuck|beginner)\b": 1.5,
+            r"\b(what|which|where|why) (is|are|should|would)\b": 0.5,
+        },
+        "negative_patterns": {
+            r"\b(meme|shitpost|giveaway|upvote|karma|lol|lmao)\b": -1.5,
+            r"^\s*https?://\S+\s*$": -2.0,
+        },
+        "empty_text": -1.5,
+        "bias": -0.5,
+    },
+    "Teaching Python": {
+        "keywords": {"python": 1.0, "code": 0.5, "error": 1.0, "learn": 0.5, "function": 0.5, "loop": 0.5, "pandas": 0.5},
+    },
+    "SaaS Development": {
+        "keywords": {"saas": 1.0, "startup": 0.5, "mvp": 1.0, "customers": 0.5, "pricing": 0.5, "marketing": 0.5, "launch": 0.5},
+    },
+}
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+def hashed_features(text, n_features=HASHED_FEATURES):
+    """
+    Maps the unigrams and bigrams of a text to a sparse {index: value} vector with the hashing trick.
+    Values are log-scaled term counts with a hashed sign, so collisions tend to cancel out.
+    """
+    tokens = tokenize(text)
+    terms = Counter(tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])])
+    features = {}
+    for term, count in terms.items():
+        digest = int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+        index = (digest >> 1) % n_features
+        sign = 1.0 if digest & 1 else -1.0
+        features[index] = features.get(index, 0.0) + sign * math.log1p(count)
+    return features
+
+
+class HashedLinearModel:
+    """
+    Small logistic regression over hashed text features, one per category.
+
+    Attributes:
+    ----------
+    weights : dict
+        Sparse {feature index: weight}.
+    bias : float
+        Intercept, in log-odds.
+    """
+    def __init__(self, weights=None, bias=0.0, n_features=HASHED_FEATURES):
+        self.weights = weights or {}
+        self.bias = bias
+        self.n_features = n_features
+
+    def decision(self, features):
+        """
+        Returns the log-odds of a feature vector.
+        """
+        return self.bias + sum(self.weights.get(index, 0.0) * value for index, value in features.items())
+
+    def fit(self, texts, labels, epochs=5, learning_rate=0.1, l2=1e-4):
+        """
+        Trains with plain SGD on texts labeled 1 (worth an extraction) or 0 (noise).
+        """
+        examples = [(hashed_features(text, self.n_features), label) for text, label in zip(texts, labels)]
+        for _ in range(epochs):
+            for features, label in examples:
+                error = label - 1 / (1 + math.exp(-self.decision(features)))
+                self.bias += learning_rate * error
+                for index, value in features.items():
+                    weight = self.weights.get(index, 0.0)
+                    self.weights[index] = weight + learning_rate * (error * value - l2 * weight)
+        return self
+
+    def to_dict(self):
+        return {"bias": self.bias, "n_features": self.n_features, "weights": {str(k): v for k, v in self.weights.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls({int(k): v for k, v in data["weights"].items()}, data["bias"], data.get("n_features", HASHED_FEATURES))
+
+
+def save_models(models, path=RELEVANCE_MODEL_FILE):
+    """
+    Writes {category: HashedLinearModel} to a JSON file.
+    """
+    with open(path, "w") as f:
+        json.dump({category: model.to_dict() for category, model in models.items()}, f)
+
+def load_json(path):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return None
+
+
+class RelevanceFilter:
+    """
+    Cheap local scoring stage that runs before the LLM extraction.
+
+    A post's score is the sum, in log-odds, of the keyword and regex rules of the '*' entry and
+    of its category, plus the category's hashed-feature model if one was trained, squashed to
+    [0, 1]. Posts scoring below threshold are not worth a paid extraction.
+
+    Attributes:
+    ----------
+    threshold : float
+        Minimum score for a post to be extracted.
+    action : str
+        What happens to a low-scoring post: 'store' saves it without extraction, 'drop' discards it.
+    rules : dict
+        Rules per category, '*' applies to every category.
+    models : dict
+        HashedLinearModel per category.
+    """
+    def __init__(self, threshold=RELEVANCE_THRESHOLD, action=RELEVANCE_ACTION, rules=None, models=None):
+        if action not in ("store", "drop"):
+            raise ValueError("Invalid action. Use 'store' or 'drop'.")
+        self.threshold = threshold
+        self.action = action
+        self.rules = rules if rules is not None else (load_json(RELEVANCE_RULES_FILE) or DEFAULT_RULES)
+        if models is None:
+            models = {category: HashedLinearModel.from_dict(data)
+                      for category, data in (load_json(RELEVANCE_MODEL_FILE) or {}).items()}
+        self.models = models
+        self._compiled = {
+            category: [
+                (re.compile(pattern, re.IGNORECASE | re.MULTILINE), weight)
+                for key in ("patterns", "negative_patterns")
+                for pattern, weight in rule.get(key, {}).items()
+            ]
+            for category, rule in self.rules.items()
+        }
+        self.scored = Counter()
+        self.filtered = Counter()
+
+    def score(self, title, content, category):
+        """
+        Returns the relevance of a post between 0 and 1.
+        """
+        text = f"{title}\n{content or ''}"
+        tokens = set(tokenize(text))
+        logit = 0.0
+        for rule_key in ("*", category):
+            rule = self.rules.get(rule_key)
+            if rule is None:
+                continue
+            logit += rule.get("bias", 0.0)
+            if not (content or "").strip():
+                logit += rule.get("empty_text", 0.0)
+            logit += sum(weight for keyword, weight in rule.get("keywords", {}).items() if keyword in tokens)
+            logit += sum(weight for pattern, weight in self._compiled[rule_key] if pattern.search(text))
+
+        model = self.models.get(category)
+        if model is not None:
+            logit += model.decision(hashed_features(text, model.n_features))
+        return 1 / (1 + math.exp(-max(min(logit, 30), -30)))
+
+    def is_relevant(self, title, content, category):
+        """
+        Scores a post, counts it, and returns (relevant, score).
+        """
+        score = self.score(title, content, category)
+        self.scored[category] += 1
+        relevant = score >= self.threshold
+        metrics.inc("relevance_posts_total", category=category, result="relevant" if relevant else "filtered")
+        if not relevant:
+            self.filtered[category] += 1
+        return relevant, score
+
+    def stats(self):
+        """
+        Returns the number of scored posts and the filter rate of each category.
+        """
+        return {
+            category: {
+                "scored": self.scored[category],
+                "filtered": self.filtered[category],
+                "filter_rate": round(self.filtered[category] / self.scored[category], 3),
+            }
+            for category in self.scored
+        }
@@ -0,0 +1,168 @@
+import asyncio
+from collections import deque
+from dotenv import load_dotenv
+import heapq
+import itertools
+import os
+import time
+
+load_dotenv()
+
+# Bounds of the interval between two polls of the same subreddit, in seconds
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "60"))
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", "3600"))
+# Number of new posts we aim to find per poll, busier subreddits get polled more often to match it
+POLL_TARGET_POSTS = float(os.getenv("POLL_TARGET_POSTS", "5"))
+# Weight of the latest observation in the smoothed arrival rate
+POLL_RATE_SMOOTHING = float(os.getenv("POLL_RATE_SMOOTHING", "0.3"))
+# Polls allowed per minute across all subreddits, kept below Reddit's 100 requests per minute
+POLL_BUDGET_PER_MINUTE = int(os.getenv("POLL_BUDGET_PER_MINUTE", "60"))
+
+
+class PollScheduler:
+    """
+    Decides which subreddit to poll next from the observed post arrival rate of each one.
+
+    Every subreddit sits in a priority queue ordered by its next poll time. After a poll its
+    smoothed arrival rate (posts per second) is updated and the next poll is scheduled when
+    about target_posts new posts are expected, within [min_interval, max_interval]. All polls
+    share a budget of budget_per_minute, so a burst of due subreddits is spread out instead of
+    tripping Reddit's rate limit.
+
+    Attributes:
+    ----------
+    min_interval : float
+        Shortest time between two polls of a subreddit, in seconds.
+    max_interval : float
+        Longest time between two polls of a subreddit, in seconds.
+    target_posts : float
+        Number of new posts expected per poll.
+    smoothing : float
+        Weight of the latest observation in the arrival rate.
+    budget_per_minute : int
+        Max number of polls started in any 60 second window.
+    """
+    def __init__(self, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL,
+                 target_posts=POLL_TARGET_POSTS, smoothing=POLL_RATE_SMOOTHING,
+                 budget_per_minute=POLL_BUDGET_PER_MINUTE):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_posts = target_posts
+        self.smoothing = smoothing
+        self.budget_per_minute = budget_per_minute
+        self._heap = []
+        self._counter = itertools.count()
+        self._state = {}
+        self._recent_polls = deque()
+        self._wakeup = asyncio.Event()
+
+    def add(self, key, payload=None, delay=0):
+        """
+        Registers a subreddit, first polled after delay seconds.
+        """
+        self._state[key] = {"payload": payload, "rate": None, "last_poll": None, "interval": None, "entry": None}
+        self._push(key, time.time() + delay)
+
+    def remove(self, key):
+        """
+        Stops scheduling a subreddit. A poll already handed out is not recorded anymore.
+        """
+        self._state.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._state
+
+    def _push(self, key, when):
+        # Only the latest heap entry of a key counts, so a subreddit removed and added again isn't polled twice
+        entry = next(self._counter)
+        self._state[key]["entry"] = entry
+        heapq.heappush(self._heap, (when, entry, key))
+        self._wakeup.set()
+
+    def _budget_wait(self, now):
+        while self._recent_polls and now - self._recent_polls[0] >= 60:
+            self._recent_polls.popleft()
+        if len(self._recent_polls) < self.budget_per_minute:
+            return 0
+        return 60 - (now - self._recent_polls[0])
+
+    async def next_due(self):
+        """
+        Waits until a subreddit is due and the shared budget allows a poll, then returns (key, payload).
+        The subreddit is not handed out again until record() was called for it.
+        """
+        while True:
+            now = time.time()
+            # Drop entries of subreddits that were removed or rescheduled
+            while self._heap and (self._heap[0][2] not in self._state
+                                  or self._state[self._heap[0][2]]["entry"] != self._heap[0][1]):
+                heapq.heappop(self._heap)
+
+            wait = self.max_interval
+            if self._heap:
+                wait = max(self._heap[0][0] - now, self._budget_wait(now))
+                if wait <= 0:
+                    _, _, key = heapq.heappop(self._heap)
+                    self._recent_polls.append(now)
+                    return key, self._state[key]["payload"]
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def record(self, key, created_utcs, overflow=False):
+        """
+        Records the result of a poll and schedules the next one.
+
+        Parameters:
+        ----------
+        key : str
+            The subreddit that was polled.
+        created_utcs : list
+            Creation times of the posts that arrived since the previous poll.
+        overflow : bool
+            True if the poll hit its page limit, so posts may have been missed.
+        """
+        state = self._state.get(key)
+        if state is None:
+            return
+
+        now = time.time()
+        if state["last_poll"] is not None:
+            observed = len(created_utcs) / max(now - state["last_poll"], 1)
+        elif len(created_utcs) >= 2:
+            # First poll: estimate the rate from the spread of the posts we got
+            observed = (len(created_utcs) - 1) / max(max(created_utcs) - min(created_utcs), 1)
+        else:
+            observed = 0.0
+
+        if state["rate"] is None:
+            state["rate"] = observed
+        else:
+            state["rate"] = self.smoothing * observed + (1 - self.smoothing) * state["rate"]
+        state["last_poll"] = now
+
+        if overflow:
+            interval = self.min_interval
+        elif state["rate"] > 0:
+            interval = self.target_posts / state["rate"]
+        else:
+            interval = self.max_interval
+        state["interval"] = min(max(interval, self.min_interval), self.max_interval)
+
+        self._push(key, now + state["interval"])
+        print(f"r/{key}: {len(created_utcs)} new posts, next poll in {round(state['interval'])} seconds.")
+
+    def stats(self):
+        """
+        Returns the smoothed arrival rate (posts per hour) and poll interval of every subreddit.
+        """
+        return {
+            key: {
+                "posts_per_hour": round((state["rate"] or 0) * 3600, 2),
+                "interval": state["interval"],
+            }
+            for key, state in self._state.items()
+        }
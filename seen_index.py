@@ -0,0 +1,127 @@
+from bson import ObjectId
+from collections import OrderedDict
+from dotenv import load_dotenv
+from db import Post
+import datetime
+import hashlib
+import math
+import os
+
+load_dotenv()
+
+# Number of post IDs the Bloom filter is sized for and its target false positive rate
+SEEN_INDEX_CAPACITY = int(os.getenv("SEEN_INDEX_CAPACITY", "2000000"))
+SEEN_INDEX_ERROR_RATE = float(os.getenv("SEEN_INDEX_ERROR_RATE", "0.001"))
+# Number of most recent post IDs also kept in an exact set
+SEEN_INDEX_RECENT_SIZE = int(os.getenv("SEEN_INDEX_RECENT_SIZE", "50000"))
+# Only load posts fetched in the last N days at startup, 0 loads all of them
+SEEN_INDEX_WINDOW_DAYS = int(os.getenv("SEEN_INDEX_WINDOW_DAYS", "0"))
+
+
+class BloomFilter:
+    """
+    Compact probabilistic set of strings. Never gives a false negative, and gives
+    a false positive with roughly error_rate probability until capacity items are added.
+
+    Attributes:
+    ----------
+    num_bits : int
+        Size of the bit array.
+    num_hashes : int
+        Number of bit positions set per item.
+    """
+    def __init__(self, capacity=SEEN_INDEX_CAPACITY, error_rate=SEEN_INDEX_ERROR_RATE):
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, item):
+        # Double hashing: derive all positions from the two halves of one digest
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, item):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class SeenIndex:
+    """
+    In-memory index of the reddit_post_ids already stored, used to skip duplicates without a query.
+
+    The IDs of the most recent posts are kept in an exact set and every loaded or saved ID
+    goes into a Bloom filter. An ID in neither is new for sure; an ID only matched by the
+    Bloom filter is a probable match that has to be confirmed against the database.
+
+    Attributes:
+    ----------
+    loaded : bool
+        False until load() ran. Before that every ID is treated as a probable match.
+    recent_size : int
+        Max number of IDs kept in the exact set.
+    window_days : int
+        Age limit of the posts loaded at startup, 0 loads every post.
+    """
+    def __init__(self, capacity=SEEN_INDEX_CAPACITY, error_rate=SEEN_INDEX_ERROR_RATE,
+                 recent_size=SEEN_INDEX_RECENT_SIZE, window_days=SEEN_INDEX_WINDOW_DAYS):
+        self.loaded = False
+        self.recent_size = recent_size
+        self.window_days = window_days
+        self.db_checks = 0
+        self.false_positives = 0
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._recent = OrderedDict()
+
+    def load(self):
+        """
+        Loads the known reddit_post_ids from the database, newest last so they end up in the exact set.
+        """
+        # Walked in _id order, i.e. fetch order, on the _id index, time_created has no index of its own to sort on
+        query = {}
+        if self.window_days:
+            since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=self.window_days)
+            query["_id"] = {"$gte": ObjectId.from_datetime(since)}
+
+        count = 0
+        cursor = Post._get_collection().find(query, {"reddit_post_id": 1, "_id": 0}).sort("_id", 1)
+        for doc in cursor.batch_size(10000):
+            self.add(doc["reddit_post_id"])
+            count += 1
+        self.loaded = True
+        print(f"Seen index loaded with {count} post IDs.")
+
+    def add(self, reddit_post_id):
+        """
+        Records a saved post.
+        """
+        self._bloom.add(reddit_post_id)
+        self._recent[reddit_post_id] = None
+        self._recent.move_to_end(reddit_post_id)
+        if len(self._recent) > self.recent_size:
+            self._recent.popitem(last=False)
+
+    def check(self, reddit_post_id):
+        """
+        Returns True if the post was seen, False if it is new, and None if only the database can tell.
+        """
+        if reddit_post_id in self._recent:
+            return True
+        if self.loaded and reddit_post_id not in self._bloom:
+            return False
+        return None
+
+    def confirm(self, reddit_post_id):
+        """
+        Resolves a probable match with a database query and remembers the answer if it was seen.
+        """
+        self.db_checks += 1
+        if Post.objects(reddit_post_id=reddit_post_id).only("id").first() is not None:
+            self.add(reddit_post_id)
+            return True
+        self.false_positives += 1
+        return False
@@ -0,0 +1,216 @@
+import asyncio
+import bisect
+from db import SubredditLease, WorkerLease
+from dotenv import load_dotenv
+import datetime
+import hashlib
+import os
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+import socket
+import time
+
+load_dotenv()
+
+# Run several aggregator processes, each polling its own share of the subreddits
+SHARDING_ENABLED = os.getenv("SHARDING_ENABLED", "false").lower() == "true"
+# Must be unique per process and stable across restarts, so set it when running several workers on one host
+WORKER_ID = os.getenv("WORKER_ID") or socket.gethostname()
+# A worker or subreddit lease not renewed for this long is taken over by the others
+SHARD_LEASE_TTL = float(os.getenv("SHARD_LEASE_TTL", "30"))
+SHARD_HEARTBEAT_INTERVAL = float(os.getenv("SHARD_HEARTBEAT_INTERVAL", "10"))
+# Points per worker on the hash ring, more points spread the subreddits more evenly
+SHARD_VNODES = int(os.getenv("SHARD_VNODES", "64"))
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except (OSError, TypeError):
+        return False
+    return True
+
+
+class HashRing:
+    """
+    Consistent hash ring mapping keys to nodes.
+
+    Each node is placed vnodes times on the ring and a key belongs to the first node point
+    after its own hash, so adding or removing a node only moves about 1/N of the keys.
+
+    Attributes:
+    ----------
+    nodes : list
+        The nodes on the ring, sorted.
+    vnodes : int
+        Number of points per node.
+    """
+    def __init__(self, nodes=(), vnodes=SHARD_VNODES):
+        self.nodes = sorted(set(nodes))
+        self.vnodes = vnodes
+        self._points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self._hashes = [point for point, _ in self._points]
+
+    def owner(self, key):
+        """
+        Returns the node a key belongs to, or None if the ring is empty.
+        """
+        if not self._points:
+            return None
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._points)
+        return self._points[index][1]
+
+
+class ShardCoordinator:
+    """
+    Keeps this worker's share of the subreddits up to date.
+
+    Workers register themselves in the 'worker_leases' collection and renew their lease on
+    every heartbeat. Each heartbeat places the live workers on a HashRing, and each worker
+    takes the subreddits the ring assigns to it. A subreddit lease in the 'subreddit_leases'
+    collection makes sure only one worker polls a subreddit, even while a rebalance is in
+    progress. When a worker joins, the others release its share on their next heartbeat.
+    When a worker dies, its leases expire after lease_ttl and its share is picked up by the
+    others.
+
+    Attributes:
+    ----------
+    subreddits : dict
+        Payload of every configured subreddit, keyed by subreddit name.
+    worker_id : str
+        Identifier of this worker.
+    lease_ttl : float
+        Seconds a lease stays valid without renewal.
+    heartbeat_interval : float
+        Seconds between two heartbeats.
+    owned : set
+        Names of the subreddits this worker currently holds a lease on.
+    """
+    def __init__(self, subreddits, worker_id=WORKER_ID, lease_ttl=SHARD_LEASE_TTL,
+                 heartbeat_interval=SHARD_HEARTBEAT_INTERVAL, vnodes=SHARD_VNODES):
+        self.subreddits = subreddits
+        self.worker_id = worker_id
+        self.lease_ttl = lease_ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.vnodes = vnodes
+        self.owned = set()
+        self.workers = []
+        self._pid = os.getpid()
+        self._host = socket.gethostname()
+
+    def _now(self):
+        return datetime.datetime.now(datetime.timezone.utc)
+
+    def join(self):
+        """
+        Registers this worker. Raises a RuntimeError if a live worker already uses the same worker_id.
+        """
+        now = self._now()
+        cutoff = now - datetime.timedelta(seconds=self.lease_ttl)
+        existing = WorkerLease._get_collection().find_one({"worker_id": self.worker_id, "heartbeat_at": {"$gte": cutoff}})
+        if existing is not None and existing.get("pid") != self._pid and (
+            existing.get("host") != self._host or _pid_alive(existing.get("pid"))
+        ):
+            raise RuntimeError(f"Worker {self.worker_id} is already running on {existing.get('host')}, set WORKER_ID.")
+        WorkerLease._get_collection().update_one(
+            {"worker_id": self.worker_id},
+            {"$set": {"host": self._host, "pid": self._pid, "heartbeat_at": now}, "$setOnInsert": {"started_at": now}},
+            upsert=True
+        )
+
+    def heartbeat(self):
+        """
+        Renews this worker's lease, recomputes its share and takes or releases subreddit leases to match.
+
+        Returns:
+        -------
+        tuple
+            (acquired, released) sets of subreddit names.
+        """
+        now = self._now()
+        expires_at = now + datetime.timedelta(seconds=self.lease_ttl)
+        workers = WorkerLease._get_collection()
+        workers.update_one({"worker_id": self.worker_id}, {"$set": {"heartbeat_at": now}})
+        cutoff = now - datetime.timedelta(seconds=self.lease_ttl)
+        self.workers = sorted(
+            {doc["worker_id"] for doc in workers.find({"heartbeat_at": {"$gte": cutoff}}, {"worker_id": 1})}
+            | {self.worker_id}
+        )
+        ring = HashRing(self.workers, self.vnodes)
+        assigned = {name for name in self.subreddits if ring.owner(name.lower()) == self.worker_id}
+
+        leases = SubredditLease._get_collection()
+        released = self.owned - assigned
+        if released:
+            leases.delete_many({"owner": self.worker_id, "subreddit": {"$in": [name.lower() for name in released]}})
+
+        # Renew every lease this worker still holds in one write, only the missing ones are claimed one by one
+        names = [name.lower() for name in assigned]
+        leases.update_many({"owner": self.worker_id, "subreddit": {"$in": names}}, {"$set": {"expires_at": expires_at}})
+        held = {doc["subreddit"] for doc in leases.find({"owner": self.worker_id, "subreddit": {"$in": names}}, {"subreddit": 1})}
+
+        acquired = set()
+        for name in assigned:
+            if name.lower() in held:
+                if name not in self.owned:
+                    acquired.add(name)
+                continue
+            try:
+                lease = leases.find_one_and_update(
+                    {"subreddit": name.lower(), "$or": [{"owner": self.worker_id}, {"expires_at": {"$lt": now}}]},
+                    {"$set": {"owner": self.worker_id, "expires_at": expires_at}},
+                    upsert=True, return_document=ReturnDocument.AFTER
+                )
+            except DuplicateKeyError:
+                # Still held by the previous owner, it is released on its next heartbeat or expires
+                lease = None
+            if lease is not None and name not in self.owned:
+                acquired.add(name)
+            elif lease is None and name in self.owned:
+                released.add(name)
+
+        self.owned = (self.owned | acquired) - released
+        return acquired, released
+
+    async def run(self, scheduler, on_acquire=None):
+        """
+        Heartbeats forever, adding the subreddits this worker takes to the scheduler and removing
+        the ones it gives up. on_acquire, if given, is awaited with the acquired names first.
+        Call join() once before.
+        """
+        last_heartbeat = time.monotonic()
+        while True:
+            try:
+                acquired, released = await asyncio.to_thread(self.heartbeat)
+            except Exception as e:
+                print(f"Shard heartbeat failed: {e}")
+                # Without renewals our leases lapse and other workers take over, so stop polling too
+                if self.owned and time.monotonic() - last_heartbeat >= self.lease_ttl:
+                    print(f"Worker {self.worker_id} lost its leases, pausing its {len(self.owned)} subreddits.")
+                    for name in self.owned:
+                        scheduler.remove(name)
+                    self.owned = set()
+            else:
+                last_heartbeat = time.monotonic()
+                if acquired and on_acquire is not None:
+                    await on_acquire(acquired)
+                for name in released:
+                    scheduler.remove(name)
+                for name in acquired:
+                    scheduler.add(name, self.subreddits[name])
+                if acquired or released:
+                    print(f"Worker {self.worker_id} of {len(self.workers)}: +{len(acquired)} -{len(released)} "
+                          f"subreddits, now polling {len(self.owned)}.")
+            await asyncio.sleep(self.heartbeat_interval)
+
+    def leave(self):
+        """
+        Releases every lease of this worker so the others take its share over right away.
+        """
+        SubredditLease._get_collection().delete_many({"owner": self.worker_id})
+        WorkerLease._get_collection().delete_one({"worker_id": self.worker_id})
+        self.owned = set()
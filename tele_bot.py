@@ -1,66 +1,289 @@
-from telegram import Bot
-from telegram.constants import ParseMode
-import os
-from dotenv import load_dotenv
-import re
-
-load_dotenv()
-
-TELEGRAM_BOT_PYTHON_GUIDANCE_API_KEY = os.getenv("TELEGRAM_BOT_PYTHON_GUIDANCE_API_KEY")
-TELEGRAM_BOT_SAAS_CREATION_API_KEY = os.getenv("TELEGRAM_BOT_SAAS_CREATION_API_KEY")
-
-
-py_bot = Bot(token=TELEGRAM_BOT_PYTHON_GUIDANCE_API_KEY)
-saas_bot = Bot(token=TELEGRAM_BOT_SAAS_CREATION_API_KEY)
-
-def escape_html(text):
-    """
-    Escape special characters for HTML formatting in Telegram.
-    """
-    return re.sub(r'([&<>])', lambda x: {'&': '&amp;', '<': '&lt;', '>': '&gt;'}.get(x.group(), x.group()), text)
-
-async def send_to_telegram(chat_id, extracted_data, category):
-    """
-    Sends a formatted HTML message to the specified Telegram chat using the extracted_data object.
-    """
-    title = escape_html(extracted_data.get('title', 'N/A'))
-    topics = escape_html(', '.join(extracted_data.get('topics_discussed', [])))
-    sentiment = escape_html(', '.join(extracted_data.get('sentiment', [])))
-    action_to_take = escape_html(', '.join(extracted_data.get('actions_next_steps', [])))
-    suggested_response = escape_html(extracted_data.get('suggested_responses', ['No response available'])[0])
-    summary = escape_html(extracted_data.get('summary', 'No summary available'))
-    post_url = f"https://www.reddit.com/r/{extracted_data["subreddit"]}/comments/{escape_html(extracted_data.get('reddit_post_id', ''))}"
-
-    message = (
-        f"<b>Title</b>: {title}\n"
-        f"<b>Topics</b>: {topics}\n"
-        f"<b>Sentiment</b>: {sentiment}\n"
-        f"<b>Action To Take</b>: {action_to_take}\n"
-        f"<b>Suggested Response</b>: {suggested_response}\n"
-        f"<b>Summary</b>: {summary}\n"
-        f"<b>Post URL</b>: {post_url}"
-    )
-    if category == "Teaching Python":
-        await py_bot.send_message(chat_id=chat_id, text=message, parse_mode=ParseMode.HTML)
-    elif category == "SaaS Development":
-        await saas_bot.send_message(chat_id=chat_id, text=message, parse_mode=ParseMode.HTML)
-
-# Example usage
-if __name__ == "__main__":
-    import asyncio
-
-    async def main():
-        chat_id = "5871291837"  # Replace with your chat_id
-        chat_id2 = "5871291837"
-        extracted_data = {
-            "title": "Example Post",
-            "topics_discussed": ["Topic 1", "Topic 2"],
-            "sentiment": ["positive"],
-            "actions_next_steps": ["Engage with community"],
-            "suggested_responses": ["This is a helpful response."],
-            "summary": "This post discusses AI and ML trends.",
-            "reddit_post_id": "t3_abc123"
-        }
-        await send_to_telegram(chat_id, extracted_data)
-
-    asyncio.run(main())
+import asyncio
+from bot_routes import get_registry
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from dotenv import load_dotenv
+from rate_limit import TokenBucket
+import metrics
+import os
+import re
+import time
+
+load_dotenv()
+
+# Telegram allows about 20 messages per minute in a group chat and 30 per second per bot
+TELEGRAM_MESSAGES_PER_MINUTE = float(os.getenv("TELEGRAM_MESSAGES_PER_MINUTE", "20"))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_BOT_MESSAGES_PER_SECOND = float(os.getenv("TELEGRAM_BOT_MESSAGES_PER_SECOND", "25"))
+# Alerts arriving within this many seconds of each other are merged into one digest message
+TELEGRAM_DIGEST_WINDOW = float(os.getenv("TELEGRAM_DIGEST_WINDOW", "3"))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "5"))
+TELEGRAM_QUEUE_SIZE = int(os.getenv("TELEGRAM_QUEUE_SIZE", "1000"))
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+DIGEST_SEPARATOR = "\n\n" + "─" * 12 + "\n\n"
+
+
+def escape_html(text):
+    """
+    Escape special characters for HTML formatting in Telegram.
+    """
+    return re.sub(r'([&<>])', lambda x: {'&': '&amp;', '<': '&lt;', '>': '&gt;'}.get(x.group(), x.group()), text)
+
+def format_message(extracted_data):
+    """
+    Formats the extracted_data object as the HTML alert sent to Telegram.
+    """
+    title = escape_html(extracted_data.get('title', 'N/A'))
+    topics = escape_html(', '.join(extracted_data.get('topics_discussed', [])))
+    sentiment = escape_html(', '.join(extracted_data.get('sentiment', [])))
+    action_to_take = escape_html(', '.join(extracted_data.get('actions_next_steps', [])))
+    suggested_response = escape_html((extracted_data.get('suggested_responses') or ['No response available'])[0])
+    summary = escape_html(extracted_data.get('summary', 'No summary available'))
+    post_url = f"https://www.reddit.com/r/{extracted_data['subreddit']}/comments/{escape_html(extracted_data.get('reddit_post_id', ''))}"
+
+    return (
+        f"<b>Title</b>: {title}\n"
+        f"<b>Topics</b>: {topics}\n"
+        f"<b>Sentiment</b>: {sentiment}\n"
+        f"<b>Action To Take</b>: {action_to_take}\n"
+        f"<b>Suggested Response</b>: {suggested_response}\n"
+        f"<b>Summary</b>: {summary}\n"
+        f"<b>Post URL</b>: {post_url}"
+    )
+
+async def send_to_telegram(chat_id, extracted_data, category):
+    """
+    Sends a formatted HTML message to the chats routed to the category using the extracted_data object.
+    chat_id is used when the category's route doesn't list its own chats.
+    """
+    bot, chat_ids = get_registry().resolve(category, chat_id)
+    for route_chat_id in chat_ids:
+        await bot.send_message(chat_id=route_chat_id, text=format_message(extracted_data), parse_mode=ParseMode.HTML)
+
+def split_message(message, limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    Splits a message on line boundaries into parts of at most limit characters.
+    A single line longer than limit is cut, without leaving half an HTML entity behind.
+    """
+    parts, current = [], ""
+    for line in message.split("\n"):
+        if len(line) > limit:
+            line = re.sub(r"&[a-z]*$", "", line[:limit - 1]) + "…"
+        if current and len(current) + 1 + len(line) > limit:
+            parts.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        parts.append(current)
+    return parts
+
+def build_digest_groups(messages, limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    Merges alerts into as few messages as possible, each at most limit characters long.
+    Returns (digest, indexes of the alerts it holds) tuples, an alert split over several digests is in each.
+    """
+    groups = []
+    for index, message in enumerate(messages):
+        for part in split_message(message, limit):
+            if groups and len(groups[-1][0]) + len(DIGEST_SEPARATOR) + len(part) <= limit:
+                groups[-1] = (groups[-1][0] + DIGEST_SEPARATOR + part, groups[-1][1] | {index})
+            else:
+                groups.append((part, {index}))
+    return groups
+
+def build_digests(messages, limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    Merges alerts into as few messages as possible, each at most limit characters long.
+    """
+    return [digest for digest, _ in build_digest_groups(messages, limit)]
+
+
+class TelegramDispatcher:
+    """
+    Outbound delivery of alerts, decoupled from ingestion.
+
+    enqueue() never waits: every (bot, chat) pair gets its own queue and worker task. The
+    worker collects the alerts that arrive within digest_window seconds of each other and
+    sends them as digest messages within Telegram's 4096 character limit, paced by a token
+    bucket per chat plus one per bot. Flood-control errors (RetryAfter) are retried after the
+    delay Telegram asks for, network errors with exponential backoff, while a BadRequest or
+    Forbidden drops the digest at once. When a queue is full the oldest alert is dropped so
+    ingestion is never blocked.
+
+    Attributes:
+    ----------
+    registry : BotRegistry
+        Picks the bot and chats of each category.
+    messages_per_minute : float
+        Steady send rate allowed per chat.
+    digest_window : float
+        Seconds to wait for more alerts before sending a digest.
+    max_retries : int
+        Retries of a failed send before the digest is dropped. BadRequest and Forbidden are never retried.
+    sent, digests, retries, dropped, failed : int
+        Alerts delivered, messages sent, send retries, alerts dropped on full queues, digests given up.
+    """
+    def __init__(self, registry=None, messages_per_minute=TELEGRAM_MESSAGES_PER_MINUTE, bot_messages_per_second=TELEGRAM_BOT_MESSAGES_PER_SECOND,
+                 digest_window=TELEGRAM_DIGEST_WINDOW, max_retries=TELEGRAM_MAX_RETRIES, queue_size=TELEGRAM_QUEUE_SIZE):
+        self.registry = registry or get_registry()
+        self.messages_per_minute = messages_per_minute
+        self.bot_messages_per_second = bot_messages_per_second
+        self.digest_window = digest_window
+        self.max_retries = max_retries
+        self.queue_size = queue_size
+        self.sent = 0
+        self.digests = 0
+        self.retries = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queues = {}
+        self._workers = {}
+        metrics.register_gauge("telegram_queue_depth", lambda: sum(queue.qsize() for queue in self._queues.values()))
+        self._chat_buckets = {}
+        self._bot_buckets = {}
+
+    def enqueue(self, chat_id, extracted_data, category, on_sent=None):
+        """
+        Queues an alert for every chat routed to the category and returns right away.
+        chat_id is used when the route doesn't list its own chats. Returns False if the category has no route.
+        on_sent, if given, is called without arguments every time the alert went out to one of the chats.
+        """
+        bot, chat_ids = self.registry.resolve(category, chat_id)
+        if bot is None:
+            return False
+
+        message = format_message(extracted_data)
+        for route_chat_id in chat_ids:
+            key = (bot.token, route_chat_id)
+            if key not in self._queues:
+                self._queues[key] = asyncio.Queue(maxsize=self.queue_size)
+                self._chat_buckets[key] = TokenBucket(self.messages_per_minute / 60, TELEGRAM_CHAT_BURST)
+                self._bot_buckets.setdefault(bot.token, TokenBucket(self.bot_messages_per_second))
+                self._workers[key] = asyncio.create_task(self._worker(key, bot, route_chat_id))
+
+            queue = self._queues[key]
+            if queue.full():
+                queue.get_nowait()
+                queue.task_done()
+                self.dropped += 1
+                metrics.inc("telegram_alerts_total", outcome="dropped")
+                print(f"Telegram queue of chat {route_chat_id} is full, dropped the oldest alert.")
+            queue.put_nowait((message, on_sent))
+        return True
+
+    async def _worker(self, key, bot, chat_id):
+        queue = self._queues[key]
+        loop = asyncio.get_running_loop()
+        while True:
+            messages = [await queue.get()]
+            # Give alerts arriving close together the chance to go out in the same digest
+            deadline = loop.time() + self.digest_window
+            while (timeout := deadline - loop.time()) > 0:
+                try:
+                    messages.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                # Counted per digest, a failed one doesn't take down the alerts of those already sent
+                failed = set()
+                for digest, indexes in build_digest_groups([message for message, _ in messages]):
+                    try:
+                        await self._chat_buckets[key].acquire()
+                        await self._bot_buckets[bot.token].acquire()
+                        await self._send(bot, chat_id, digest)
+                    except Exception as e:
+                        self.failed += 1
+                        failed |= indexes
+                        print(f"Error sending a digest of {len(indexes)} alerts to chat {chat_id}: {e}")
+                delivered = [on_sent for index, (_, on_sent) in enumerate(messages) if index not in failed]
+                self.sent += len(delivered)
+                metrics.inc("telegram_alerts_total", len(delivered), outcome="sent")
+                metrics.inc("telegram_alerts_total", len(failed), outcome="failed")
+                for on_sent in delivered:
+                    if on_sent is None:
+                        continue
+                    try:
+                        on_sent()
+                    except Exception as e:
+                        print(f"Error after sending an alert to chat {chat_id}: {e}")
+            finally:
+                for _ in messages:
+                    queue.task_done()
+
+    async def _send(self, bot, chat_id, text):
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML)
+                self.digests += 1
+                metrics.observe("telegram_send_seconds", time.perf_counter() - started)
+                return
+            except (BadRequest, Forbidden):
+                # Bad markup, a message too long, an unknown chat or a blocked bot, retrying can't help
+                raise
+            except RetryAfter as e:
+                error = e
+                metrics.inc("telegram_retries_total", reason="retry_after")
+                retry_after = e.retry_after
+                delay = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+            except NetworkError as e:
+                error = e
+                metrics.inc("telegram_retries_total", reason="network")
+                delay = min(60, 2 ** attempt)
+            if attempt >= self.max_retries:
+                raise error
+            attempt += 1
+            self.retries += 1
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        """
+        Returns the delivery counters and the depth of every chat queue.
+        """
+        return {
+            "sent": self.sent,
+            "digests": self.digests,
+            "retries": self.retries,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "queued": {chat_id: queue.qsize() for (_, chat_id), queue in self._queues.items()},
+        }
+
+    async def close(self, timeout=30):
+        """
+        Waits up to timeout seconds for the queued alerts to go out, then stops the workers.
+        """
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues.values())), timeout)
+        except asyncio.TimeoutError:
+            print("Timed out waiting for Telegram alerts to be delivered.")
+        for worker in self._workers.values():
+            worker.cancel()
+        await asyncio.gather(*self._workers.values(), return_exceptions=True)
+        self._queues, self._workers = {}, {}
+        await self.registry.close()
+
+# Example usage
+if __name__ == "__main__":
+    async def main():
+        chat_id = "5871291837"  # Replace with your chat_id
+        chat_id2 = "5871291837"
+        extracted_data = {
+            "title": "Example Post",
+            "topics_discussed": ["Topic 1", "Topic 2"],
+            "sentiment": ["positive"],
+            "actions_next_steps": ["Engage with community"],
+            "suggested_responses": ["This is a helpful response."],
+            "summary": "This post discusses AI and ML trends.",
+            "reddit_post_id": "t3_abc123"
+        }
+        dispatcher = TelegramDispatcher()
+        dispatcher.enqueue(chat_id, {**extracted_data, "subreddit": "learnpython"}, "Teaching Python")
+        dispatcher.enqueue(chat_id2, {**extracted_data, "subreddit": "learnpython"}, "Teaching Python")
+        await dispatcher.close()
+
+    asyncio.run(main())
@@ -1,28 +1,176 @@
-from telegram import Update
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
-import os
-from dotenv import load_dotenv
-
-load_dotenv()
-
-TELEGRAM_BOT_PYTHON_GUIDANCE_API_KEY = os.getenv("TELEGRAM_BOT_PYTHON_GUIDANCE_API_KEY")
-
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """
-    Handler for the /start command. Prints the chat_id when the command is received.
-    """
-    chat_id = update.effective_chat.id
-    await update.message.reply_text(f"Your chat ID is: {chat_id}")
-    print(f"Chat ID: {chat_id}")
-
-if __name__ == "__main__":
-    # Create the application and pass the bot token
-    application = ApplicationBuilder().token(TELEGRAM_BOT_PYTHON_GUIDANCE_API_KEY).build()
-
-    # Register the /start command handler
-    start_handler = CommandHandler('start', start)
-    application.add_handler(start_handler)
-
-    # Start the bot
-    print("Bot is running...")
-    application.run_polling()
+import asyncio
+from collections import OrderedDict
+from telegram import LinkPreviewOptions, Update
+from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
+from bot_routes import load_routes
+from query_cache import QueryCache, parse_window
+from rate_limit import TokenBucket
+from tele_bot import escape_html
+import datetime
+import metrics
+import os
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TELEGRAM_BOT_PYTHON_GUIDANCE_API_KEY = os.getenv("TELEGRAM_BOT_PYTHON_GUIDANCE_API_KEY")
+
+# Queries each chat may run per minute, with a small burst, so one chat can't keep the database busy
+TELEGRAM_QUERY_RATE_PER_MINUTE = float(os.getenv("TELEGRAM_QUERY_RATE_PER_MINUTE", "6"))
+TELEGRAM_QUERY_BURST = float(os.getenv("TELEGRAM_QUERY_BURST", "3"))
+MAX_RATE_LIMITED_CHATS = 10000
+DEFAULT_TOP_WINDOW = "24h"
+TITLE_MAX_CHARS = 120
+
+_chat_buckets = OrderedDict()
+
+
+def allow_query(chat_id):
+    """
+    Takes a token from the chat's bucket, returns False if the chat ran out of queries for now.
+    """
+    bucket = _chat_buckets.get(chat_id)
+    if bucket is None:
+        bucket = _chat_buckets[chat_id] = TokenBucket(TELEGRAM_QUERY_RATE_PER_MINUTE / 60, TELEGRAM_QUERY_BURST)
+        if len(_chat_buckets) > MAX_RATE_LIMITED_CHATS:
+            _chat_buckets.popitem(last=False)
+    _chat_buckets.move_to_end(chat_id)
+    return bucket.try_acquire()
+
+def resolve_category(name):
+    """
+    Returns the configured category matching name case-insensitively, or None.
+    """
+    for category in load_routes():
+        if category.lower() == name.strip().lower():
+            return category
+    return None
+
+def format_age(moment, now=None):
+    if moment is None:
+        return "?"
+    minutes = max(0, int(((now or datetime.datetime.now()) - moment).total_seconds() // 60))
+    if minutes < 60:
+        return f"{minutes}m"
+    return f"{minutes // 60}h" if minutes < 24 * 60 else f"{minutes // (24 * 60)}d"
+
+def format_posts(header, posts):
+    """
+    Formats cached post summaries as an HTML list, newest first.
+    """
+    if not posts:
+        return f"{header}\nNo posts found."
+    lines = [header]
+    for post in posts:
+        title = post["title"] if len(post["title"]) <= TITLE_MAX_CHARS else post["title"][:TITLE_MAX_CHARS] + "…"
+        url = f"https://www.reddit.com/r/{post['subreddit']}/comments/{post['reddit_post_id']}"
+        lines.append(f"• <a href=\"{escape_html(url)}\">{escape_html(title)}</a> "
+                     f"(r/{escape_html(post['subreddit'] or '?')}, {format_age(post['time_created'])} ago)")
+    return "\n".join(lines)
+
+def format_terms(header, terms):
+    if not terms:
+        return f"{header}\nNo keywords found."
+    return "\n".join([header] + [f"{rank}. {escape_html(term)}: {count}" for rank, (term, count) in enumerate(terms, 1)])
+
+async def answer(update, context, command, compute):
+    """
+    Runs a query for a chat within its rate limit, in a worker thread, and replies with its HTML result.
+    """
+    if not allow_query(update.effective_chat.id):
+        metrics.inc("bot_queries_total", command=command, outcome="rate_limited")
+        await update.message.reply_text("Too many queries, try again in a few seconds.")
+        return
+    started = time.perf_counter()
+    try:
+        text = await asyncio.to_thread(compute, context.bot_data["query_cache"])
+    except Exception as e:
+        print(f"Error answering /{command}: {e}")
+        metrics.inc("bot_queries_total", command=command, outcome="error")
+        await update.message.reply_text("Query failed, try again later.")
+        return
+    metrics.observe("bot_query_seconds", time.perf_counter() - started, command=command)
+    metrics.inc("bot_queries_total", command=command, outcome="ok")
+    await update.message.reply_text(text, parse_mode="HTML", link_preview_options=LinkPreviewOptions(is_disabled=True))
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handler for the /start command. Prints the chat_id when the command is received.
+    """
+    chat_id = update.effective_chat.id
+    await update.message.reply_text(f"Your chat ID is: {chat_id}")
+    print(f"Chat ID: {chat_id}")
+
+async def recent(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handler for /recent <category>, replies with the newest posts of the category.
+    """
+    category = resolve_category(" ".join(context.args))
+    if category is None:
+        await update.message.reply_text(f"Usage: /recent <category>, one of: {', '.join(load_routes())}")
+        return
+    await answer(update, context, "recent",
+                 lambda cache: format_posts(f"<b>Newest posts in {escape_html(category)}</b>", cache.recent(category)))
+
+async def top(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handler for /top <category> [window], replies with the most mentioned keywords, e.g. /top SaaS Development 7d.
+    """
+    args = list(context.args)
+    window_text = args.pop() if len(args) > 1 and parse_window(args[-1]) else DEFAULT_TOP_WINDOW
+    category = resolve_category(" ".join(args))
+    if category is None:
+        await update.message.reply_text(
+            f"Usage: /top <category> [window such as 6h, 7d], category one of: {', '.join(load_routes())}"
+        )
+        return
+    window = parse_window(window_text)
+    await answer(update, context, "top", lambda cache: format_terms(
+        f"<b>Top keywords in {escape_html(category)}, last {window_text}</b>", cache.top(category, window)
+    ))
+
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handler for /search <term>, replies with the newest posts whose topics or keywords include the term.
+    """
+    term = " ".join(context.args).strip()
+    if not term:
+        await update.message.reply_text("Usage: /search <term>")
+        return
+    await answer(update, context, "search",
+                 lambda cache: format_posts(f"<b>Posts about {escape_html(term)}</b>", cache.search(term)))
+
+async def post_init(application):
+    """
+    Connects to the database and starts keeping the query cache up to date.
+    """
+    from db import connect_to_db
+
+    await asyncio.to_thread(connect_to_db)
+    cache = application.bot_data["query_cache"] = QueryCache()
+    application.bot_data["refresh_task"] = asyncio.create_task(cache.refresh_periodically())
+
+async def post_shutdown(application):
+    task = application.bot_data.get("refresh_task")
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        print(f"Query cache: {application.bot_data['query_cache'].stats()}")
+
+if __name__ == "__main__":
+    # Create the application and pass the bot token
+    application = (
+        ApplicationBuilder().token(TELEGRAM_BOT_PYTHON_GUIDANCE_API_KEY)
+        .post_init(post_init).post_shutdown(post_shutdown).build()
+    )
+
+    # Register the command handlers
+    application.add_handler(CommandHandler('start', start))
+    application.add_handler(CommandHandler('recent', recent))
+    application.add_handler(CommandHandler('top', top))
+    application.add_handler(CommandHandler('search', search))
+
+    # Start the bot
+    print("Bot is running...")
+    application.run_polling()
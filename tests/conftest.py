@@ -0,0 +1,21 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The benchmark wires its in-memory config into the environment before any module reads it
+import benchmark  # noqa: E402,F401
+import mongoengine  # noqa: E402
+import mongomock  # noqa: E402
+import pytest  # noqa: E402
+
+
+@pytest.fixture
+def mongo(request):
+    """
+    Connects the documents to an empty mongomock database for the test.
+    """
+    mongoengine.disconnect_all()
+    mongoengine.connect(f"test_{request.node.name}", host="mongodb://localhost", mongo_client_class=mongomock.MongoClient)
+    yield
+    mongoengine.disconnect_all()
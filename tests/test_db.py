@@ -0,0 +1,103 @@
+import datetime
+
+from bson import ObjectId
+from pymongo.errors import AutoReconnect, WriteError
+import pytest
+
+import db
+
+
+def extracted(reddit_post_id, keywords=("python",)):
+    return {
+        "reddit_post_id": reddit_post_id, "subreddit": "learnpython", "time_scraped": datetime.datetime.now(),
+        "time_created": datetime.datetime(2024, 5, 1, 12), "title": "title", "reddit_user_id": "u1",
+        "sentiment": ["confused"], "actions_next_steps": [], "category": "Teaching Python", "filter_type": "new",
+        "suggested_responses": [], "summary": "summary", "topics_discussed": ["loops"], "keywords": list(keywords),
+    }
+
+
+@pytest.fixture
+def poisoned(monkeypatch):
+    # A write fails for good as soon as its batch holds a post named poison*
+    write_posts = db.write_posts
+    calls = []
+
+    def write(batch):
+        calls.append(len(batch))
+        if any(documents["post"]["reddit_post_id"].startswith("poison") for documents in batch):
+            raise WriteError("document failed validation", 121)
+        return write_posts(batch)
+
+    monkeypatch.setattr(db, "write_posts", write)
+    return calls
+
+
+def test_writer_isolates_poison_posts(mongo, poisoned):
+    writer = db.BulkPostWriter(batch_size=100, max_age=60)
+    for reddit_post_id in ["p0", "p1", "p2", "poison", "p4", "p5", "p6", "p7"]:
+        writer.add(extracted(reddit_post_id), "user", str(ObjectId()))
+
+    assert sorted(writer.flush()) == ["p0", "p1", "p2", "p4", "p5", "p6", "p7"]
+    assert [reddit_post_id for reddit_post_id, _ in writer.take_rejected()] == ["poison"]
+    assert writer.take_rejected() == []
+    assert len(writer) == 0
+    assert db.Post._get_collection().count_documents({}) == 7
+    # Halved down to the poison post: 8, then 4 + 4, 2 + 2, 1 + 1
+    assert len(poisoned) == 7
+
+
+def test_writer_keeps_batch_on_transient_errors(mongo, monkeypatch):
+    writer = db.BulkPostWriter(batch_size=100, max_age=60)
+    writer.add(extracted("p0"), "user", str(ObjectId()))
+    writer.add(extracted("p1"), "user", str(ObjectId()))
+
+    def down(batch):
+        raise AutoReconnect("connection refused")
+
+    write_posts = db.write_posts
+    monkeypatch.setattr(db, "write_posts", down)
+    with pytest.raises(AutoReconnect):
+        writer.flush()
+    assert len(writer) == 2
+    assert writer.take_rejected() == []
+
+    monkeypatch.setattr(db, "write_posts", write_posts)
+    assert sorted(writer.flush()) == ["p0", "p1"]
+
+
+def rollup_count(term):
+    rollup = db.TermRollup._get_collection().find_one({"granularity": "hour", "term": term, "subreddit": "*"})
+    return rollup and rollup["count"]
+
+
+def test_write_posts_replay_counts_rollups_once(mongo, monkeypatch):
+    batch = [db.build_post_documents(extracted(f"p{i}"), "user", post_id=str(ObjectId())) for i in range(3)]
+
+    class Down:
+        def bulk_write(self, *args, **kwargs):
+            raise AutoReconnect("connection refused")
+
+    # The first attempt stores the posts and dies before their rollups
+    get_collection = db.TermRollup._get_collection
+    monkeypatch.setattr(db.TermRollup, "_get_collection", classmethod(lambda cls: Down()))
+    with pytest.raises(AutoReconnect):
+        db.write_posts(batch)
+    monkeypatch.setattr(db.TermRollup, "_get_collection", get_collection)
+    assert db.Post._get_collection().count_documents({"rolled_up": True}) == 0
+
+    assert sorted(db.write_posts(batch)) == ["p0", "p1", "p2"]
+    assert sorted(db.write_posts(batch)) == ["p0", "p1", "p2"]
+    assert rollup_count("python") == 3
+    assert db.Post._get_collection().count_documents({"rolled_up": True}) == 3
+    assert db.Post._get_collection().count_documents({}) == 3
+
+
+def test_write_posts_skips_posts_saved_under_another_id(mongo):
+    db.write_posts([db.build_post_documents(extracted("p0"), "user", post_id=str(ObjectId()))])
+    again = db.build_post_documents(extracted("p0", keywords=("other",)), "user", post_id=str(ObjectId()))
+    fresh = db.build_post_documents(extracted("p1"), "user", post_id=str(ObjectId()))
+
+    assert sorted(db.write_posts([again, fresh])) == ["p0", "p1"]
+    assert rollup_count("python") == 2
+    assert rollup_count("other") is None
+    assert db.Keyword._get_collection().count_documents({"keyword": "other"}) == 0
@@ -0,0 +1,102 @@
+import asyncio
+
+from benchmark import FakeReddit, StubRegistry
+import db
+import pipeline
+from tele_bot import TelegramDispatcher
+from work_queue import WorkQueue
+
+START = 1700000000.0
+
+
+def make_reddit(posts):
+    """
+    Fake Reddit whose listings hold the given (subreddit, created_utc) posts, published in that order.
+    """
+    reddit = FakeReddit(sorted({name for name, _ in posts}), posts_per_minute=1, latency=0)
+    for name, created_utc in posts:
+        post = reddit._make_post(name)
+        post.created_utc = created_utc
+        reddit.listings[name].append(post)
+    return reddit
+
+
+def make_pipeline(reddit, limit=2):
+    return pipeline.Pipeline(reddit, limit=limit, dispatcher=TelegramDispatcher(registry=StubRegistry(0)),
+                             work_queue=WorkQueue(":memory:"))
+
+
+def read(pipe, members):
+    posts, overflow = asyncio.run(pipe._read_listing("+".join(members), members))
+    return [post.name for post in posts], overflow
+
+
+def fullname(reddit, name, index):
+    return reddit.listings[name][index].name
+
+
+def test_first_run_takes_the_latest_posts_of_each_subreddit():
+    reddit = make_reddit([(name, START + i) for i in range(5) for name in ("a", "b")])
+    pipe = make_pipeline(reddit, limit=2)
+
+    names, overflow = read(pipe, ["a", "b"])
+    assert names == [fullname(reddit, "b", 4), fullname(reddit, "a", 4),
+                     fullname(reddit, "b", 3), fullname(reddit, "a", 3)]
+    assert not overflow
+    assert pipe.read_through["a"] == pipe.read_through["b"] == (START + 4, fullname(reddit, "b", 4))
+
+
+def test_marked_subreddits_read_down_to_their_own_mark():
+    reddit = make_reddit([(name, START + i) for i in range(6) for name in ("a", "b")])
+    pipe = make_pipeline(reddit)
+    pipe.cursors = {"a": (fullname(reddit, "a", 3), START + 3), "b": (fullname(reddit, "b", 1), START + 1)}
+
+    names, overflow = read(pipe, ["a", "b"])
+    assert sorted(names) == sorted([fullname(reddit, "a", 4), fullname(reddit, "a", 5)]
+                                   + [fullname(reddit, "b", i) for i in range(2, 6)])
+    assert not overflow
+
+
+def test_posts_of_the_mark_second_are_ordered_by_fullname():
+    reddit = make_reddit([("a", START)] * 4)
+    pipe = make_pipeline(reddit)
+    pipe.cursors = {"a": (fullname(reddit, "a", 1), START)}
+
+    names, overflow = read(pipe, ["a"])
+    assert names == [fullname(reddit, "a", 3), fullname(reddit, "a", 2)]
+    assert not overflow
+
+
+def test_page_limit_before_a_mark_is_an_overflow(monkeypatch):
+    monkeypatch.setattr(pipeline, "HWM_MAX_POSTS", 5)
+    reddit = make_reddit([("a", START + i) for i in range(10)])
+    pipe = make_pipeline(reddit)
+    pipe.cursors = {"a": (fullname(reddit, "a", 0), START)}
+
+    names, overflow = read(pipe, ["a"])
+    assert len(names) == 5
+    assert overflow
+    # Not read down to its mark, so its read-through time stays where it was
+    assert "a" not in pipe.read_through
+
+
+def test_quiet_member_is_read_through_to_the_newest_post(mongo, monkeypatch):
+    monkeypatch.setattr(pipeline, "HWM_MAX_POSTS", 5)
+    reddit = make_reddit([("quiet", START)] + [("busy", START + 10 + i) for i in range(20)])
+    db.save_subreddit_cursor("quiet", fullname(reddit, "quiet", 0), START)
+    db.save_subreddit_cursor("busy", fullname(reddit, "busy", 17), START + 27)
+
+    pipe = make_pipeline(reddit)
+    asyncio.run(pipe.reload_cursors())
+    # The quiet subreddit's mark is below the page, as long as nothing moved it forward
+    names, overflow = read(pipe, ["busy", "quiet"])
+    assert overflow
+    assert names == [fullname(reddit, "busy", 19), fullname(reddit, "busy", 18)]
+
+    # Once read through in a listing that reached it, and persisted, the mark follows the listing
+    db.save_read_through({"quiet": (START + 29, fullname(reddit, "busy", 19))})
+    pipe = make_pipeline(reddit)
+    asyncio.run(pipe.reload_cursors())
+    names, overflow = read(pipe, ["busy", "quiet"])
+    assert names == [fullname(reddit, "busy", 19), fullname(reddit, "busy", 18)]
+    assert not overflow
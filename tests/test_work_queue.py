@@ -0,0 +1,55 @@
+import time
+
+from work_queue import WorkQueue
+
+
+def test_recover_makes_running_items_due():
+    queue = WorkQueue(":memory:")
+    queue.add("a", "enrich", {"n": 1})
+    queue.add("b", "persist", {"n": 2})
+    assert queue.claim_due() == []
+
+    assert queue.recover() == 2
+    assert sorted(queue.claim_due()) == [("a", "enrich", {"n": 1}), ("b", "persist", {"n": 2})]
+    assert queue.stats()["running"] == {"enrich": 1, "persist": 1}
+
+
+def test_add_ignores_known_posts():
+    queue = WorkQueue(":memory:")
+    assert queue.add("a", "enrich", {})
+    assert not queue.add("a", "enrich", {})
+
+
+def test_fail_backs_off_exponentially():
+    queue = WorkQueue(":memory:", max_attempts=5, backoff_base=10, backoff_max=25)
+    queue.add("a", "enrich", {})
+    delays = []
+    for _ in range(3):
+        before = time.time()
+        assert queue.fail("a", "boom") == "pending"
+        available_at = queue._conn.execute("SELECT available_at FROM work_items").fetchone()[0]
+        delays.append(round(available_at - before))
+    assert delays == [10, 20, 25]
+    assert queue.claim_due() == []
+
+
+def test_fail_dead_letters_after_max_attempts():
+    queue = WorkQueue(":memory:", max_attempts=2, backoff_base=0)
+    queue.add("a", "persist", {"n": 1})
+    assert queue.fail("a", "first") == "pending"
+    assert queue.claim_due() == [("a", "persist", {"n": 1})]
+    assert queue.fail("a", "second") == "dead"
+    assert queue.claim_due() == []
+    assert queue.dead_letters() == [("a", "persist", 2, "second")]
+
+    assert queue.retry_dead() == 1
+    assert queue.claim_due() == [("a", "persist", {"n": 1})]
+    assert queue.fail("unknown", "boom") is None
+
+
+def test_complete_removes_items():
+    queue = WorkQueue(":memory:")
+    queue.add("a", "enrich", {})
+    queue.advance("a", "persist", {"done": True})
+    queue.complete(["a"])
+    assert queue.stats() == {"pending": {}, "running": {}, "dead": {}}
@@ -0,0 +1,165 @@
+from db import ALL_SUBREDDITS, Post, TermRollup, build_rollup_ops, load_post_terms, truncate_to_bucket
+import datetime
+
+TERM_KINDS = ('keyword', 'topic', 'sentiment')
+# Windows longer than this are read from the daily counters instead of the hourly ones
+DAILY_ROLLUP_THRESHOLD = datetime.timedelta(days=2)
+
+
+def _check_kind(kind):
+    if kind not in TERM_KINDS:
+        raise ValueError("Invalid kind. Use 'keyword', 'topic', or 'sentiment'.")
+
+def _term_counts(kind, category, subreddit, since, until, granularity):
+    """
+    Sums the counters of every term of a kind over [since, until) and returns {term: count}.
+    """
+    match = {
+        "granularity": granularity,
+        "kind": kind,
+        "category": category,
+        "subreddit": subreddit or ALL_SUBREDDITS,
+        "bucket": {"$gte": truncate_to_bucket(since, granularity), "$lt": until},
+    }
+    pipeline = [
+        {"$match": match},
+        {"$group": {"_id": "$term", "count": {"$sum": "$count"}}},
+    ]
+    return {doc["_id"]: doc["count"] for doc in TermRollup._get_collection().aggregate(pipeline)}
+
+def top_terms(kind, category, subreddit=None, window=datetime.timedelta(days=1), now=None, n=10, granularity=None):
+    """
+    Returns the most mentioned terms of a category or subreddit over a time window.
+
+    Parameters:
+    ----------
+    kind : str
+        'keyword', 'topic' or 'sentiment'.
+    category : str
+        The category to read.
+    subreddit : str, optional
+        Restricts the counts to one subreddit of the category (default is the whole category).
+    window : timedelta, optional
+        How far back to count (default is one day). The first bucket is counted whole.
+    now : datetime, optional
+        End of the window (default is now, in the same local time as Post.time_created).
+    n : int, optional
+        Number of terms returned (default is 10).
+    granularity : str, optional
+        'hour' or 'day' (default is picked from the window size).
+
+    Returns:
+    -------
+    list
+        (term, count) tuples, most mentioned first.
+    """
+    _check_kind(kind)
+    now = now or datetime.datetime.now()
+    granularity = granularity or ("day" if window > DAILY_ROLLUP_THRESHOLD else "hour")
+    counts = _term_counts(kind, category, subreddit, now - window, now, granularity)
+    return sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:n]
+
+def spikes(kind, category, subreddit=None, window=datetime.timedelta(hours=6), baseline=datetime.timedelta(days=7),
+           now=None, n=10, min_count=3, smoothing=1.0):
+    """
+    Returns the terms mentioned much more often in the recent window than over the baseline before it.
+
+    A term's ratio is its count in the window over the count expected from its baseline rate,
+    both smoothed so that terms never seen before rank by how often they appear now.
+
+    Parameters:
+    ----------
+    kind : str
+        'keyword', 'topic' or 'sentiment'.
+    category : str
+        The category to read.
+    subreddit : str, optional
+        Restricts the counts to one subreddit of the category (default is the whole category).
+    window : timedelta, optional
+        The recent window (default is 6 hours).
+    baseline : timedelta, optional
+        The period right before the window the rate is compared to (default is 7 days).
+    now : datetime, optional
+        End of the window (default is now).
+    n : int, optional
+        Number of terms returned (default is 10).
+    min_count : int, optional
+        Terms mentioned fewer times in the window are ignored (default is 3).
+    smoothing : float, optional
+        Count added to both sides of the ratio (default is 1).
+
+    Returns:
+    -------
+    list
+        Dicts with term, count, expected and ratio, highest ratio first.
+    """
+    _check_kind(kind)
+    now = now or datetime.datetime.now()
+    start = now - window
+    recent = _term_counts(kind, category, subreddit, start, now, "hour")
+    # The window starts mid-hour, its first hour is already counted in recent
+    past = _term_counts(kind, category, subreddit, start - baseline, truncate_to_bucket(start, "hour"), "hour")
+
+    scale = window / baseline
+    results = []
+    for term, count in recent.items():
+        if count < min_count:
+            continue
+        expected = past.get(term, 0) * scale
+        results.append({
+            "term": term,
+            "count": count,
+            "expected": round(expected, 2),
+            "ratio": round((count + smoothing) / (expected + smoothing), 2),
+        })
+    results.sort(key=lambda result: (-result["ratio"], -result["count"], result["term"]))
+    return results[:n]
+
+def rebuild_rollups(batch_size=1000):
+    """
+    Recomputes every counter from the posts already stored, e.g. after enabling ROLLUPS_ENABLED.
+    """
+    TermRollup.drop_collection()
+    TermRollup.ensure_indexes()
+
+    collection = Post._get_collection()
+    projection = {"subreddit": 1, "category": 1, "time_created": 1, "sentiment": 1, "topic_terms": 1, "keyword_terms": 1}
+    cursor = collection.find({}, projection).sort("_id", 1)
+    rebuilt = 0
+    batch = []
+
+    def flush():
+        terms = load_post_terms(batch)
+        documents = []
+        for post in batch:
+            terms[post["_id"]]["sentiment"] = [s for s in (post.get("sentiment") or "").split(", ") if s]
+            documents.append({"post": post, "terms": terms[post["_id"]]})
+        ops = build_rollup_ops(documents)
+        if ops:
+            TermRollup._get_collection().bulk_write(ops, ordered=False)
+        collection.update_many({"_id": {"$in": [post["_id"] for post in batch]}}, {"$set": {"rolled_up": True}})
+
+    for post in cursor:
+        batch.append(post)
+        if len(batch) >= batch_size:
+            flush()
+            rebuilt += len(batch)
+            batch = []
+    if batch:
+        flush()
+        rebuilt += len(batch)
+    print(f"Rebuilt trend rollups from {rebuilt} posts.")
+    return rebuilt
+
+
+if __name__ == "__main__":
+    import sys
+    from db import connect_to_db
+
+    connect_to_db()
+    if sys.argv[1:] == ["rebuild"]:
+        rebuild_rollups()
+    else:
+        for category in sys.argv[1:] or ["Teaching Python", "SaaS Development"]:
+            print(f"{category}: top keywords of the last day {top_terms('keyword', category)}")
+            print(f"{category}: keyword spikes {spikes('keyword', category)}")
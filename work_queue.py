@@ -0,0 +1,204 @@
+from dotenv import load_dotenv
+import json
+import os
+import sqlite3
+import time
+
+load_dotenv()
+
+WORK_QUEUE_PATH = os.getenv("WORK_QUEUE_PATH", "work_queue.sqlite3")
+# A failed item is retried with exponential backoff, then dead-lettered after this many attempts
+WORK_QUEUE_MAX_ATTEMPTS = int(os.getenv("WORK_QUEUE_MAX_ATTEMPTS", "5"))
+WORK_QUEUE_BACKOFF_BASE = float(os.getenv("WORK_QUEUE_BACKOFF_BASE", "30"))
+WORK_QUEUE_BACKOFF_MAX = float(os.getenv("WORK_QUEUE_BACKOFF_MAX", "3600"))
+
+# 'running' items are in the pipeline's memory, 'pending' ones wait for a retry, 'dead' ones gave up
+STATES = ("pending", "running", "dead")
+
+
+class WorkQueue:
+    """
+    Durable queue of the posts between fetching and saving, stored in a local SQLite file.
+
+    Every fetched post gets one row keyed by its reddit_post_id, holding the stage it has
+    to go through next and a JSON payload with everything that stage needs. A stage that
+    finishes moves the row to the next stage with its result, so an LLM extraction is paid
+    for once even if the process dies before the post is saved, and the row is deleted
+    once the post is in the database. Failed items are retried with backoff and
+    dead-lettered after max_attempts. Items left 'running' by a crash are picked up again
+    on the next start, so processing is at-least-once.
+
+    Attributes:
+    ----------
+    path : str
+        Path of the SQLite file, ':memory:' keeps the queue in memory only.
+    max_attempts : int
+        Failures of an item before it is dead-lettered.
+    backoff_base : float
+        Seconds before the first retry, doubled on every further failure.
+    backoff_max : float
+        Max seconds between two retries.
+    """
+    def __init__(self, path=WORK_QUEUE_PATH, max_attempts=WORK_QUEUE_MAX_ATTEMPTS,
+                 backoff_base=WORK_QUEUE_BACKOFF_BASE, backoff_max=WORK_QUEUE_BACKOFF_MAX):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # Every state change is committed, NORMAL only risks the last commits on a power loss
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS work_items ("
+            "reddit_post_id TEXT PRIMARY KEY, stage TEXT NOT NULL, state TEXT NOT NULL, payload TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, last_error TEXT, available_at REAL NOT NULL, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS work_items_due ON work_items (state, available_at)")
+        self._conn.commit()
+
+    def add(self, reddit_post_id, stage, payload):
+        """
+        Records a new item as running in the given stage.
+
+        Returns:
+        -------
+        bool
+            False if the post already has an item, whatever its state.
+        """
+        now = time.time()
+        cursor = self._conn.execute(
+            "INSERT OR IGNORE INTO work_items "
+            "(reddit_post_id, stage, state, payload, available_at, created_at, updated_at) "
+            "VALUES (?, ?, 'running', ?, ?, ?, ?)",
+            (reddit_post_id, stage, json.dumps(payload), now, now, now)
+        )
+        self._conn.commit()
+        return cursor.rowcount == 1
+
+    def advance(self, reddit_post_id, stage, payload):
+        """
+        Moves an item to its next stage with the payload that stage needs.
+        """
+        self._conn.execute(
+            "UPDATE work_items SET stage = ?, payload = ?, updated_at = ? WHERE reddit_post_id = ?",
+            (stage, json.dumps(payload), time.time(), reddit_post_id)
+        )
+        self._conn.commit()
+
+    def complete(self, reddit_post_ids):
+        """
+        Deletes the items of posts that are saved, or that were dropped on purpose.
+        """
+        self._conn.executemany(
+            "DELETE FROM work_items WHERE reddit_post_id = ?", [(reddit_post_id,) for reddit_post_id in reddit_post_ids]
+        )
+        self._conn.commit()
+
+    def fail(self, reddit_post_id, error):
+        """
+        Schedules a retry of a failed item, or dead-letters it once it ran out of attempts.
+
+        Returns:
+        -------
+        str
+            The new state of the item, 'pending' or 'dead', None if the item is unknown.
+        """
+        row = self._conn.execute(
+            "SELECT attempts FROM work_items WHERE reddit_post_id = ?", (reddit_post_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        attempts = row[0] + 1
+        state = "dead" if attempts >= self.max_attempts else "pending"
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+        now = time.time()
+        self._conn.execute(
+            "UPDATE work_items SET state = ?, attempts = ?, last_error = ?, available_at = ?, updated_at = ? "
+            "WHERE reddit_post_id = ?",
+            (state, attempts, str(error)[:1000], now + delay, now, reddit_post_id)
+        )
+        self._conn.commit()
+        return state
+
+    def claim_due(self, limit=100):
+        """
+        Marks up to limit pending items whose retry time has come as running and returns them.
+
+        Returns:
+        -------
+        list
+            (reddit_post_id, stage, payload) tuples, oldest first.
+        """
+        rows = self._conn.execute(
+            "SELECT reddit_post_id, stage, payload FROM work_items "
+            "WHERE state = 'pending' AND available_at <= ? ORDER BY available_at LIMIT ?",
+            (time.time(), limit)
+        ).fetchall()
+        self._conn.executemany(
+            "UPDATE work_items SET state = 'running', updated_at = ? WHERE reddit_post_id = ?",
+            [(time.time(), row[0]) for row in rows]
+        )
+        self._conn.commit()
+        return [(reddit_post_id, stage, json.loads(payload)) for reddit_post_id, stage, payload in rows]
+
+    def recover(self):
+        """
+        Makes the items a previous process left running due now. Call it once at startup.
+        """
+        cursor = self._conn.execute(
+            "UPDATE work_items SET state = 'pending', available_at = ? WHERE state = 'running'", (time.time(),)
+        )
+        self._conn.commit()
+        return cursor.rowcount
+
+    def retry_dead(self):
+        """
+        Puts every dead-lettered item back in the queue with a fresh set of attempts.
+        """
+        cursor = self._conn.execute(
+            "UPDATE work_items SET state = 'pending', attempts = 0, available_at = ? WHERE state = 'dead'",
+            (time.time(),)
+        )
+        self._conn.commit()
+        return cursor.rowcount
+
+    def dead_letters(self, limit=100):
+        """
+        Returns (reddit_post_id, stage, attempts, last_error) of the dead-lettered items.
+        """
+        return self._conn.execute(
+            "SELECT reddit_post_id, stage, attempts, last_error FROM work_items "
+            "WHERE state = 'dead' ORDER BY updated_at DESC LIMIT ?", (limit,)
+        ).fetchall()
+
+    def stats(self):
+        """
+        Returns the number of items per state and per stage.
+        """
+        counts = {state: {} for state in STATES}
+        for state, stage, count in self._conn.execute(
+            "SELECT state, stage, COUNT(*) FROM work_items GROUP BY state, stage"
+        ):
+            counts[state][stage] = count
+        return counts
+
+    def close(self):
+        self._conn.close()
+
+
+if __name__ == "__main__":
+    import sys
+
+    queue = WorkQueue()
+    # python work_queue.py [stats | dead | retry-dead]
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    if command == "dead":
+        for reddit_post_id, stage, attempts, last_error in queue.dead_letters():
+            print(f"{reddit_post_id} ({stage}, {attempts} attempts): {last_error}")
+    elif command == "retry-dead":
+        print(f"{queue.retry_dead()} dead items queued again.")
+    else:
+        print(queue.stats())
+    queue.close()